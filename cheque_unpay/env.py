@@ -0,0 +1,122 @@
+"""
+Environment configuration of the project, read once per process.
+
+test.env and .env are loaded here and nowhere else; settings.py and the app read
+the typed values of `env` instead of calling os.getenv themselves.
+"""
+
+import json
+import os
+
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from typing import Optional
+
+from dotenv import load_dotenv
+
+
+TRUE_VALUES = {'true', '1', 'yes', 'on'}
+FALSE_VALUES = {'false', '0', 'no', 'off', ''}
+
+
+def to_bool(value):
+    """true/1/yes/on and false/0/no/off (or empty), in any case; anything else is a configuration error"""
+    normalized = value.strip().lower()
+    if normalized in TRUE_VALUES:
+        return True
+    if normalized in FALSE_VALUES:
+        return False
+    raise ValueError(f'{value!r} is not a boolean, use true or false')
+
+
+def to_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def env_field(name, default=None, parse=str):
+    """a field read from the environment variable `name`, parsed with `parse` (the default is parsed too)"""
+    return field(metadata={'env': name, 'default': default, 'parse': parse})
+
+
+@dataclass(frozen=True)
+class Env:
+    # django
+    secret_key: Optional[str] = env_field('DEV_SECRET_KEY')
+    host: Optional[str] = env_field('DEV_HOST')
+    api_only_mode: bool = env_field('API_ONLY_MODE', 'False', to_bool)
+    service_token_cache_ttl: int = env_field('SERVICE_TOKEN_CACHE_TTL', '60', int)
+    warmup_on_start: bool = env_field('WARMUP_ON_START', 'False', to_bool)
+
+    # T24
+    tws_user: Optional[str] = env_field('TWS_USER')
+    tws_password: Optional[str] = env_field('TWS_PWD')
+    tws_co_code: Optional[str] = env_field('TWS_CO')
+    unpay_cheque_wsdl: Optional[str] = env_field('TEST_UNPAY_CHEQUE_URL')
+    query_cc_wsdl: Optional[str] = env_field('TEST_QUERY_CC_URL')
+    unpaid_charge_wsdl: Optional[str] = env_field('TEST_CHARGE_UNPAID_URL')
+    t24_companies: dict = env_field('T24_COMPANIES', '{}', json.loads)
+    t24_pool_max_concurrency: int = env_field('T24_POOL_MAX_CONCURRENCY', '8', int)
+    t24_pool_max_queue: int = env_field('T24_POOL_MAX_QUEUE', '16', int)
+    t24_pool_queue_timeout: float = env_field('T24_POOL_QUEUE_TIMEOUT', '10', float)
+    t24_record_dir: Optional[str] = env_field('T24_RECORD_DIR')
+    t24_record_mask_elements: list = env_field('T24_RECORD_MASK_ELEMENTS',
+                                               'CREDITACCNO,DEBITACCOUNT,TXNID,criteriaValue', to_list)
+
+    # admission control
+    throttle_redis_url: Optional[str] = env_field('THROTTLE_REDIS_URL')
+    throttle_owner_rate: float = env_field('THROTTLE_OWNER_RATE', '5', float)
+    throttle_owner_burst: int = env_field('THROTTLE_OWNER_BURST', '10', int)
+    throttle_global_rate: float = env_field('THROTTLE_GLOBAL_RATE', '50', float)
+    throttle_global_burst: int = env_field('THROTTLE_GLOBAL_BURST', '100', int)
+    throttle_owner_max_in_flight: int = env_field('THROTTLE_OWNER_MAX_IN_FLIGHT', '4', int)
+
+    # profiling
+    profile_sample_rate: float = env_field('PROFILE_SAMPLE_RATE', '0', float)
+    profile_header_token: str = env_field('PROFILE_HEADER_TOKEN', '')
+    profile_dir: Optional[str] = env_field('PROFILE_DIR')
+
+    # webhooks
+    webhook_max_pending: int = env_field('WEBHOOK_MAX_PENDING', '10000', int)
+    webhook_batch_size: int = env_field('WEBHOOK_BATCH_SIZE', '100', int)
+    webhook_max_attempts: int = env_field('WEBHOOK_MAX_ATTEMPTS', '10', int)
+    webhook_timeout: float = env_field('WEBHOOK_TIMEOUT', '10', float)
+    webhook_backoff_base: float = env_field('WEBHOOK_BACKOFF_BASE', '5', float)
+    webhook_backoff_max: float = env_field('WEBHOOK_BACKOFF_MAX', '3600', float)
+    webhook_allow_local: bool = env_field('WEBHOOK_ALLOW_LOCAL', 'False', to_bool)
+
+    # write-behind batching
+    write_behind_enabled: bool = env_field('WRITE_BEHIND_ENABLED', 'False', to_bool)
+    write_behind_max_batch: int = env_field('WRITE_BEHIND_MAX_BATCH', '50', int)
+    write_behind_max_wait_ms: float = env_field('WRITE_BEHIND_MAX_WAIT_MS', '5', float)
+    write_behind_timeout: float = env_field('WRITE_BEHIND_TIMEOUT', '30', float)
+
+    # background work
+    background_workers: int = env_field('BACKGROUND_WORKERS', '4', int)
+    background_queue_size: int = env_field('BACKGROUND_QUEUE_SIZE', '1000', int)
+    health_interval: float = env_field('HEALTH_INTERVAL', '10', float)
+    health_timeout: float = env_field('HEALTH_TIMEOUT', '3', float)
+    health_stale_after: float = env_field('HEALTH_STALE_AFTER', '60', float)
+    health_state_token: str = env_field('HEALTH_STATE_TOKEN', '')
+    health_state_public: bool = env_field('HEALTH_STATE_PUBLIC', 'False', to_bool)
+    charge_collection_max_per_run: int = env_field('CHARGE_COLLECTION_MAX_PER_RUN', '1000', int)
+    charge_collection_rate: float = env_field('CHARGE_COLLECTION_RATE', '5', float)
+    charge_collection_concurrency: int = env_field('CHARGE_COLLECTION_CONCURRENCY', '4', int)
+    charge_collection_batch_size: int = env_field('CHARGE_COLLECTION_BATCH_SIZE', '50', int)
+    charge_collection_claim_ttl: int = env_field('CHARGE_COLLECTION_CLAIM_TTL', '3600', int)
+
+    @classmethod
+    def load(cls):
+        """loads test.env and .env (variables already set in the environment win) and parses every field"""
+        load_dotenv(dotenv_path=Path('test.env'))
+        load_dotenv()
+        values = {}
+        for f in fields(cls):
+            raw = os.getenv(f.metadata['env'], f.metadata['default'])
+            try:
+                values[f.name] = f.metadata['parse'](raw) if raw is not None else None
+            except ValueError as e:
+                raise ValueError(f"{f.metadata['env']}: {e}") from e
+        return cls(**values)
+
+
+env = Env.load()
@@ -11,10 +11,7 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
 from pathlib import Path
-from dotenv import load_dotenv
-import os
-
-load_dotenv(dotenv_path=Path('test.env'))
+from .env import env
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -24,13 +21,13 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # See https://docs.djangoproject.com/en/4.0/howto/deployment/checklist/
 
 # SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = os.getenv('DEV_SECRET_KEY')
+SECRET_KEY = env.secret_key
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
 ALLOWED_HOSTS = [
-    os.getenv('DEV_HOST'),
+    env.host,
 ]
 
 
@@ -47,7 +44,8 @@ INSTALLED_APPS = [
     'unpay_cheque'
 ]
 
-MIDDLEWARE = [
+FULL_MIDDLEWARE = [
+    'unpay_cheque.profiling.SamplingProfilerMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,6 +55,27 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# API-only mode: machine-to-machine calls under API_PATH_PREFIXES skip the session, CSRF, auth, messages
+# and clickjacking middleware and authenticate with service tokens only. the admin keeps the full stack
+API_ONLY_MODE = env.api_only_mode
+
+API_PATH_PREFIXES = ['/unpaids/', '/charges/', '/users/', '/webhooks/', '/health/']
+
+# the browser-only variant (see unpay_cheque/middleware.py) that replaces each middleware in API-only mode
+BROWSER_ONLY_MIDDLEWARE = {
+    'django.contrib.sessions.middleware.SessionMiddleware': 'unpay_cheque.middleware.BrowserOnlySessionMiddleware',
+    'django.middleware.csrf.CsrfViewMiddleware': 'unpay_cheque.middleware.BrowserOnlyCsrfViewMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware':
+        'unpay_cheque.middleware.BrowserOnlyAuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware': 'unpay_cheque.middleware.BrowserOnlyMessageMiddleware',
+    'django.middleware.clickjacking.XFrameOptionsMiddleware':
+        'unpay_cheque.middleware.BrowserOnlyXFrameOptionsMiddleware',
+}
+
+API_ONLY_MIDDLEWARE = [BROWSER_ONLY_MIDDLEWARE.get(middleware, middleware) for middleware in FULL_MIDDLEWARE]
+
+MIDDLEWARE = API_ONLY_MIDDLEWARE if API_ONLY_MODE else FULL_MIDDLEWARE
+
 ROOT_URLCONF = 'cheque_unpay.urls'
 
 TEMPLATES = [
@@ -135,5 +154,136 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # adding pagination to the API
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
-    'PAGE_SIZE': 10
+    'PAGE_SIZE': 10,
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'unpay_cheque.authentication.ServiceTokenAuthentication',
+        'rest_framework.authentication.SessionAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
+}
+
+# in API-only mode the API takes service tokens only, no session or password on every call
+if API_ONLY_MODE:
+    REST_FRAMEWORK['DEFAULT_AUTHENTICATION_CLASSES'] = ['unpay_cheque.authentication.ServiceTokenAuthentication']
+
+# seconds a service token lookup is cached in-process
+SERVICE_TOKEN_CACHE_TTL = env.service_token_cache_ttl
+
+
+# caches. the admission control counters live in the 'throttle' cache when THROTTLE_REDIS_URL is set so
+# that every worker shares the same limits; without it each worker keeps its own in-memory counters
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+if env.throttle_redis_url:
+    CACHES['throttle'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': env.throttle_redis_url,
+    }
+
+
+# admission control on the endpoints that call T24 (see unpay_cheque/throttling.py).
+# rates are tokens per second, bursts are bucket sizes
+ADMISSION_CONTROL = {
+    'OWNER_RATE': env.throttle_owner_rate,
+    'OWNER_BURST': env.throttle_owner_burst,
+    'GLOBAL_RATE': env.throttle_global_rate,
+    'GLOBAL_BURST': env.throttle_global_burst,
+    'OWNER_MAX_IN_FLIGHT': env.throttle_owner_max_in_flight,
+}
+
+
+# sampling profiler (see unpay_cheque/profiling.py). off unless PROFILE_SAMPLE_RATE (0..1) or
+# PROFILE_HEADER_TOKEN is set; with a token, requests sending `X-Profile: <token>` are always profiled
+PROFILING = {
+    'SAMPLE_RATE': env.profile_sample_rate,
+    'HEADER_TOKEN': env.profile_header_token,
+    'PATH_PREFIXES': ['/unpaids/', '/charges/'],
+    'OUTPUT_DIR': Path(env.profile_dir) if env.profile_dir else BASE_DIR / 'profiles',
 }
+
+
+# per-company T24 routing (see unpay_cheque/t24.py). T24_COMPANIES is a JSON object keyed by COCODE, e.g.
+# {"KE0010002": {"user": "...", "password": "...", "unpay_cheque": "<wsdl url>", "max_concurrency": 2}}
+# a company can override user, password, the query_cc/unpay_cheque/unpaid_charge WSDLs and its pool sizes
+T24_COMPANIES = env.t24_companies
+
+# default pool sizes per service and company: calls running at a time, callers allowed to wait (0: none, a call
+# without a free slot fails at once) and seconds they wait
+T24_POOL = {
+    'MAX_CONCURRENCY': env.t24_pool_max_concurrency,
+    'MAX_QUEUE': env.t24_pool_max_queue,
+    'QUEUE_TIMEOUT': env.t24_pool_queue_timeout,
+}
+
+# recording of T24 traffic for `manage.py benchmark replay` (see unpay_cheque/cassettes.py), off unless
+# T24_RECORD_DIR is set. SECRET_ELEMENTS are blanked out of the recorded XML, MASK_ELEMENTS (by default the
+# accounts, the FT references and the query_cc criteriaValue, which is an FT reference too) and the cheque
+# number, FT reference and account of the recorded requests get their digits replaced by a keyed hash
+T24_TRAFFIC = {
+    'RECORD_DIR': Path(env.t24_record_dir) if env.t24_record_dir else None,
+    'SECRET_ELEMENTS': ['userName', 'password'],
+    'MASK_ELEMENTS': env.t24_record_mask_elements,
+}
+
+
+# outbound webhooks (see unpay_cheque/webhooks.py). MAX_PENDING bounds each subscription's outbox,
+# backoff is BACKOFF_BASE * 2^(attempt - 1) seconds capped at BACKOFF_MAX
+WEBHOOKS = {
+    'MAX_PENDING': env.webhook_max_pending,
+    'BATCH_SIZE': env.webhook_batch_size,
+    'MAX_ATTEMPTS': env.webhook_max_attempts,
+    'TIMEOUT': env.webhook_timeout,
+    'BACKOFF_BASE': env.webhook_backoff_base,
+    'BACKOFF_MAX': env.webhook_backoff_max,
+    # callback URLs must be https and resolve to public addresses only. turn on to point a subscription at
+    # `manage.py webhook_sink` on a development machine, never in production
+    'ALLOW_LOCAL': env.webhook_allow_local,
+}
+
+
+# write-behind micro-batching of the UnpaidCheque and Charge inserts (see unpay_cheque/batching.py). a batch is
+# written once it has MAX_BATCH rows or MAX_WAIT_MS after its first row, and requests return after its commit.
+# a request waits at most TIMEOUT seconds for the commit and then fails, its row may still be written later
+WRITE_BEHIND = {
+    'ENABLED': env.write_behind_enabled,
+    'MAX_BATCH': env.write_behind_max_batch,
+    'MAX_WAIT_MS': env.write_behind_max_wait_ms,
+    'TIMEOUT': env.write_behind_timeout,
+}
+
+
+# threads running follow-up T24 work queued from the admin (see unpay_cheque/tasks.py), and the tasks
+# allowed to be queued or running at a time; the queue lives in the web worker and is lost when it restarts
+BACKGROUND_WORKERS = env.background_workers
+BACKGROUND_QUEUE_SIZE = env.background_queue_size
+
+# health endpoints for the load balancer (see unpay_cheque/health.py): the readiness checks run every
+# INTERVAL seconds in the background, each WSDL fetch times out after TIMEOUT seconds and results older than
+# STALE_AFTER seconds make the node unready. /health/state is only answered for `X-Health-Token: <STATE_TOKEN>`
+# or a staff user, unless STATE_PUBLIC opens it to anyone
+HEALTH = {
+    'INTERVAL': env.health_interval,
+    'TIMEOUT': env.health_timeout,
+    'STALE_AFTER': env.health_stale_after,
+    'STATE_TOKEN': env.health_state_token,
+    'STATE_PUBLIC': env.health_state_public,
+}
+
+
+# defaults of `manage.py collect_charges` (see unpay_cheque/collection.py)
+CHARGE_COLLECTION = {
+    'MAX_PER_RUN': env.charge_collection_max_per_run,
+    'RATE': env.charge_collection_rate,
+    'CONCURRENCY': env.charge_collection_concurrency,
+    'BATCH_SIZE': env.charge_collection_batch_size,
+    'CLAIM_TTL': env.charge_collection_claim_ttl,
+}
+
+
+# warm the SOAP clients, serializers and URLconf up when the app loads (see unpay_cheque/warmup.py),
+# meant for gunicorn --preload so the work is done once in the master instead of on each first request
+WARMUP_ON_START = env.warmup_on_start
@@ -1,7 +1,99 @@
-from django.contrib import admin
-from .models import UnpaidCheque, Charge
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import connection
+from django.utils.functional import cached_property
+from .models import UnpaidCheque, Charge, ServiceToken
+from . import tasks
 
-# Register your models here.
-admin.site.register(UnpaidCheque)
-admin.site.register(Charge)
 
+class EstimatedCountPaginator(Paginator):
+    """
+    Uses the planner's row estimate instead of COUNT(*) for an unfiltered changelist on PostgreSQL,
+    where counting millions of rows takes longer than rendering the page. Filtered changelists and
+    other databases get the exact count.
+    """
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if connection.vendor == 'postgresql' and query is not None and not query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [query.model._meta.db_table])
+                row = cursor.fetchone()
+            # reltuples is -1 (or 0) for a table that has never been analyzed
+            if row and row[0] > 0:
+                return int(row[0])
+        return super().count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # don't run a second COUNT(*) over the whole table next to the filtered count
+    show_full_result_count = False
+    list_per_page = 50
+
+
+def queue_for_rows(modeladmin, request, queryset, task, pk_field='pk'):
+    """
+    queues task(pk) on the background pool for the selected rows until the queue is full and tells the
+    user how many were queued. queued rows are lost if the worker restarts before they run
+    """
+    queued = 0
+    for pk in queryset.order_by().values_list(pk_field, flat=True).distinct().iterator():
+        try:
+            tasks.submit(task, pk)
+        except tasks.QueueFull:
+            remaining = queryset.order_by().values_list(pk_field, flat=True).distinct().count() - queued
+            modeladmin.message_user(
+                request, f'queued {queued} rows; the background queue is full, {remaining} rows were not queued. '
+                         f'run the action again on them once the queue has drained', messages.WARNING)
+            return
+        queued += 1
+    modeladmin.message_user(request, f'queued {queued} rows, the results will show up as they come back from T24. '
+                                     f'rows still queued when the server restarts are dropped', messages.SUCCESS)
+
+
+@admin.register(UnpaidCheque)
+class UnpaidChequeAdmin(LargeTableAdmin):
+    list_display = ['ft_ref', 'cheque_number', 'cheque_amount', 'is_unpaid', 'cc_record', 'cheque_account', 'owner',
+                    'logged_at']
+    list_select_related = ['owner']
+    list_filter = ['is_unpaid']
+    # exact matches so that the indexes are used
+    search_fields = ['=ft_ref', '=cheque_number', '=cc_record', '=cheque_account']
+    date_hierarchy = 'logged_at'
+    raw_id_fields = ['owner']
+    actions = ['requery_t24', 'attempt_charge']
+
+    @admin.action(description='Re-query T24 and unpay selected cheques that are not unpaid')
+    def requery_t24(self, request, queryset):
+        queue_for_rows(self, request, queryset.filter(is_unpaid=False), tasks.requery_unpaid_cheque)
+
+    @admin.action(description='Attempt to collect the charge of selected unpaid cheques')
+    def attempt_charge(self, request, queryset):
+        queue_for_rows(self, request, queryset.filter(is_unpaid=True), tasks.attempt_charge)
+
+
+@admin.register(Charge)
+class ChargeAdmin(LargeTableAdmin):
+    list_display = ['charge_id', 'charge_account', 'charge_amount', 'is_collected', 'cc_record', 'owner',
+                    'charge_value_date']
+    list_select_related = ['owner', 'cc_record']
+    list_filter = ['is_collected']
+    search_fields = ['=charge_id', '=charge_account']
+    date_hierarchy = 'charge_value_date'
+    # a search box instead of a <select> of every unpaid cheque
+    autocomplete_fields = ['cc_record']
+    raw_id_fields = ['owner']
+    actions = ['reattempt_charge']
+
+    @admin.action(description='Re-attempt the charge of the cheques of selected charges')
+    def reattempt_charge(self, request, queryset):
+        queue_for_rows(self, request, queryset.filter(is_collected=False), tasks.attempt_charge, 'cc_record_id')
+
+
+@admin.register(ServiceToken)
+class ServiceTokenAdmin(admin.ModelAdmin):
+    list_display = ['name', 'owner', 'is_active', 'created_at']
+    # tokens are created with `manage.py create_service_token`, the key itself is never stored
+    readonly_fields = ['key_digest']
@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class UnpayChequeConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'unpay_cheque'
+
+    def ready(self):
+        # connect the webhook signal handlers
+        from . import signals
+
+        # preload the SOAP clients and co. (see warmup.py), for gunicorn --preload
+        if settings.WARMUP_ON_START:
+            from . import warmup
+            warmup.run()
@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from rest_framework import authentication, exceptions
+from .caching import TTLCache
+from .models import ServiceToken
+
+
+# token digest -> the owner's fields below. a revoked or deactivated token keeps working for at most
+# SERVICE_TOKEN_CACHE_TTL seconds
+token_cache = TTLCache(ttl=settings.SERVICE_TOKEN_CACHE_TTL)
+
+# the fields of the token owner kept in the cache: what the views, permissions and throttles read
+CACHED_USER_FIELDS = ('id', 'username', 'is_active', 'is_staff', 'is_superuser')
+
+
+class ServiceTokenAuthentication(authentication.BaseAuthentication):
+    """
+    Authenticates service clients sending `Authorization: Token <key>`.
+    The token and its owner are looked up in one query and the owner's pk and flags are then cached
+    in-process, so a client calling repeatedly costs no database hit for authentication. Every request
+    gets its own User built from the cached fields, no instance is shared between threads.
+    """
+    keyword = 'Token'
+
+    def authenticate(self, request):
+        auth = authentication.get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+
+        try:
+            key = auth[1].decode()
+        except UnicodeError:
+            raise exceptions.AuthenticationFailed('Invalid token header.')
+
+        return self.authenticate_credentials(key)
+
+    def authenticate_credentials(self, key):
+        digest = ServiceToken.digest(key)
+        fields = token_cache.get(digest)
+        if fields is None:
+            try:
+                token = ServiceToken.objects.select_related('owner').get(key_digest=digest, is_active=True)
+            except ServiceToken.DoesNotExist:
+                raise exceptions.AuthenticationFailed('Invalid token.')
+            user = token.owner
+            if not user.is_active:
+                raise exceptions.AuthenticationFailed('User inactive or deleted.')
+            fields = {name: getattr(user, name) for name in CACHED_USER_FIELDS}
+            token_cache.set(digest, fields)
+        return (User(**fields), None)
+
+    def authenticate_header(self, request):
+        return self.keyword
@@ -0,0 +1,177 @@
+# write-behind micro-batching of the rows created by concurrent requests
+import os
+import queue
+import threading
+import time
+
+from collections import defaultdict
+from concurrent.futures import Future
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from .helpers import Helpers, current_date
+
+
+helper = Helpers()
+
+# queued by stop(), the batcher thread writes what it has and exits
+STOP = object()
+
+
+def bulk_persist(model, instances):
+    """
+    inserts instances of one model with a single bulk_create. bulk_create does not send post_save,
+    so it is sent here for every row (the webhook outbox listens to it). Call it inside a transaction
+    so that the rows and whatever the receivers write commit together.
+    """
+    if connection.features.can_return_rows_from_bulk_insert:
+        model.objects.bulk_create(instances)
+        for instance in instances:
+            post_save.send(sender=model, instance=instance, created=True, update_fields=None, raw=False,
+                           using=connection.alias)
+    else:
+        # without RETURNING the new primary keys would be lost, save one by one in the caller's transaction
+        for instance in instances:
+            instance.save()
+
+
+class WriteBehindBatcher:
+    """
+    Groups the inserts of concurrent requests into one transaction:
+    - submit() queues an unsaved instance and returns a future
+    - a background thread collects up to MAX_BATCH instances, or whatever arrived within MAX_WAIT_MS
+      of the first one, and writes them with bulk_persist in one transaction
+    - the futures are resolved only after the commit, so a caller that waits on its future knows its
+      row is as durable as with save()
+    If a batch fails its rows are retried one by one, so a bad row only fails its own request.
+    The thread keeps its database connection open between batches; it is only closed when a batch fails
+    on a connection that no longer answers, and when the thread is stopped.
+    """
+
+    def __init__(self, max_batch, max_wait):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.commits = 0
+        self.rows = 0
+        self.logger = helper.setup_logger('write_behind', f'logs/{current_date}/write_behind.log')
+
+    def submit(self, instance):
+        self.ensure_thread()
+        future = Future()
+        self.queue.put((instance, future))
+        return future
+
+    def ensure_thread(self):
+        # the thread is started lazily and again in every forked worker, threads do not survive a fork
+        if self.pid == os.getpid() and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                # whatever the parent had queued belongs to the parent
+                self.queue = queue.Queue()
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def stop(self, timeout=None):
+        """
+        writes what is queued and stops the thread, which closes its database connection. Call it before
+        the database goes away (e.g. a test database being destroyed); a later submit() starts a new thread
+        """
+        if self.thread is not None and self.pid == os.getpid() and self.thread.is_alive():
+            self.queue.put((STOP, None))
+            self.thread.join(timeout)
+
+    def run(self):
+        try:
+            stopping = False
+            while not stopping:
+                item = self.queue.get()
+                if item[0] is STOP:
+                    return
+                batch = [item]
+                deadline = time.monotonic() + self.max_wait
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item[0] is STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                try:
+                    self.flush(batch)
+                except Exception as e:
+                    # keep the thread alive, the callers of this batch get the error
+                    self.close_if_unusable()
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+        finally:
+            connection.close()
+
+    def close_if_unusable(self):
+        # the connection may have been dropped by the server while the thread was idle, the next query reconnects
+        if connection.connection is not None and not connection.is_usable():
+            connection.close()
+
+    def flush(self, batch):
+        by_model = defaultdict(list)
+        for instance, _ in batch:
+            by_model[type(instance)].append(instance)
+
+        try:
+            with transaction.atomic():
+                for model, instances in by_model.items():
+                    bulk_persist(model, instances)
+        except Exception as e:
+            self.logger.error(f'batch of {len(batch)} rows failed, saving them one by one: {e}')
+            self.close_if_unusable()
+            for instance, future in batch:
+                self.save_one(instance, future)
+            return
+
+        self.commits += 1
+        self.rows += len(batch)
+        for _, future in batch:
+            future.set_result(None)
+
+    def save_one(self, instance, future):
+        try:
+            # the failed bulk insert may have set primary keys that were rolled back
+            instance.pk = None
+            instance._state.adding = True
+            instance.save()
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(None)
+
+
+batcher = WriteBehindBatcher(
+    max_batch=settings.WRITE_BEHIND['MAX_BATCH'],
+    max_wait=settings.WRITE_BEHIND['MAX_WAIT_MS'] / 1000,
+)
+
+
+def persist(instance):
+    """
+    inserts a new row. With WRITE_BEHIND['ENABLED'] the insert joins the current micro-batch and this
+    returns once the batch has committed, otherwise the instance is simply saved.
+    raises concurrent.futures.TimeoutError if the batch has not committed within WRITE_BEHIND['TIMEOUT']
+    seconds; the row may still be written afterwards
+    """
+    if settings.WRITE_BEHIND['ENABLED']:
+        batcher.submit(instance).result(timeout=settings.WRITE_BEHIND['TIMEOUT'])
+    else:
+        instance.save()
+    return instance
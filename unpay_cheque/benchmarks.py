@@ -0,0 +1,389 @@
+# benchmark scenarios run by `manage.py benchmark <scenario>`
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date
+from pathlib import Path
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment
+from .batching import WriteBehindBatcher
+from .cassettes import Cassette
+from .helpers import Helpers, router
+from .metrics import percentile
+from .models import UnpaidCheque, ServiceToken
+from .transports import replaying
+
+
+@contextmanager
+def test_database():
+    """creates a throwaway test database for the duration of a benchmark so that real data is never touched"""
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def summarize(timings):
+    """returns mean/p50/p99 of a list of durations in seconds, in milliseconds"""
+    return {
+        'mean_ms': statistics.mean(timings) * 1000,
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+    }
+
+
+def create_unpaid_cheque(owner, n=0):
+    unpaid_cheque = new_unpaid_cheque(owner, n)
+    unpaid_cheque.save()
+    return unpaid_cheque
+
+
+def new_unpaid_cheque(owner, n=0):
+    return UnpaidCheque(
+        raw_string=f'09-{n:06d}-01-1000.00-20220201-FT22032BENCH',
+        voucher_code='09',
+        cheque_number=f'{n:06d}',
+        reason_code='01',
+        cheque_amount='1000.00',
+        cheque_value_date=date(2022, 2, 1),
+        ft_ref='FT22032BENCH',
+        owner=owner,
+    )
+
+
+class MiddlewareBenchmark:
+    """
+    Per-request overhead of the API before and after API-only mode, measured on GET /unpaids/<pk>/:
+    - before: the full middleware stack with session authentication
+    - after: the trimmed stack with a cached service token
+    """
+    help = 'per-request overhead of the full middleware stack vs API-only mode'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000, help='requests per configuration')
+
+    def run(self, command, options):
+        with test_database():
+            owner = User.objects.create_user('benchmark', password='benchmark')
+            _, key = ServiceToken.generate(owner, 'benchmark')
+            path = f'/unpaids/{create_unpaid_cheque(owner).pk}/'
+
+            with override_settings(MIDDLEWARE=settings.FULL_MIDDLEWARE):
+                client = Client()
+                client.force_login(owner)
+                before = self.measure(client, path, options['requests'])
+
+            with override_settings(MIDDLEWARE=settings.API_ONLY_MIDDLEWARE):
+                client = Client(HTTP_AUTHORIZATION='Token ' + key)
+                after = self.measure(client, path, options['requests'])
+
+        for label, result in (('full stack + session', before), ('api-only + token', after)):
+            command.stdout.write(f"{label:<22} mean {result['mean_ms']:.3f}ms  p50 {result['p50_ms']:.3f}ms  "
+                                 f"p99 {result['p99_ms']:.3f}ms  queries/request {result['queries']:.2f}")
+
+    def measure(self, client, path, requests):
+        # warm up the handler and the token cache before timing
+        client.get(path)
+        timings = []
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(requests):
+                started = time.perf_counter()
+                response = client.get(path)
+                timings.append(time.perf_counter() - started)
+                assert response.status_code == 200, response.status_code
+        result = summarize(timings)
+        result['queries'] = len(queries) / requests
+        return result
+
+
+class WritesBenchmark:
+    """
+    Inserts from concurrent request threads, one save() per row vs write-behind micro-batches:
+    - commits/s is the number of transactions committed per second of wall time
+    - p99 is the time a thread waits for its own row to be durable; for the batched run the
+      difference to the direct p99 is the latency the batching adds (or removes)
+    Run it against the production database engine, sqlite serializes writers and says little.
+    """
+    help = 'insert throughput and latency of save() vs write-behind micro-batching'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help='concurrent request threads')
+        parser.add_argument('--rows', type=int, default=100, help='rows inserted per thread')
+        parser.add_argument('--max-batch', type=int, default=settings.WRITE_BEHIND['MAX_BATCH'])
+        parser.add_argument('--max-wait-ms', type=float, default=settings.WRITE_BEHIND['MAX_WAIT_MS'])
+
+    def run(self, command, options):
+        with test_database():
+            owner = User.objects.create_user('benchmark', password='benchmark')
+            direct = self.measure(owner, options, lambda instance: instance.save())
+
+            batcher = WriteBehindBatcher(options['max_batch'], options['max_wait_ms'] / 1000)
+            try:
+                batched = self.measure(owner, options, lambda instance: batcher.submit(instance).result())
+            finally:
+                # the batcher thread holds a connection to the test database, which cannot be dropped while it is open
+                batcher.stop()
+            batched['commits'] = batcher.commits
+            batched['commits_per_s'] = batcher.commits / batched['elapsed']
+
+        for label, result in (('save() per row', direct), ('write-behind', batched)):
+            command.stdout.write(f"{label:<15} {result['rows_per_s']:8.0f} rows/s  {result['commits_per_s']:8.0f} commits/s  "
+                                 f"p50 {result['p50_ms']:.2f}ms  p99 {result['p99_ms']:.2f}ms  errors {result['errors']}")
+        command.stdout.write(f"p99 added by write-behind: {batched['p99_ms'] - direct['p99_ms']:+.2f}ms")
+
+    def measure(self, owner, options, insert):
+        timings = []
+        errors = []
+        lock = threading.Lock()
+
+        def worker(offset):
+            mine = []
+            try:
+                for n in range(offset, offset + options['rows']):
+                    started = time.perf_counter()
+                    try:
+                        insert(new_unpaid_cheque(owner, n))
+                    except Exception as e:
+                        errors.append(e)
+                    mine.append(time.perf_counter() - started)
+            finally:
+                connection.close()
+            with lock:
+                timings.extend(mine)
+
+        threads = [threading.Thread(target=worker, args=(i * options['rows'],)) for i in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        rows = options['threads'] * options['rows']
+        result = summarize(timings)
+        result.update(elapsed=elapsed, errors=len(errors), rows_per_s=(rows - len(errors)) / elapsed,
+                      commits_per_s=(rows - len(errors)) / elapsed)
+        return result
+
+
+# run in a fresh interpreter by StartupBenchmark, prints its timings as JSON on the last line of stdout
+STARTUP_PROBE = '''
+import json, os, time
+started = time.perf_counter()
+import django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cheque_unpay.settings')
+django.setup()
+setup = time.perf_counter() - started
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment
+setup_test_environment()
+connection.creation.create_test_db(verbosity=0, autoclobber=True)
+client = Client()
+client.force_login(User.objects.create_user('benchmark', password='benchmark'))
+
+timings = []
+for _ in range(2):
+    started = time.perf_counter()
+    assert client.get('/unpaids/').status_code == 200
+    timings.append(time.perf_counter() - started)
+print(json.dumps({'setup': setup, 'first_request': timings[0], 'second_request': timings[1]}))
+'''
+
+
+class StartupBenchmark:
+    """
+    Cold start of a worker, with and without the warm-up of unpay_cheque/warmup.py, each run in a fresh
+    interpreter started with `python -X importtime`:
+    - setup is the import of django plus django.setup(), which includes the warm-up when it is on
+    - first request is GET /unpaids/ right after startup, second request the same again once warm
+    The test database is created between the two, so the migrate it runs already warms some of the
+    ORM up for both configurations. The WSDLs are only loaded when their URLs are set.
+    """
+    help = 'import time, setup time and first-request latency with and without the warm-up'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=3, help='interpreters started per configuration')
+        parser.add_argument('--top', type=int, default=15, help='slowest top-level imports to show')
+
+    def run(self, command, options):
+        database = settings.DATABASES['default']['NAME']
+        database_existed = os.path.exists(database)
+        try:
+            for warmup in (False, True):
+                runs = [self.probe(warmup) for _ in range(options['runs'])]
+                command.stdout.write(f"warm-up {'on ' if warmup else 'off'}  "
+                                     f"setup {self.median(runs, 'setup'):.1f}ms  "
+                                     f"first request {self.median(runs, 'first_request'):.1f}ms  "
+                                     f"second request {self.median(runs, 'second_request'):.1f}ms  "
+                                     f"imports {self.median(runs, 'imports'):.1f}ms")
+        finally:
+            # the warm-up checks the real database connection, which creates an empty sqlite file
+            if not database_existed and os.path.exists(database):
+                os.remove(database)
+
+        command.stdout.write("slowest top-level imports (cumulative, warm-up on):")
+        for name, microseconds in sorted(runs[-1]['modules'].items(), key=lambda item: -item[1])[:options['top']]:
+            command.stdout.write(f'  {microseconds / 1000:8.1f}ms  {name}')
+
+    def probe(self, warmup):
+        environment = dict(os.environ, WARMUP_ON_START=str(warmup))
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_PROBE],
+                                   cwd=settings.BASE_DIR, env=environment, capture_output=True, text=True)
+        if completed.returncode:
+            raise RuntimeError(completed.stderr[-2000:])
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+
+        # `import time: self [us] | cumulative | imported package`, nested imports are indented
+        modules = {}
+        for line in completed.stderr.splitlines():
+            if not line.startswith('import time:') or 'imported package' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if not name.startswith('  '):
+                modules[name.strip()] = int(cumulative)
+        result['modules'] = modules
+        result['imports'] = sum(modules.values()) / 1000
+        return result
+
+    def median(self, runs, key):
+        values = [run[key] for run in runs]
+        # the probe reports seconds, the import times are already milliseconds
+        return statistics.median(values) * (1 if key == 'imports' else 1000)
+
+
+class ReplayBenchmark:
+    """
+    Replays cassettes recorded with T24_RECORD_DIR (see cassettes.py) through the helpers, with T24 answered
+    by ReplayTransports serving the recorded responses:
+    - every recorded unpay request goes through process_unpay_request, every charge request through
+      create_charge_soap_request, on `concurrency` threads
+    - with --speed N the requests arrive at the recorded times compressed N times (a day at --speed 240
+      takes 6 minutes), with --speed 0 they are sent as fast as the threads take them
+    - latency is measured from when a request was due to when it finished, so queueing is included
+    With --baseline the results are compared to a stored run and a drop in throughput, or a rise in p99 or
+    errors, of more than --tolerance percent fails the command. Compare runs with the same options;
+    throughput is only meaningful at --speed 0, paced runs get the throughput of their arrivals.
+    The API and database layers are not replayed, the middleware and writes scenarios cover those.
+    """
+    help = 'replays recorded T24 traffic through the helpers and compares it to a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('cassettes', nargs='+', help='cassette files or directories of them')
+        parser.add_argument('--latency-scale', type=float, default=1.0,
+                            help='multiplier of the recorded T24 latencies, 0 answers at once')
+        parser.add_argument('--speed', type=float, default=0,
+                            help='compression of the recorded arrival times, 0 sends as fast as possible')
+        parser.add_argument('--concurrency', type=int, default=16, help='requests handled at a time')
+        parser.add_argument('--limit', type=int, help='replay only the first LIMIT requests')
+        parser.add_argument('--baseline', type=Path, help='JSON results of an earlier run to compare with')
+        parser.add_argument('--save-baseline', action='store_true', help='write the results to --baseline')
+        parser.add_argument('--tolerance', type=float, default=10, help='percent change flagged as a regression')
+
+    def run(self, command, options):
+        cassette = Cassette(options['cassettes'])
+        requests = cassette.requests[:options['limit']]
+        if not requests:
+            raise CommandError('the cassettes contain no recorded requests')
+
+        # don't record the replay into a cassette of its own
+        with override_settings(T24_TRAFFIC={**settings.T24_TRAFFIC, 'RECORD_DIR': None}), \
+                replaying(router, cassette, options['latency_scale']):
+            results = self.replay(Helpers(), requests, options)
+
+        for kind, result in results.items():
+            command.stdout.write(f"{kind:<7} {result['requests']:6d} requests  {result['throughput_per_s']:8.1f}/s  "
+                                 f"p50 {result['p50_ms']:.1f}ms  p99 {result['p99_ms']:.1f}ms  errors {result['errors']}")
+
+        if options['baseline'] and options['save_baseline']:
+            options['baseline'].write_text(json.dumps({'options': self.replay_options(options), 'results': results},
+                                                      indent=2))
+            command.stdout.write(f"baseline written to {options['baseline']}")
+        elif options['baseline']:
+            self.compare(command, json.loads(options['baseline'].read_text()), results, options)
+
+    def replay(self, helper, requests, options):
+        timings = {}
+        errors = {}
+        lock = threading.Lock()
+
+        def handle(entry, due):
+            try:
+                if entry['kind'] == 'unpay':
+                    result = helper.process_unpay_request(helper.parse_raw_string(entry['data']['raw_string']))
+                else:
+                    result = helper.create_charge_soap_request(entry['data']['charge_account'])
+                failed = 'error' in result
+            except Exception:
+                failed = True
+            elapsed = time.perf_counter() - due
+            with lock:
+                timings.setdefault(entry['kind'], []).append(elapsed)
+                errors[entry['kind']] = errors.get(entry['kind'], 0) + failed
+
+        first = requests[0]['at']
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            for entry in requests:
+                due = started + (entry['at'] - first) / options['speed'] if options['speed'] else time.perf_counter()
+                if due > time.perf_counter():
+                    time.sleep(due - time.perf_counter())
+                pool.submit(handle, entry, due)
+        elapsed = time.perf_counter() - started
+
+        results = {}
+        for kind in sorted(timings):
+            results[kind] = summarize(timings[kind])
+            results[kind].update(requests=len(timings[kind]), errors=errors[kind],
+                                 throughput_per_s=len(timings[kind]) / elapsed)
+        return results
+
+    def replay_options(self, options):
+        return {key: options[key] for key in ('latency_scale', 'speed', 'concurrency', 'limit')}
+
+    def compare(self, command, baseline, results, options):
+        if baseline['options'] != self.replay_options(options):
+            command.stderr.write(f"the baseline was run with {baseline['options']}, the numbers may not compare")
+
+        tolerance = options['tolerance'] / 100
+        regressions = []
+        for kind, result in results.items():
+            before = baseline['results'].get(kind)
+            if before is None:
+                continue
+            if result['throughput_per_s'] < before['throughput_per_s'] * (1 - tolerance):
+                regressions.append(f"{kind} throughput {before['throughput_per_s']:.1f}/s -> "
+                                   f"{result['throughput_per_s']:.1f}/s")
+            if result['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+                regressions.append(f"{kind} p99 {before['p99_ms']:.1f}ms -> {result['p99_ms']:.1f}ms")
+            if result['errors'] > before['errors'] * (1 + tolerance):
+                regressions.append(f"{kind} errors {before['errors']} -> {result['errors']}")
+
+        if regressions:
+            raise CommandError('regressions against the baseline: ' + '; '.join(regressions))
+        command.stdout.write(f"no regressions against the baseline (tolerance {options['tolerance']:g}%)")
+
+
+SCENARIOS = {
+    'middleware': MiddlewareBenchmark(),
+    'writes': WritesBenchmark(),
+    'startup': StartupBenchmark(),
+    'replay': ReplayBenchmark(),
+}
@@ -0,0 +1,195 @@
+# recording of T24 traffic to cassettes, and reading them back for `manage.py benchmark replay`
+import atexit
+import gzip
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+from datetime import datetime
+from pathlib import Path
+from django.conf import settings
+
+
+def mask(value):
+    """
+    replaces every digit of value with one taken from a keyed hash of the whole value, so that the same
+    account or reference masks to the same string everywhere while keeping its length and format
+    """
+    if not value:
+        return value
+    digest = hmac.new(settings.SECRET_KEY.encode(), value.encode(), hashlib.sha256).hexdigest()
+    digits = itertools.cycle(str(int(digest, 16)))
+    return ''.join(next(digits) if char.isdigit() else char for char in value)
+
+
+def element_pattern(names):
+    """matches <name ...>text</ of any of the given element names, with or without a namespace prefix"""
+    return re.compile(r'(<(?:[\w.-]+:)?(?:%s)(?:\s[^>]*)?>)([^<]*)(</)' % '|'.join(map(re.escape, names)))
+
+
+def redact_xml(text):
+    """blanks out the secret elements of a SOAP message and masks the digits of the masked ones"""
+    config = settings.T24_TRAFFIC
+    if config['SECRET_ELEMENTS']:
+        text = element_pattern(config['SECRET_ELEMENTS']).sub(r'\1***\3', text)
+    if config['MASK_ELEMENTS']:
+        text = element_pattern(config['MASK_ELEMENTS']).sub(
+            lambda match: match.group(1) + mask(match.group(2)) + match.group(3), text)
+    return text
+
+
+def mask_raw_string(raw_string):
+    """masks the cheque number and FT reference of a raw unpay request, leaving it parseable"""
+    parts = raw_string.split('-')
+    if len(parts) == 6:
+        parts[1] = mask(parts[1])
+        parts[5] = mask(parts[5])
+    return '-'.join(parts)
+
+
+class Recorder:
+    """
+    Appends T24 traffic to a gzip-compressed JSON lines cassette, one file per process under
+    <RECORD_DIR>/<date>/. Entries are:
+    - wsdls: the default WSDL of every service, written first
+    - request: an unpay or charge request as it entered the helpers, with the time it arrived
+    - document: a WSDL or schema loaded by a zeep client
+    - call: a redacted SOAP request/response pair of one operation and how long T24 took to answer
+    Each entry is flushed as it is written; a cassette cut off by a crash is readable up to its last entry.
+    Recording never fails the call it records, errors are logged.
+    """
+
+    def __init__(self):
+        self.file = None
+        self.pid = None
+        self.documents = set()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return settings.T24_TRAFFIC['RECORD_DIR'] is not None
+
+    def open(self):
+        directory = Path(settings.T24_TRAFFIC['RECORD_DIR']) / datetime.now().strftime('%Y-%m-%d')
+        directory.mkdir(parents=True, exist_ok=True)
+        self.file = gzip.open(directory / f'{socket.gethostname()}-{os.getpid()}.jsonl.gz', 'at', encoding='utf-8')
+        self.pid = os.getpid()
+        self.documents = set()
+        atexit.register(self.close)
+
+        # imported here, the helpers import the recorder
+        from .helpers import router
+        entry = {'type': 'wsdls', 'wsdls': router.default_wsdls, 'at': time.time()}
+        self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def close(self):
+        with self._lock:
+            if self.file is not None and self.pid == os.getpid():
+                self.file.close()
+            self.file = None
+
+    def write(self, entry, redacted=()):
+        """appends entry, the SOAP messages under its `redacted` keys are redacted here so that a failure is logged too"""
+        if not self.enabled:
+            return
+        entry['at'] = time.time()
+        try:
+            for key in redacted:
+                entry[key] = redact_xml(entry[key])
+            line = json.dumps(entry, separators=(',', ':'))
+            with self._lock:
+                # a forked worker opens a cassette of its own instead of writing into its parent's
+                if self.file is None or self.pid != os.getpid():
+                    self.open()
+                self.file.write(line + '\n')
+                self.file.flush()
+        except Exception as e:
+            # imported here, the helpers import the recorder
+            from .helpers import Helpers, current_date
+            logger = Helpers().setup_logger('t24_traffic', f'logs/{current_date}/t24_traffic.log')
+            logger.error(f'recording T24 traffic: {e}')
+
+    def record_request(self, kind, data):
+        """records an unpay ('raw_string') or charge ('charge_account') request, masked"""
+        if not self.enabled:
+            return
+        if kind == 'unpay':
+            data = {'raw_string': mask_raw_string(data['raw_string'])}
+        else:
+            data = {'charge_account': mask(data['charge_account'])}
+        self.write({'type': 'request', 'kind': kind, 'data': data})
+
+    def record_document(self, service, url, content):
+        if url in self.documents:
+            return
+        self.documents.add(url)
+        self.write({'type': 'document', 'service': service, 'url': url, 'content': content.decode('utf-8')})
+
+    def record_call(self, service, address, action, request, status, content_type, response, elapsed):
+        self.write({'type': 'call', 'service': service, 'address': address, 'action': action,
+                    'request': request, 'status': status, 'content_type': content_type,
+                    'response': response, 'elapsed': elapsed}, redacted=('request', 'response'))
+
+
+recorder = Recorder()
+
+
+class Cassette:
+    """
+    The entries of one or more cassette files (or directories of them), for replay:
+    - requests: the recorded requests ordered by arrival
+    - documents: {url: content}, wsdls: {service: WSDL url}
+    - calls: {SOAPAction: [recorded calls]}, served round robin by next_call()
+    """
+
+    def __init__(self, paths):
+        self.requests = []
+        self.documents = {}
+        self.wsdls = {}
+        self.calls = {}
+        self.cycles = {}
+        self._lock = threading.Lock()
+        for path in self.files(paths):
+            for entry in self.read(path):
+                if entry['type'] == 'request':
+                    self.requests.append(entry)
+                elif entry['type'] == 'wsdls':
+                    for service, url in entry['wsdls'].items():
+                        self.wsdls.setdefault(service, url)
+                elif entry['type'] == 'document':
+                    self.documents[entry['url']] = entry['content'].encode('utf-8')
+                elif entry['type'] == 'call':
+                    self.calls.setdefault(entry['action'], []).append(entry)
+        self.requests.sort(key=lambda entry: entry['at'])
+
+    def next_call(self, action):
+        """returns the next recorded call of a SOAPAction"""
+        with self._lock:
+            if action not in self.cycles:
+                if not self.calls.get(action):
+                    raise ValueError(f'no call with SOAPAction {action} was recorded')
+                self.cycles[action] = itertools.cycle(self.calls[action])
+            return next(self.cycles[action])
+
+    def files(self, paths):
+        for path in map(Path, paths):
+            if path.is_dir():
+                yield from sorted(path.rglob('*.jsonl.gz'))
+            else:
+                yield path
+
+    def read(self, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            try:
+                for line in file:
+                    if line.endswith('\n'):
+                        yield json.loads(line)
+            except EOFError:
+                # the process that wrote the cassette did not close it, everything flushed before is there
+                pass
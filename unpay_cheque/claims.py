@@ -0,0 +1,69 @@
+# claims that keep the paths charging unpaid cheques (collection sweep, admin actions, charges API) apart
+import socket
+import uuid
+
+from datetime import timedelta
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from .models import UnpaidCheque, Charge
+
+
+# prefix of the claims of cheques charged in T24 whose charge could not be stored. they never expire, an
+# operator records the charge and then clears charge_claimed_by in the admin
+HELD = 'held:'
+
+
+def outstanding_unpaid_cheques():
+    """
+    unpaid cheques with an account to charge and no collected charge, as a single NOT EXISTS anti-join
+    on the (cc_record, is_collected) index of Charge
+    """
+    collected = Charge.objects.filter(cc_record=OuterRef('pk'), is_collected=True)
+    return (UnpaidCheque.objects
+            .filter(is_unpaid=True, cheque_account__isnull=False)
+            .exclude(cheque_account='')
+            .filter(~Exists(collected)))
+
+
+def new_claimer(kind):
+    """returns a unique value for charge_claimed_by, e.g. sweep-<host>-<id> or admin-<host>-<id>"""
+    return f'{kind}-{socket.gethostname()}-{uuid.uuid4().hex[:12]}'
+
+
+def claim_unpaid_cheques(pks, claimed_by, claim_ttl):
+    """
+    Claims the cheques in pks for claimed_by with one conditional UPDATE and returns the claimed ones.
+    Every path that charges a cheque (the sweep, the admin actions and the charges API) claims it first,
+    so each cheque is charged by one of them at a time. The UPDATE itself checks that the cheque is
+    still outstanding (no collected charge, NOT EXISTS) and that nobody holds a claim on it younger
+    than claim_ttl; concurrent claims of the same row wait on its lock and then re-check.
+    """
+    now = timezone.now()
+    unclaimed = Q(charge_claimed_at__isnull=True) | Q(charge_claimed_at__lt=now - timedelta(seconds=claim_ttl))
+    (outstanding_unpaid_cheques()
+        .filter(pk__in=list(pks))
+        .filter(unclaimed)
+        .exclude(charge_claimed_by__startswith=HELD)
+        .update(charge_claimed_by=claimed_by, charge_claimed_at=now))
+    return list(UnpaidCheque.objects.filter(pk__in=list(pks), charge_claimed_by=claimed_by, charge_claimed_at=now))
+
+
+def release_claim(unpaid_cheque, claimed_by):
+    """drops claimed_by's claim on a cheque, e.g. after T24 answered that the charge was not collected"""
+    UnpaidCheque.objects.filter(pk=unpaid_cheque.pk, charge_claimed_by=claimed_by).update(
+        charge_claimed_by=None, charge_claimed_at=None)
+
+
+def hold_claims(charges, logger):
+    """
+    keeps the cheques of charges made in T24 but not stored claimed for good, so that no later run charges
+    them again, and logs the T24 charge ids
+    """
+    for charge in charges:
+        logger.error(f'charge {charge.charge_id} (ofs {charge.ofs_id}) was made in T24 for unpaid cheque '
+                     f'{charge.cc_record_id} but could not be stored; record it, then clear charge_claimed_by')
+    try:
+        UnpaidCheque.objects.filter(pk__in=[charge.cc_record_id for charge in charges]).update(
+            charge_claimed_by=HELD + uuid.uuid4().hex[:12])
+    except Exception as e:
+        logger.error(f'holding the claims of unpaid cheques {[charge.cc_record_id for charge in charges]}: {e}')
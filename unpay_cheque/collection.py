@@ -0,0 +1,135 @@
+# scheduled collection of the charges of unpaid cheques that nobody asked to charge, or whose charge failed
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .batching import bulk_persist
+from .claims import HELD, claim_unpaid_cheques, hold_claims, new_claimer, outstanding_unpaid_cheques
+from .helpers import Helpers, current_date
+from .models import Charge
+from .tasks import build_charge
+
+
+helper = Helpers()
+
+
+class Pacer:
+    """spaces calls made from several threads at least 1 / rate seconds apart"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            call_at = max(self.next_call, now)
+            self.next_call = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+class ChargeCollectionRun:
+    """
+    One run of the collection:
+    - claim up to batch_size outstanding cheques by stamping them with the run id. The claim is a conditional
+      UPDATE, so when several nodes run at once each row goes to exactly one of them
+    - charge the claimed cheques on a pool of `concurrency` threads, at most `rate` calls per second
+    - write the charges of the batch with one bulk insert in one transaction
+    - repeat until max_per_run cheques were attempted or nothing is left
+    Claims are not released: a collected cheque drops out of the anti-join and a cheque whose charge failed
+    stays claimed, and is skipped, until its claim is older than claim_ttl. A node that dies mid-run leaves
+    its claims to expire the same way. A charge made in T24 by a node that dies before writing its batch is
+    not recorded, keep batch_size small where that matters. If the batch insert fails the charges are
+    saved one by one; cheques whose charge still cannot be stored are held (see hold_claims).
+    """
+
+    def __init__(self, max_per_run, rate, concurrency, batch_size, claim_ttl):
+        self.max_per_run = max_per_run
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.claim_ttl = claim_ttl
+        self.pacer = Pacer(rate)
+        self.run_id = new_claimer('sweep')
+        self.logger = helper.setup_logger('charge_collection', f'logs/{current_date}/charge_collection.log')
+        self.summary = {'run_id': self.run_id, 'claimed': 0, 'collected': 0, 'not_collected': 0, 'errors': 0,
+                        'unrecorded': 0}
+
+    def claim(self, limit):
+        """claims up to limit outstanding cheques for this run and returns them"""
+        now = timezone.now()
+        unclaimed = Q(charge_claimed_at__isnull=True) | Q(charge_claimed_at__lt=now - timedelta(seconds=self.claim_ttl))
+        # a cheque this run already attempted is not tried twice, however short claim_ttl is
+        candidates = list(outstanding_unpaid_cheques().filter(unclaimed).exclude(charge_claimed_by=self.run_id)
+                          .exclude(charge_claimed_by__startswith=HELD).order_by('logged_at').values_list('pk', flat=True)[:limit])
+        if not candidates:
+            return []
+        # rows another claimer took in between are left alone by the conditional UPDATE
+        return claim_unpaid_cheques(candidates, self.run_id, self.claim_ttl)
+
+    def charge(self, unpaid_cheque):
+        """calls T24 for one cheque, paced. runs on a pool thread"""
+        try:
+            self.pacer.wait()
+            return build_charge(unpaid_cheque)
+        except Exception as e:
+            self.logger.error(f'charging unpaid cheque {unpaid_cheque.pk}: {e}')
+            return e
+        finally:
+            connection.close()
+
+    def store(self, charges):
+        """writes the charges of a batch in one insert, or one by one if the batch insert fails"""
+        try:
+            with transaction.atomic():
+                bulk_persist(Charge, charges)
+            return
+        except Exception as e:
+            self.logger.error(f'storing a batch of {len(charges)} charges failed, saving them one by one: {e}')
+
+        unrecorded = []
+        for charge in charges:
+            try:
+                # the failed bulk insert may have set primary keys that were rolled back
+                charge.pk = None
+                charge._state.adding = True
+                with transaction.atomic():
+                    charge.save()
+            except Exception as e:
+                self.logger.error(f'storing charge {charge.charge_id}: {e}')
+                unrecorded.append(charge)
+        if unrecorded:
+            self.summary['unrecorded'] += len(unrecorded)
+            hold_claims(unrecorded, self.logger)
+
+    def run(self):
+        """runs the collection and returns the summary"""
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while self.summary['claimed'] < self.max_per_run:
+                batch = self.claim(min(self.batch_size, self.max_per_run - self.summary['claimed']))
+                if not batch:
+                    break
+                self.summary['claimed'] += len(batch)
+
+                charges = []
+                for result in pool.map(self.charge, batch):
+                    if isinstance(result, Charge):
+                        charges.append(result)
+                        self.summary['collected' if result.is_collected else 'not_collected'] += 1
+                    else:
+                        # None is a failed web service call, already logged by the helper
+                        self.summary['errors'] += 1
+
+                if charges:
+                    self.store(charges)
+
+        self.summary['elapsed_seconds'] = round(time.monotonic() - started, 1)
+        self.summary['limit_reached'] = self.summary['claimed'] >= self.max_per_run
+        self.logger.info(f'charge collection run: {self.summary}')
+        return self.summary
@@ -0,0 +1,115 @@
+# readiness checks for the load balancer, run in the background so that probes only read their outcome
+import os
+import threading
+import time
+
+import requests
+
+from django.conf import settings
+from django.db import connection
+from .helpers import Helpers, current_date, router, tws_co_code, wsdls
+
+
+helper = Helpers()
+
+
+class HealthChecker:
+    """
+    Keeps the outcome of the readiness checks, refreshed every `interval` seconds by a background thread:
+    - database: a connection is opened and SELECT 1 runs on it, so a database that refuses new
+      connections makes the node unready
+    - t24: every configured WSDL URL answers a GET within `timeout` seconds. Only the WSDL is fetched,
+      no SOAP call is made
+    The thread starts with the first probe, and again in every forked worker. An outcome older than
+    stale_after seconds counts as failed, so a stuck checker makes the node unready too.
+    """
+
+    def __init__(self, interval, timeout, stale_after):
+        self.interval = interval
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.checks = None
+        self.checked_at = None
+        self.thread = None
+        self.pid = None
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.logger = helper.setup_logger('health', f'logs/{current_date}/health.log')
+
+    def ensure_thread(self):
+        # same as the write-behind batcher, threads do not survive a fork
+        if self.pid == os.getpid() and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.checks = None
+                self.session = requests.Session()
+                self.thread = threading.Thread(target=self.run, name='health-checker', daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                self.logger.error(f'health checks: {e}')
+            time.sleep(self.interval)
+
+    def refresh(self):
+        checks = {'database': self.check_database(), 't24': self.check_t24()}
+        for name, check in checks.items():
+            if not check['ok']:
+                self.logger.warning(f'{name} not ready: {check}')
+        with self.lock:
+            self.checks = checks
+            self.checked_at = time.time()
+
+    def check_database(self):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return {'ok': True}
+        except Exception as e:
+            return {'ok': False, 'error': str(e)}
+        finally:
+            connection.close()
+
+    def check_t24(self):
+        """fetches every distinct WSDL of the default company and the companies in T24_COMPANIES"""
+        targets = {}
+        for company in {tws_co_code, *settings.T24_COMPANIES}:
+            for service in wsdls:
+                wsdl = router.wsdl(service, company)
+                if wsdl:
+                    targets.setdefault(wsdl, []).append(f'{service}@{company}')
+
+        unreachable = []
+        for wsdl, names in targets.items():
+            try:
+                response = self.session.get(wsdl, timeout=self.timeout)
+                response.raise_for_status()
+            except Exception:
+                # the URL itself is not reported, it may carry credentials
+                unreachable.extend(names)
+        return {'ok': not unreachable, 'wsdls': len(targets), 'unreachable': sorted(unreachable)}
+
+    def status(self):
+        """returns (ready, details) from the last refresh"""
+        self.ensure_thread()
+        with self.lock:
+            checks, checked_at = self.checks, self.checked_at
+        if checks is None:
+            return False, {'status': 'starting'}
+
+        age = time.time() - checked_at
+        ready = age <= self.stale_after and all(check['ok'] for check in checks.values())
+        return ready, {'status': 'ready' if ready else 'not ready', 'checked_seconds_ago': round(age, 1),
+                       'checks': checks}
+
+
+checker = HealthChecker(
+    interval=settings.HEALTH['INTERVAL'],
+    timeout=settings.HEALTH['TIMEOUT'],
+    stale_after=settings.HEALTH['STALE_AFTER'],
+)
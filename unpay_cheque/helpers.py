@@ -3,21 +3,18 @@ import os
 import logging
 
 from datetime import datetime
-from zeep import Client
-from dotenv import load_dotenv
-from pathlib import Path
+from cheque_unpay.env import env
+from .cassettes import recorder
 from .models import Charge
+from .t24 import T24Router, CompanyBusy
 
-# define environment variables
-load_dotenv()
-dotenv_path = Path('test.env')
-
-tws_user = os.getenv('TWS_USER')
-tws_password = os.getenv('TWS_PWD')
-tws_co_code = os.getenv('TWS_CO')
-test_unpay_cheque_ws = os.getenv('TEST_UNPAY_CHEQUE_URL')
-test_query_cc_ws = os.getenv('TEST_QUERY_CC_URL')
-test_unpaid_charge_ws = os.getenv('TEST_CHARGE_UNPAID_URL')
+# define environment variables, loaded once in cheque_unpay/env.py
+tws_user = env.tws_user
+tws_password = env.tws_password
+tws_co_code = env.tws_co_code
+test_unpay_cheque_ws = env.unpay_cheque_wsdl
+test_query_cc_ws = env.query_cc_wsdl
+test_unpaid_charge_ws = env.unpaid_charge_wsdl
 
 # define the current date
 current_date = datetime.now().strftime('%Y-%m-%d')
@@ -29,6 +26,9 @@ wsdls = {
     'unpaid_charge': test_unpaid_charge_ws
 }
 
+# routes every T24 call to the credentials, endpoint and pool of the company it is made for
+router = T24Router(default_credentials={'userName': tws_user, 'password': tws_password}, default_wsdls=wsdls)
+
 class Helpers:
     # helper method to create a log file
     def setup_logger(self, name, log_file, level=logging.INFO):
@@ -51,14 +51,17 @@ class Helpers:
         if not os.path.exists(log_dir):
             os.makedirs(log_dir)
 
-        # create handlers
-        handler = logging.FileHandler(log_file)        
-        handler.setFormatter(formatter)
-
         # create logger
         logger = logging.getLogger(name)
         logger.setLevel(level)
-        logger.addHandler(handler)
+
+        # create handlers, unless the logger already writes to this file. the helpers ask for their logger
+        # on every call and long-running workers would otherwise pile up one handler per call
+        log_path = os.path.abspath(log_file)
+        if not any(isinstance(h, logging.FileHandler) and h.baseFilename == log_path for h in logger.handlers):
+            handler = logging.FileHandler(log_file)
+            handler.setFormatter(formatter)
+            logger.addHandler(handler)
 
         # return the logger
         return logger
@@ -72,6 +75,24 @@ class Helpers:
         - return the dictionary
         """
         request_string = request.data['raw_string']
+        request_dict = self.parse_raw_string(request_string)
+
+        # log the raw incoming request as well as the formatted request to incoming log file at INFO level
+        logger = self.setup_logger('incoming', f'logs/{current_date}/incoming_requests.log')
+        logger.info('raw request: ' + request_string)
+        logger.info('formatted request: ' + str(request_dict))
+
+        return request_dict
+
+
+    # helper method to break down a raw string (e.g. 09-123456-01-1000.00-20220201-FT22032XXXXX) to a dictionary
+    def parse_raw_string(self, request_string):
+        """
+        - split the string on '-'
+        - convert the cheque value date from YYYYMMDD to YYYY-MM-DD
+        - return the dictionary
+        raises IndexError or ValueError if the string does not have the expected shape
+        """
         request_string_list = request_string.split('-')
         voucher_code = request_string_list[0]
         cheque_number = request_string_list[1]
@@ -81,7 +102,7 @@ class Helpers:
         ft_ref = request_string_list[5]
 
         # create dictionary
-        request_dict = {
+        return {
             'raw_string': request_string,
             'voucher_code': voucher_code,
             'cheque_number': cheque_number,
@@ -91,13 +112,6 @@ class Helpers:
             'ft_ref': ft_ref
         }
 
-        # log the raw incoming request as well as the formatted request to incoming log file at INFO level
-        logger = self.setup_logger('incoming', f'logs/{current_date}/incoming_requests.log')
-        logger.info('raw request: ' + request_string)
-        logger.info('formatted request: ' + str(request_dict))
-
-        return request_dict
-
 
     # helper method to validate the input
     def validate_input(self, request_dict):
@@ -163,15 +177,13 @@ class Helpers:
         - return the response from the web service
         """
         logger = self.setup_logger('query_CC', f'logs/{current_date}/t24_cc_query_info.log')
+        # the company of the CC record is not known yet, the query is made in the default company
+        company = tws_co_code
         # create a client object
-        client = Client(wsdls['query_cc'])
+        client = router.client('query_cc', company)
         # create a dictionary to hold the request parameters
         request_parameters = {
-            'WebRequestCommon': {
-                'company': tws_co_code,  # env variable
-                'password': tws_password, # env variable
-                'userName': tws_user, # env variable
-            },
+            'WebRequestCommon': router.credentials(company),  # env variables, or the company's own
             'CBLCHQCOLType': {
                 'enquiryInputCollection': {
                     'columnName': 'TXN.ID',
@@ -182,7 +194,7 @@ class Helpers:
         }
         # call the web service in a try block
         try:
-            response = client.service.GetCCWebService(**request_parameters)
+            response = router.call(client, 'query_cc', company, 'GetCCWebService', request_parameters)
             
             # log and return the response
             if response['CBLCHQCOLType'][0]['ZERORECORDS']:
@@ -195,6 +207,10 @@ class Helpers:
                         ', FT ref - ' + response['CBLCHQCOLType'][0]['gCBLCHQCOLDetailType']['mCBLCHQCOLDetailType'][0]['TXNID'] + 
                         ', account number - ' + response['CBLCHQCOLType'][0]['gCBLCHQCOLDetailType']['mCBLCHQCOLDetailType'][0]['CREDITACCNO'])
             return response
+        except CompanyBusy as e:
+            # the company's pool is saturated, fail fast instead of queueing behind it
+            logger.warning(e)
+            return {'error': f'T24 is busy for company {company}, try again later'}
         except Exception as e:
             # log the T24 error if any else log the error
             if response['Status']['messages']:
@@ -218,16 +234,16 @@ class Helpers:
         # create a logger object
         logger = self.setup_logger('unpay_cheque', f'logs/{current_date}/t24_unpay_info.log')
 
+        # the unpay has to be done in the company that holds the CC record
+        company = self.cc_company(response)
+
         # create a client object
-        client = Client(wsdls['unpay_cheque'])
+        client = router.client('unpay_cheque', company)
 
         # create a dictionary to hold the request parameters
         request_parameters = {
-            'WebRequestCommon': {
-                'company': response['CBLCHQCOLType'][0]['gCBLCHQCOLDetailType']['mCBLCHQCOLDetailType'][0]['COCODE'],
-                'password': tws_password,  # env variable
-                'userName': tws_user, # env variable
-            },
+            'WebRequestCommon': router.credentials(company),  # env variables, or the company's own
+
             'OfsFunction': {
                 'gtsControl': 0
             },
@@ -241,7 +257,7 @@ class Helpers:
 
         # call the web service in a try block
         try:
-            response = client.service.UnpayChequeWebService(**request_parameters)
+            response = router.call(client, 'unpay_cheque', company, 'UnpayChequeWebService', request_parameters)
             # log the response
             logger.info('successIndicator - ' + response['Status']['successIndicator'] +
                         ', cc_id - ' + response['Status']['transactionId'] +
@@ -250,6 +266,10 @@ class Helpers:
                         ', cheque_status - ' + response['CHEQUECOLLECTIONType']['CHQSTATUS'])
             # return the response
             return response
+        except CompanyBusy as e:
+            # the company's pool is saturated, fail fast instead of queueing behind it
+            logger.warning(e)
+            return {'error': f'T24 is busy for company {company}, try again later'}
         except Exception as e:
             # log the T24 error (if any) else log the error
             if response['Status']['messages']:
@@ -260,6 +280,11 @@ class Helpers:
             return {'error': 'error calling T24 unpay web service'}
 
 
+    # helper method to read the company of the CC record from the response of the query_cc web service
+    def cc_company(self, response):
+        return response['CBLCHQCOLType'][0]['gCBLCHQCOLDetailType']['mCBLCHQCOLDetailType'][0]['COCODE']
+
+
     # helper method to evaluate the response from the SOAP request.
     def evaluate_soap_response(self, request_dict, response):
         """
@@ -311,6 +336,41 @@ class Helpers:
         return request_dict
 
 
+    # helper method to run a parsed request through the whole unpay flow
+    def process_unpay_request(self, request_dict):
+        """
+        Given the dictionary from parse_raw_string:
+        - validate the dict values
+        - call the query_cc web service
+        - call the unpay_cheque web service
+        - evaluate the response from the unpay_cheque web service
+        - return the evaluated dictionary, or a dictionary with an 'error' key if any step failed
+        """
+        # record the request for replay when T24 traffic recording is on (see cassettes.py)
+        recorder.record_request('unpay', request_dict)
+
+        # validate the request
+        validated_request_dict = self.validate_input(request_dict)
+        if 'error' in validated_request_dict:
+            return validated_request_dict
+
+        # call the query_cc web service
+        query_response = self.create_query_soap_request(validated_request_dict)
+        if 'error' in query_response:
+            return query_response
+
+        # call the unpay_cheque web service
+        response = self.create_unpay_soap_request(query_response)
+        if 'error' in response:
+            return response
+
+        # keep the company of the CC record, the charge for the cheque is routed to it
+        validated_request_dict['co_code'] = self.cc_company(query_response)
+
+        # evaluate the response from the unpay_cheque web service
+        return self.evaluate_soap_response(validated_request_dict, response)
+
+
     # helper method to validate that charge has not been collected already for inputted cc_record
     def validate_charge_not_collected(self, request):
         """
@@ -330,9 +390,10 @@ class Helpers:
             return None
         
     # helper method to send a charge request to the unpaid_charge web service
-    def create_charge_soap_request(self, request):
+    def create_charge_soap_request(self, charge_account, company=None):
         """
-        this function takes the request object.
+        this function takes the account to charge and the company of the unpaid cheque (COCODE), the default
+        company (TWS_CO_CODE) when it is not known.
         - create a client object for the unpaid_charge web service
         - create a dictionary to hold the request parameters
         - call the web service in a try block
@@ -340,28 +401,31 @@ class Helpers:
         # create a logger object
         logger = self.setup_logger('charge_soap_request', f'logs/{current_date}/t24_charge_info.log')
 
+        # record the request for replay when T24 traffic recording is on (see cassettes.py)
+        recorder.record_request('charge', {'charge_account': charge_account})
+
+        # the charge is made in the company that holds the CC record of the unpaid cheque
+        company = company or tws_co_code
+
         # create a client object
-        client = Client(wsdls['unpaid_charge'])
+        client = router.client('unpaid_charge', company)
 
         # create a dictionary to hold the request parameters
         request_parameters = {
-            'WebRequestCommon': {
-                'company': tws_co_code, # env variable
-                'password': tws_password,  # env variable
-                'userName': tws_user, # env variable
-            },
+            'WebRequestCommon': router.credentials(company),  # env variables, or the company's own
+
             'OfsFunction': {
                 'gtsControl': 0
             },
             'ACCHARGEREQUESTINUNPAIDType': {
-                'DEBITACCOUNT': request.data['charge_account'],
+                'DEBITACCOUNT': charge_account,
                 'CHARGEDETAIL': 'BENONLY', 
             }
         }
 
         # call the web service in a try block
         try:
-            response = client.service.InputUnpaidCharge(**request_parameters)
+            response = router.call(client, 'unpaid_charge', company, 'InputUnpaidCharge', request_parameters)
             # create a response dictionary
             response_dict = {
                 'charge_success_indicator': response['Status']['successIndicator'],
@@ -376,6 +440,10 @@ class Helpers:
             logger.info(response_dict)
             # return a response dictionary that we'll use to create the Charge object
             return response_dict
+        except CompanyBusy as e:
+            # the company's pool is saturated, fail fast instead of queueing behind it
+            logger.warning(e)
+            return {'error': f'T24 is busy for company {company}, try again later'}
         except Exception as e:
             # log the T24 error if any else log the error
             if response['Status']['messages']:
@@ -0,0 +1,297 @@
+# ingestion of the returned-cheque files our clearing partner drops into a local directory
+import json
+import os
+import shutil
+import threading
+import time
+
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from django.db import connection
+from .batching import persist
+from .helpers import Helpers, current_date
+from .models import UnpaidCheque
+
+
+helper = Helpers()
+
+# file names the partner's SFTP client uses while a transfer is still running
+PARTIAL_SUFFIXES = ('.part', '.tmp', '.filepart')
+
+# lines read ahead of the checkpoint, as a multiple of the concurrency
+WINDOW_FACTOR = 16
+
+# outcome of a line that went through the whole flow and was unpaid in T24
+UNPAID = 'unpaid'
+
+# record written before a line is sent to T24, it is not an outcome
+STARTED = 'started'
+
+# outcome of a line whose worker died after sending it to T24 and before recording what T24 answered
+INTERRUPTED = 'interrupted'
+
+
+class Checkpoint:
+    """
+    Progress of one file, kept in the state directory so that a crashed worker resumes where it stopped:
+    - <name>.checkpoint.json holds the byte offset up to which every line has an outcome
+    - <name>.outcomes.jsonl gets a 'started' record before a line is sent to T24 and one outcome per line
+      as soon as the line is done, so lines that finished after the checkpointed offset (lines run
+      concurrently) are not sent to T24 again
+    Only the offsets past the checkpoint are kept in memory; the summary is read back from the outcomes file.
+    A line that was in flight when the worker died is processed again if it had not reached T24 yet.
+    If it had, it is not sent again, it may have been unpaid already: it gets the 'interrupted' outcome
+    and the file ends up in failed/ for someone to check in T24.
+    """
+
+    def __init__(self, state_dir, path):
+        name = os.path.basename(path)
+        self.checkpoint_path = os.path.join(state_dir, name + '.checkpoint.json')
+        self.outcomes_path = os.path.join(state_dir, name + '.outcomes.jsonl')
+        stat = os.stat(path)
+        # the same file name may be delivered again later, only resume the state of this very file
+        self.identity = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        self.offset = 0
+        # offsets past the checkpoint of the lines that have an outcome / were sent to T24 without one
+        self.finished = set()
+        self.interrupted = set()
+        self.lock = threading.Lock()
+
+        saved = self.read_checkpoint()
+        if saved and saved['identity'] == self.identity:
+            self.offset = saved['offset']
+            started = set()
+            for record in self.read_outcomes():
+                if record['offset'] >= self.offset:
+                    (started if record['status'] == STARTED else self.finished).add(record['offset'])
+            self.interrupted = started - self.finished
+        else:
+            self.remove()
+
+    def read_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def read_outcomes(self):
+        """yields the records of the outcomes file one at a time"""
+        try:
+            with open(self.outcomes_path) as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # the last record may be cut short by a crash
+                        continue
+        except OSError:
+            pass
+
+    def write(self, record):
+        with open(self.outcomes_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def start(self, offset):
+        """marks a line as sent to T24, flushed to disk before the call is made"""
+        with self.lock:
+            self.write({'offset': offset, 'status': STARTED})
+
+    def record(self, outcome):
+        """appends the outcome of a line and flushes it to disk before the line counts as done"""
+        with self.lock:
+            self.write(outcome)
+            self.finished.add(outcome['offset'])
+            self.interrupted.discard(outcome['offset'])
+
+    def is_finished(self, offset):
+        with self.lock:
+            return offset in self.finished
+
+    def advance(self, offset):
+        """atomically replaces the checkpoint with the new offset"""
+        self.offset = offset
+        with self.lock:
+            # the lines before the checkpoint are never looked at again
+            self.finished = {finished for finished in self.finished if finished >= offset}
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'identity': self.identity, 'offset': offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def remove(self):
+        for path in (self.checkpoint_path, self.outcomes_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class DropFolderIngester:
+    """
+    Watches a directory for clearing files and runs every line through the unpay flow:
+    - <directory>/            incoming files, picked up once they have not changed for settle_seconds
+    - <directory>/.state/     checkpoints of the files being processed
+    - <directory>/done/       files whose lines were all unpaid, with a <name>.summary.json
+    - <directory>/failed/     files with at least one line that was not unpaid, with a summary and the outcomes
+    Files are read line by line and at most `concurrency` lines are in flight at a time.
+    """
+
+    def __init__(self, directory, owner, concurrency=4, settle_seconds=5, stop_event=None):
+        self.directory = directory
+        self.owner = owner
+        self.concurrency = concurrency
+        self.settle_seconds = settle_seconds
+        self.stop_event = stop_event or threading.Event()
+        self.state_dir = os.path.join(directory, '.state')
+        self.done_dir = os.path.join(directory, 'done')
+        self.failed_dir = os.path.join(directory, 'failed')
+        for path in (self.state_dir, self.done_dir, self.failed_dir):
+            os.makedirs(path, exist_ok=True)
+        self.logger = helper.setup_logger('ingestion', f'logs/{current_date}/ingestion.log')
+
+    def ready_files(self):
+        """returns the files in the directory that are complete, oldest first"""
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.startswith('.') or entry.name.endswith(PARTIAL_SUFFIXES):
+                continue
+            mtime = entry.stat().st_mtime
+            if now - mtime >= self.settle_seconds:
+                files.append((mtime, entry.path))
+        return [path for _, path in sorted(files)]
+
+    def run(self, poll_interval=5, once=False):
+        """processes the ready files until stopped, or a single pass if once is True"""
+        while not self.stop_event.is_set():
+            for path in self.ready_files():
+                if self.stop_event.is_set():
+                    break
+                self.ingest_file(path)
+            if once:
+                break
+            self.stop_event.wait(poll_interval)
+
+    def ingest_file(self, path):
+        """
+        - resume from the checkpoint of the file, if any
+        - read the file line by line from the checkpointed offset, skipping lines that already have an outcome
+        - keep at most `concurrency` lines in flight and advance the checkpoint over the finished prefix
+        - once every line has an outcome, move the file to done/ or failed/ with a summary
+        returns the summary, or None if the worker was stopped before the end of the file
+        """
+        checkpoint = Checkpoint(self.state_dir, path)
+        self.logger.info(f'ingesting {path} from offset {checkpoint.offset}')
+
+        # (end offset, future) of the lines read so far whose checkpoint has not advanced yet, in file order
+        pending = deque()
+        reached_end = False
+        with open(path, 'rb') as f, ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            f.seek(checkpoint.offset)
+            offset = checkpoint.offset
+            for raw_line in iter(f.readline, b''):
+                if self.stop_event.is_set():
+                    break
+                start, offset = offset, offset + len(raw_line)
+                line = raw_line.decode('utf-8', errors='replace').strip()
+
+                if not line or checkpoint.is_finished(start):
+                    pending.append((offset, None))
+                elif start in checkpoint.interrupted:
+                    checkpoint.record({'offset': start, 'raw_string': line, 'status': INTERRUPTED,
+                                       'detail': 'the worker stopped while the line was in T24, check it there'})
+                    pending.append((offset, None))
+                else:
+                    pending.append((offset, pool.submit(self.process_line, checkpoint, start, line)))
+
+                # move the checkpoint over the finished lines and block while the window is full. the window
+                # is also capped in lines so that one slow line cannot make it grow with the whole file
+                while True:
+                    self.advance(checkpoint, pending)
+                    running = [future for _, future in pending if future and not future.done()]
+                    if len(running) < self.concurrency and len(pending) < self.concurrency * WINDOW_FACTOR:
+                        break
+                    wait(running, return_when=FIRST_COMPLETED)
+            else:
+                reached_end = True
+
+        # the pool has been shut down, every submitted line is finished
+        self.advance(checkpoint, pending)
+        if not reached_end:
+            self.logger.info(f'stopped ingesting {path} at offset {checkpoint.offset}')
+            return None
+        return self.finish(path, checkpoint)
+
+    def advance(self, checkpoint, pending):
+        offset = None
+        while pending and (pending[0][1] is None or pending[0][1].done()):
+            offset, _ = pending.popleft()
+        if offset is not None:
+            checkpoint.advance(offset)
+
+    def process_line(self, checkpoint, offset, line):
+        """runs one line through the unpay flow and records its outcome"""
+        outcome = {'offset': offset, 'raw_string': line}
+        try:
+            try:
+                request_dict = helper.parse_raw_string(line)
+            except (IndexError, ValueError):
+                request_dict = {'error': 'malformed line'}
+            if 'error' not in request_dict:
+                checkpoint.start(offset)
+                request_dict = helper.process_unpay_request(request_dict)
+
+            if 'error' in request_dict:
+                outcome.update(status='rejected', detail=request_dict['error'])
+            else:
+                request_dict['owner'] = self.owner
+                unpaid_cheque = UnpaidCheque(**request_dict)
+                persist(unpaid_cheque)
+                outcome.update(status=UNPAID if unpaid_cheque.is_unpaid else 'not_unpaid',
+                               detail=unpaid_cheque.unpay_error_message or '', unpaid_cheque=unpaid_cheque.pk)
+        except Exception as e:
+            self.logger.error(f'line at offset {offset}: {e}')
+            outcome.update(status='error', detail=str(e))
+        finally:
+            # the line ran in a pool thread, which has its own database connection
+            connection.close()
+
+        checkpoint.record(outcome)
+        return outcome
+
+    def finish(self, path, checkpoint):
+        """
+        writes the summary, moves the file and its outcomes to done/ or failed/ and drops the checkpoint.
+        the summary is built from the outcomes file, read one record at a time
+        """
+        name = os.path.basename(path)
+        counts = Counter()
+        failed = []
+        for outcome in checkpoint.read_outcomes():
+            if outcome['status'] == STARTED:
+                continue
+            counts[outcome['status']] += 1
+            if outcome['status'] != UNPAID:
+                failed.append(outcome)
+        failed.sort(key=lambda outcome: outcome['offset'])
+        summary = {
+            'file': name,
+            'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'lines': sum(counts.values()),
+            'counts': dict(counts),
+            'failed_lines': failed,
+        }
+
+        destination = self.failed_dir if failed else self.done_dir
+        with open(os.path.join(destination, name + '.summary.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        if failed and os.path.exists(checkpoint.outcomes_path):
+            shutil.move(checkpoint.outcomes_path, os.path.join(destination, name + '.outcomes.jsonl'))
+        shutil.move(path, os.path.join(destination, name))
+        checkpoint.remove()
+
+        self.logger.info(f'{name} moved to {destination}: {dict(counts)}')
+        return summary
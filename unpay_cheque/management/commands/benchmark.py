@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from unpay_cheque.benchmarks import SCENARIOS
+
+
+class Command(BaseCommand):
+    help = 'Runs a benchmark scenario against a throwaway test database'
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='scenario', required=True)
+        for name, scenario in SCENARIOS.items():
+            scenario.add_arguments(subparsers.add_parser(name, help=scenario.help))
+
+    def handle(self, *args, **options):
+        SCENARIOS[options['scenario']].run(self, options)
@@ -0,0 +1,35 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from unpay_cheque.collection import ChargeCollectionRun, outstanding_unpaid_cheques
+
+
+class Command(BaseCommand):
+    help = ('Charges unpaid cheques that have no collected charge. '
+            'Safe to schedule on several nodes at once, each cheque is claimed by one run.')
+
+    def add_arguments(self, parser):
+        config = settings.CHARGE_COLLECTION
+        parser.add_argument('--max-per-run', type=int, default=config['MAX_PER_RUN'], help='cheques attempted per run')
+        parser.add_argument('--rate', type=float, default=config['RATE'], help='T24 charge calls per second')
+        parser.add_argument('--concurrency', type=int, default=config['CONCURRENCY'], help='T24 calls in flight')
+        parser.add_argument('--batch-size', type=int, default=config['BATCH_SIZE'],
+                            help='cheques claimed, and charges written, at a time')
+        parser.add_argument('--claim-ttl', type=int, default=config['CLAIM_TTL'],
+                            help='seconds before a claimed cheque whose charge failed is tried again')
+        parser.add_argument('--dry-run', action='store_true', help='only count the outstanding cheques')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            self.stdout.write(f'{outstanding_unpaid_cheques().count()} unpaid cheques without a collected charge')
+            return
+
+        summary = ChargeCollectionRun(
+            max_per_run=options['max_per_run'],
+            rate=options['rate'],
+            concurrency=options['concurrency'],
+            batch_size=options['batch_size'],
+            claim_ttl=options['claim_ttl'],
+        ).run()
+        self.stdout.write(json.dumps(summary))
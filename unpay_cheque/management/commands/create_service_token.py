@@ -0,0 +1,21 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from unpay_cheque.models import ServiceToken
+
+
+class Command(BaseCommand):
+    help = 'Creates an API token for a service client. The key is printed once and is not stored.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='user the requests made with the token are owned by')
+        parser.add_argument('--name', help='label for the token, defaults to the username')
+
+    def handle(self, *args, **options):
+        try:
+            owner = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError('no user named ' + options['username'])
+
+        token, key = ServiceToken.generate(owner, options['name'] or owner.username)
+        self.stdout.write(f'created token "{token.name}" for {owner.username}')
+        self.stdout.write(f'Authorization: Token {key}')
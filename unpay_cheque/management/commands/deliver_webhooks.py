@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from unpay_cheque.webhooks import WebhookDeliverer
+
+
+class Command(BaseCommand):
+    help = 'Delivers the webhook outbox to the subscribed callback URLs, retrying failures with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help='subscriptions delivered side by side')
+        parser.add_argument('--poll-interval', type=float, default=1, help='seconds to wait when nothing is due')
+        parser.add_argument('--once', action='store_true', help='deliver one round of due events and exit')
+
+    def handle(self, *args, **options):
+        WebhookDeliverer(concurrency=options['concurrency']).run(poll_interval=options['poll_interval'],
+                                                                 once=options['once'])
@@ -0,0 +1,36 @@
+import signal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from unpay_cheque.ingestion import DropFolderIngester
+
+
+class Command(BaseCommand):
+    help = 'Watches a drop folder for returned-cheque files and unpays every line, resuming mid-file after a crash'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='directory the clearing files are delivered to')
+        parser.add_argument('--owner', required=True, help='username the created unpaid cheques are owned by')
+        parser.add_argument('--concurrency', type=int, default=4, help='lines in flight at a time')
+        parser.add_argument('--poll-interval', type=float, default=5, help='seconds between directory scans')
+        parser.add_argument('--settle-seconds', type=float, default=5,
+                            help='seconds a file must be unchanged before it is picked up')
+        parser.add_argument('--once', action='store_true', help='process the ready files once and exit')
+
+    def handle(self, *args, **options):
+        try:
+            owner = User.objects.get(username=options['owner'])
+        except User.DoesNotExist:
+            raise CommandError('no user named ' + options['owner'])
+
+        ingester = DropFolderIngester(options['directory'], owner, concurrency=options['concurrency'],
+                                      settle_seconds=options['settle_seconds'])
+
+        # finish the lines in flight and checkpoint on SIGTERM/SIGINT instead of dying mid-line
+        def stop(signum, frame):
+            self.stdout.write('stopping after the lines in flight')
+            ingester.stop_event.set()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        ingester.run(poll_interval=options['poll_interval'], once=options['once'])
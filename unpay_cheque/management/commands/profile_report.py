@@ -0,0 +1,29 @@
+import io
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from unpay_cheque.profiling import load_profiles
+
+
+class Command(BaseCommand):
+    help = 'Lists the top functions by cumulative time from the profiles written by SamplingProfilerMiddleware'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoint', help='only report this endpoint, e.g. unpaidcheque-list.POST')
+        parser.add_argument('--limit', type=int, default=25, help='number of functions to list per endpoint')
+        parser.add_argument('--sort', default='cumulative', help='pstats sort key (cumulative, tottime, ncalls, ...)')
+        parser.add_argument('--dir', default=str(settings.PROFILING['OUTPUT_DIR']), help='directory holding the profiles')
+
+    def handle(self, *args, **options):
+        profiles = load_profiles(options['dir'], options['endpoint'])
+        if not profiles:
+            self.stdout.write('no profiles found in ' + options['dir'])
+            return
+
+        for endpoint, stats in profiles.items():
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{endpoint} ({stats.total_calls} calls, {stats.total_tt:.3f}s)'))
+            # pstats prints to a stream, point it at a buffer so the output goes through self.stdout
+            buffer = io.StringIO()
+            stats.stream = buffer
+            stats.sort_stats(options['sort']).print_stats(options['limit'])
+            self.stdout.write(buffer.getvalue())
@@ -0,0 +1,50 @@
+import hmac
+import json
+import random
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.core.management.base import BaseCommand
+from unpay_cheque.webhooks import sign, SIGNATURE_HEADER, TIMESTAMP_HEADER
+
+
+class Command(BaseCommand):
+    help = 'Runs a local HTTP sink that receives webhooks, checks their signature and prints the events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--secret', help="the subscription's secret, signatures are not checked without it")
+        parser.add_argument('--fail-rate', type=float, default=0,
+                            help='share of batches answered with a 503, to exercise retries')
+
+    def handle(self, *args, **options):
+        command = self
+
+        class SinkHandler(BaseHTTPRequestHandler):
+            # keep-alive, so that the connection reuse of the delivery worker shows
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if options['secret']:
+                    expected = 'sha256=' + sign(options['secret'], self.headers.get(TIMESTAMP_HEADER, ''), body)
+                    if not hmac.compare_digest(expected, self.headers.get(SIGNATURE_HEADER, '')):
+                        command.stdout.write(command.style.ERROR('bad signature'))
+                        return self.reply(401)
+                if random.random() < options['fail_rate']:
+                    command.stdout.write(command.style.WARNING('failing batch on purpose'))
+                    return self.reply(503)
+
+                for event in json.loads(body)['events']:
+                    command.stdout.write(f"{event['id']} {event['type']} {json.dumps(event['data'])}")
+                self.reply(200)
+
+            def reply(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.stdout.write(f"webhook sink listening on http://127.0.0.1:{options['port']}/")
+        ThreadingHTTPServer(('127.0.0.1', options['port']), SinkHandler).serve_forever()
@@ -0,0 +1,87 @@
+# in-process call metrics
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+
+def percentile(values, pct):
+    """nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class CallStats:
+    """counters and the latencies of the last `window` calls of one (service, company) pair"""
+
+    def __init__(self, window):
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=window)
+
+    def as_dict(self):
+        latencies = list(self.latencies)
+        stats = {
+            'in_flight': self.in_flight,
+            'calls': self.calls,
+            'errors': self.errors,
+            'rejected': self.rejected,
+        }
+        for pct in (50, 95, 99):
+            stats[f'p{pct}_ms'] = round(percentile(latencies, pct) * 1000, 1) if latencies else None
+        return stats
+
+
+class CallMetrics:
+    """
+    Metrics of outgoing calls keyed by service and company:
+    - track() wraps a call, counting it in flight and recording its latency and whether it raised
+    - reject() counts a call that was turned away before it was made
+    - snapshot() returns {service: {company: stats}}
+    """
+
+    def __init__(self, window=500):
+        self.window = window
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _get(self, service, company):
+        key = (service, company)
+        if key not in self._stats:
+            self._stats[key] = CallStats(self.window)
+        return self._stats[key]
+
+    @contextmanager
+    def track(self, service, company):
+        with self._lock:
+            stats = self._get(service, company)
+            stats.in_flight += 1
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                stats.in_flight -= 1
+                stats.calls += 1
+                stats.errors += failed
+                stats.latencies.append(elapsed)
+
+    def reject(self, service, company):
+        with self._lock:
+            self._get(service, company).rejected += 1
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {}
+            for (service, company), stats in sorted(self._stats.items()):
+                snapshot.setdefault(service, {})[company] = stats.as_dict()
+            return snapshot
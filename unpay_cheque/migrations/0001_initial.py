@@ -0,0 +1,61 @@
+# Generated by Django 4.0.2 on 2026-10-19 03:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnpaidCheque',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('raw_string', models.CharField(max_length=100)),
+                ('voucher_code', models.CharField(max_length=3)),
+                ('cheque_number', models.CharField(max_length=100)),
+                ('reason_code', models.CharField(max_length=3)),
+                ('cheque_amount', models.DecimalField(decimal_places=2, max_digits=9)),
+                ('cheque_value_date', models.DateField()),
+                ('ft_ref', models.CharField(blank=True, max_length=100, null=True)),
+                ('logged_at', models.DateTimeField(auto_now_add=True)),
+                ('is_unpaid', models.BooleanField(default=False)),
+                ('unpaid_value_date', models.DateField(blank=True, null=True)),
+                ('cc_record', models.CharField(blank=True, max_length=100, null=True)),
+                ('unpay_success_indicator', models.CharField(blank=True, max_length=50, null=True)),
+                ('unpay_error_message', models.CharField(blank=True, max_length=100, null=True)),
+                ('cheque_account', models.CharField(blank=True, max_length=100, null=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unpaid_cheques', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['logged_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Charge',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('charge_id', models.CharField(max_length=100)),
+                ('charge_account', models.CharField(max_length=100)),
+                ('charge_amount', models.DecimalField(decimal_places=2, max_digits=9)),
+                ('charge_value_date', models.DateField()),
+                ('charge_success_indicator', models.CharField(blank=True, max_length=50, null=True)),
+                ('ofs_id', models.CharField(blank=True, max_length=100, null=True)),
+                ('ft_ref', models.CharField(blank=True, max_length=100, null=True)),
+                ('is_collected', models.BooleanField(default=False)),
+                ('charge_error_message', models.CharField(blank=True, max_length=100, null=True)),
+                ('cc_record', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='charges', to='unpay_cheque.unpaidcheque')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='charges', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['charge_id'],
+            },
+        ),
+    ]
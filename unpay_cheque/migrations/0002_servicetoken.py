@@ -0,0 +1,31 @@
+# Generated by Django 4.0.2 on 2026-10-19 03:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    # the table may already exist in a database built with `migrate --run-syncdb` before this app had
+    # migrations, `migrate --fake-initial` then marks this migration as applied instead of failing
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('unpay_cheque', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('key_digest', models.CharField(max_length=64, unique=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='service_tokens', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
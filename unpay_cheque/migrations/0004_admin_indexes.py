@@ -0,0 +1,53 @@
+# Generated by Django 4.0.2 on 2026-10-19 03:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('unpay_cheque', '0003_webhooks'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='charge',
+            index=models.Index(fields=['charge_id'], name='unpay_chequ_charge__ed46b7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='charge',
+            index=models.Index(fields=['charge_account', 'is_collected'], name='unpay_chequ_charge__2cdd0e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='charge',
+            index=models.Index(fields=['cc_record', 'is_collected'], name='unpay_chequ_cc_reco_358646_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='charge',
+            index=models.Index(fields=['charge_value_date'], name='unpay_chequ_charge__b82303_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='unpaidcheque',
+            index=models.Index(fields=['logged_at'], name='unpay_chequ_logged__f45e4f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='unpaidcheque',
+            index=models.Index(fields=['is_unpaid', 'logged_at'], name='unpay_chequ_is_unpa_1d3916_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='unpaidcheque',
+            index=models.Index(fields=['ft_ref'], name='unpay_chequ_ft_ref_f89641_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='unpaidcheque',
+            index=models.Index(fields=['cheque_number'], name='unpay_chequ_cheque__7990cd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='unpaidcheque',
+            index=models.Index(fields=['cc_record'], name='unpay_chequ_cc_reco_bd8ae5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='unpaidcheque',
+            index=models.Index(fields=['cheque_account'], name='unpay_chequ_cheque__0dc279_idx'),
+        ),
+    ]
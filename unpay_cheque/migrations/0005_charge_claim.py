@@ -0,0 +1,27 @@
+# Generated by Django 4.0.2 on 2026-10-19 03:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('unpay_cheque', '0004_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unpaidcheque',
+            name='charge_claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='unpaidcheque',
+            name='charge_claimed_by',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='unpaidcheque',
+            index=models.Index(fields=['charge_claimed_by'], name='unpay_chequ_charge__82d99e_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-19 03:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('unpay_cheque', '0005_charge_claim'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unpaidcheque',
+            name='co_code',
+            field=models.CharField(blank=True, max_length=20, null=True),
+        ),
+    ]
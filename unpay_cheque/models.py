@@ -1,4 +1,8 @@
+import hashlib
+import secrets
+
 from django.db import models
+from django.utils import timezone
 
 # model to store incoming unpaid cheque details
 class UnpaidCheque(models.Model):
@@ -16,6 +20,11 @@ class UnpaidCheque(models.Model):
     unpay_success_indicator = models.CharField(max_length=50, blank=True, null=True)
     unpay_error_message = models.CharField(max_length=100, blank=True, null=True)
     cheque_account = models.CharField(max_length=100, blank=True, null=True)
+    # the T24 company (COCODE) that holds the CC record, the charge for the cheque is made in it too
+    co_code = models.CharField(max_length=20, blank=True, null=True)
+    # set by the charge collection run working on the row, so that concurrent runs skip it
+    charge_claimed_by = models.CharField(max_length=64, blank=True, null=True)
+    charge_claimed_at = models.DateTimeField(blank=True, null=True)
     owner = models.ForeignKey('auth.User', related_name='unpaid_cheques', on_delete=models.CASCADE)
 
     def __str__(self):
@@ -23,6 +32,16 @@ class UnpaidCheque(models.Model):
 
     class Meta:
         ordering = ['logged_at']
+        indexes = [
+            # the admin changelist filters, searches and orders on these
+            models.Index(fields=['logged_at']),
+            models.Index(fields=['is_unpaid', 'logged_at']),
+            models.Index(fields=['ft_ref']),
+            models.Index(fields=['cheque_number']),
+            models.Index(fields=['cc_record']),
+            models.Index(fields=['cheque_account']),
+            models.Index(fields=['charge_claimed_by']),
+        ]
 
 
 # model to store charge details
@@ -43,4 +62,84 @@ class Charge(models.Model):
         return self.charge_id
 
     class Meta:
-        ordering = ['charge_id']
\ No newline at end of file
+        ordering = ['charge_id']
+        indexes = [
+            # the default ordering, lookups by account (charge validation, admin search) and the
+            # collected-charge anti-join per cheque
+            models.Index(fields=['charge_id']),
+            models.Index(fields=['charge_account', 'is_collected']),
+            models.Index(fields=['cc_record', 'is_collected']),
+            models.Index(fields=['charge_value_date']),
+        ]
+
+
+# model to store the API tokens of machine-to-machine clients. only a digest of the key is stored
+class ServiceToken(models.Model):
+    name = models.CharField(max_length=100)
+    key_digest = models.CharField(max_length=64, unique=True)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    owner = models.ForeignKey('auth.User', related_name='service_tokens', on_delete=models.CASCADE)
+
+    def __str__(self):
+        return self.name
+
+    @staticmethod
+    def digest(key):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    @classmethod
+    def generate(cls, owner, name):
+        """creates a token for owner and returns it together with the raw key, which is not stored"""
+        key = secrets.token_hex(32)
+        token = cls.objects.create(owner=owner, name=name, key_digest=cls.digest(key))
+        return token, key
+
+
+def generate_webhook_secret():
+    return secrets.token_hex(32)
+
+
+# model to store the callback URLs clients register to be told about outcomes instead of polling
+class WebhookSubscription(models.Model):
+    callback_url = models.URLField(max_length=500)
+    secret = models.CharField(max_length=64, default=generate_webhook_secret)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    owner = models.ForeignKey('auth.User', related_name='webhook_subscriptions', on_delete=models.CASCADE)
+
+    def __str__(self):
+        return self.callback_url
+
+    class Meta:
+        ordering = ['created_at']
+
+
+# outbox of the events waiting to be delivered to a subscription
+class WebhookEvent(models.Model):
+    PENDING = 'pending'
+    DELIVERED = 'delivered'
+    FAILED = 'failed'
+    DROPPED = 'dropped'
+    STATUS_CHOICES = [(PENDING, 'pending'), (DELIVERED, 'delivered'), (FAILED, 'failed'), (DROPPED, 'dropped')]
+
+    event_type = models.CharField(max_length=50)
+    payload = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.CharField(max_length=200, blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    delivered_at = models.DateTimeField(blank=True, null=True)
+    subscription = models.ForeignKey('WebhookSubscription', related_name='events', on_delete=models.CASCADE)
+
+    def __str__(self):
+        return f'{self.event_type} #{self.pk}'
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            # the delivery worker looks for due pending events, the outbox bound counts pending events per subscription
+            models.Index(fields=['status', 'next_attempt_at']),
+            models.Index(fields=['subscription', 'status']),
+        ]
@@ -1,3 +1,6 @@
+import hmac
+
+from django.conf import settings
 from rest_framework import permissions
 
 
@@ -13,4 +16,20 @@ class IsOwnerOrReadOnly(permissions.BasePermission):
             return True
 
         # Write permissions are only allowed to the owner of the snippet.
-        return obj.owner == request.user
\ No newline at end of file
+        # Compare the ids so that the owner row is not fetched.
+        return obj.owner_id == request.user.pk
+
+
+class CanReadHealthState(permissions.BasePermission):
+    """
+    Allows the load balancer (X-Health-Token matching HEALTH['STATE_TOKEN']) and staff users to read
+    /health/state, or anyone when HEALTH['STATE_PUBLIC'] is on. Without a token configured only staff get in.
+    """
+
+    def has_permission(self, request, view):
+        if settings.HEALTH['STATE_PUBLIC']:
+            return True
+        token = settings.HEALTH['STATE_TOKEN']
+        if token and hmac.compare_digest(request.headers.get('X-Health-Token', ''), token):
+            return True
+        return bool(request.user and request.user.is_staff)
\ No newline at end of file
@@ -0,0 +1,109 @@
+# opt-in sampling profiler for the API hot paths
+import cProfile
+import hmac
+import os
+import pstats
+import random
+import threading
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+
+# request header used to ask for a profile of a single request, e.g. X-Profile: <PROFILE_HEADER_TOKEN>
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+
+
+class SamplingProfilerMiddleware:
+    """
+    Profiles a sample of the requests to the configured path prefixes with cProfile and
+    aggregates the results per endpoint into pstats files under PROFILING['OUTPUT_DIR']:
+    - <OUTPUT_DIR>/<view name>.<method>/<pid>.prof, one file per worker process
+    - `manage.py profile_report` merges the files and lists the top functions
+    When there is neither a sample rate nor a header token configured the middleware removes
+    itself from the chain at startup, so it costs nothing when profiling is off.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.config = settings.PROFILING
+        if not self.config['SAMPLE_RATE'] and not self.config['HEADER_TOKEN']:
+            raise MiddlewareNotUsed
+
+        self.path_prefixes = tuple(self.config['PATH_PREFIXES'])
+        self.output_dir = str(self.config['OUTPUT_DIR'])
+        # aggregated stats of this process, keyed by endpoint
+        self.stats = {}
+        # only one request is profiled at a time per process. cProfile cannot run two profilers
+        # at once on newer pythons and this also bounds the overhead under load
+        self.profiling_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+
+    def __call__(self, request):
+        if not self.should_profile(request) or not self.profiling_lock.acquire(blocking=False):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+        finally:
+            self.profiling_lock.release()
+
+        self.save(self.endpoint(request), profiler)
+        return response
+
+    def should_profile(self, request):
+        """
+        - only requests under the configured path prefixes are profiled
+        - a request carrying the header token is always profiled
+        - any other request is profiled with probability SAMPLE_RATE
+        """
+        if not request.path.startswith(self.path_prefixes):
+            return False
+        token = request.META.get(PROFILE_HEADER)
+        if token and self.config['HEADER_TOKEN'] and hmac.compare_digest(token, self.config['HEADER_TOKEN']):
+            return True
+        return random.random() < self.config['SAMPLE_RATE']
+
+    def endpoint(self, request):
+        # name the profile after the resolved view so that /unpaids/1/ and /unpaids/2/ are aggregated
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match else 'unresolved'
+        return f'{view_name}.{request.method}'
+
+    def save(self, endpoint, profiler):
+        """
+        - add the profile to the aggregated stats of the endpoint
+        - dump the aggregated stats of this process to its pstats file
+        """
+        endpoint_dir = os.path.join(self.output_dir, endpoint)
+        with self.stats_lock:
+            if endpoint in self.stats:
+                self.stats[endpoint].add(profiler)
+            else:
+                self.stats[endpoint] = pstats.Stats(profiler)
+            os.makedirs(endpoint_dir, exist_ok=True)
+            self.stats[endpoint].dump_stats(os.path.join(endpoint_dir, f'{os.getpid()}.prof'))
+
+
+def load_profiles(output_dir, endpoint=None):
+    """
+    reads the pstats files written by SamplingProfilerMiddleware and returns a dictionary of
+    endpoint -> pstats.Stats merged across worker processes
+    """
+    profiles = {}
+    if not os.path.isdir(output_dir):
+        return profiles
+
+    for name in sorted(os.listdir(output_dir)):
+        endpoint_dir = os.path.join(output_dir, name)
+        if not os.path.isdir(endpoint_dir) or (endpoint and name != endpoint):
+            continue
+        files = [os.path.join(endpoint_dir, f) for f in sorted(os.listdir(endpoint_dir)) if f.endswith('.prof')]
+        if files:
+            profiles[name] = pstats.Stats(*files)
+    return profiles
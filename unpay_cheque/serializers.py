@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from .models import UnpaidCheque, Charge
+from .models import UnpaidCheque, Charge, WebhookSubscription
+from .webhooks import check_callback_url, UnsafeCallbackURL
 from django.contrib.auth.models import User
 
 
@@ -13,10 +14,10 @@ class UnpaidChequeSerializer(serializers.HyperlinkedModelSerializer):
 
         fields = ['raw_string', 'owner', 'posted_at', 'voucher_code', 'cheque_number', 'reason_code', 'cheque_amount',
                 'cheque_value_date', 'ft_ref', 'logged_at', 'is_unpaid', 'unpaid_value_date', 'cc_record', 'unpay_success_indicator', 
-                'unpay_error_message', 'cheque_account']
+                'unpay_error_message', 'cheque_account', 'co_code']
         read_only_fields = ['posted_at', 'owner', 'voucher_code', 'cheque_number', 'reason_code', 'cheque_amount', 'cheque_value_date',
                             'ft_ref', 'logged_at', 'is_unpaid', 'unpaid_value_date', 'cc_record', 'unpay_success_indicator', 'unpay_error_message',
-                            'cheque_account']
+                            'cheque_account', 'co_code']
 
 
 class UserSerializer(serializers.HyperlinkedModelSerializer):
@@ -36,4 +37,28 @@ class ChargeSerializer(serializers.HyperlinkedModelSerializer):
         fields = ['charge_id', 'charge_account', 'charge_amount', 'charge_value_date', 'charge_success_indicator',
                   'charge_error_message', 'owner', 'cc_record', 'ofs_id', 'ft_ref', 'is_collected']
         read_only_fields = ['charge_id', 'charge_amount', 'charge_value_date', 'charge_success_indicator', 
-                            'charge_error_message', 'owner', 'cc_record', 'ofs_id', 'is_collected']
\ No newline at end of file
+                            'charge_error_message', 'owner', 'cc_record', 'ofs_id', 'is_collected']
+
+
+class WebhookSubscriptionSerializer(serializers.HyperlinkedModelSerializer):
+    owner = serializers.ReadOnlyField(source='owner.username')
+
+    class Meta:
+        model = WebhookSubscription
+        fields = ['url', 'id', 'callback_url', 'is_active', 'created_at', 'owner']
+        read_only_fields = ['created_at', 'owner']
+
+    def validate_callback_url(self, value):
+        try:
+            check_callback_url(value)
+        except UnsafeCallbackURL as e:
+            raise serializers.ValidationError(str(e))
+        return value
+
+
+# the secret is only ever returned by the request that creates the subscription
+class WebhookSubscriptionCreateSerializer(WebhookSubscriptionSerializer):
+
+    class Meta(WebhookSubscriptionSerializer.Meta):
+        fields = WebhookSubscriptionSerializer.Meta.fields + ['secret']
+        read_only_fields = WebhookSubscriptionSerializer.Meta.read_only_fields + ['secret']
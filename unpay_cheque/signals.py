@@ -0,0 +1,53 @@
+# signal handlers that add webhook events to the outbox when an outcome is recorded or changes
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+from .models import UnpaidCheque, Charge
+from . import webhooks
+
+
+@receiver(post_init, sender=UnpaidCheque)
+@receiver(post_init, sender=Charge)
+def remember_outcome(sender, instance, **kwargs):
+    # remember the outcome as loaded so that post_save can tell whether it changed
+    instance._saved_outcome = outcome(instance)
+
+
+@receiver(post_save, sender=UnpaidCheque)
+@receiver(post_save, sender=Charge)
+def emit_outcome_change(sender, instance, created, **kwargs):
+    """
+    emits an event for every new row, whatever its outcome (a cheque T24 refused to unpay or a charge
+    that was not collected is news to the client too), and when the outcome of a saved row changes:
+    - unpaid_cheque.is_unpaid_changed for UnpaidCheque.is_unpaid
+    - charge.is_collected_changed for Charge.is_collected
+    """
+    current = outcome(instance)
+    changed = created or current != instance._saved_outcome
+    instance._saved_outcome = current
+    if not changed:
+        return
+
+    if sender is UnpaidCheque:
+        webhooks.emit(instance.owner_id, 'unpaid_cheque.is_unpaid_changed', {
+            'id': instance.pk,
+            'ft_ref': instance.ft_ref,
+            'cheque_number': instance.cheque_number,
+            'cc_record': instance.cc_record,
+            'is_unpaid': instance.is_unpaid,
+            'unpaid_value_date': str(instance.unpaid_value_date) if instance.unpaid_value_date else None,
+            'unpay_success_indicator': instance.unpay_success_indicator,
+        })
+    else:
+        webhooks.emit(instance.owner_id, 'charge.is_collected_changed', {
+            'id': instance.pk,
+            'charge_id': instance.charge_id,
+            'charge_account': instance.charge_account,
+            'charge_amount': str(instance.charge_amount),
+            'unpaid_cheque': instance.cc_record_id,
+            'is_collected': instance.is_collected,
+            'charge_success_indicator': instance.charge_success_indicator,
+        })
+
+
+def outcome(instance):
+    return instance.is_unpaid if isinstance(instance, UnpaidCheque) else instance.is_collected
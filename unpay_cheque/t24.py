@@ -0,0 +1,151 @@
+# routing of T24 web service calls per company (COCODE)
+import threading
+
+from contextlib import contextmanager
+from django.conf import settings
+from .metrics import CallMetrics
+
+
+class CompanyBusy(Exception):
+    """raised when a pool has no free slot and its queue is full or the wait timed out"""
+
+
+class CompanyPool:
+    """
+    Bounds the calls to one service of one company: at most max_concurrency calls run at a time and at most
+    max_queue callers wait for a slot, each for up to queue_timeout seconds. A caller that finds a free slot
+    never counts as waiting, so max_queue 0 means no queueing at all. A slow company, or a slow service of
+    a company, therefore only ties up its own slots and callers.
+    """
+
+    def __init__(self, service, company, max_concurrency, max_queue, queue_timeout):
+        self.service = service
+        self.company = company
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.waiting = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self):
+        if not self.semaphore.acquire(blocking=False):
+            self.wait()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self.semaphore.release()
+
+    def wait(self):
+        """queues for a slot, raises CompanyBusy if the queue is full or no slot frees up in time"""
+        with self._lock:
+            if self.waiting >= self.max_queue:
+                raise CompanyBusy(f'too many {self.service} calls queued for company {self.company}')
+            self.waiting += 1
+        try:
+            acquired = self.semaphore.acquire(timeout=self.queue_timeout)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        if not acquired:
+            raise CompanyBusy(f'timed out waiting for a {self.service} slot for company {self.company}')
+
+
+def default_transport(service, wsdl):
+    """the transport of a new client: zeep's own, or a recording one while T24_TRAFFIC['RECORD_DIR'] is set"""
+    if settings.T24_TRAFFIC['RECORD_DIR'] is None:
+        return None
+    from .transports import RecordingTransport
+    return RecordingTransport(service)
+
+
+class T24Router:
+    """
+    Picks the endpoint and credentials of a T24 call from the company it is made for and runs it
+    through the pool of that service in that company, so that the query_cc calls made for every company
+    on the default one do not queue behind its unpays and charges. Companies listed in settings.T24_COMPANIES
+    can override the user, password, any service's WSDL and the pool sizes; everything else falls back to the
+    defaults.
+    zeep clients are built once per WSDL and reused, loading a WSDL is far slower than a call.
+    """
+
+    def __init__(self, default_credentials, default_wsdls):
+        self.default_credentials = default_credentials
+        self.default_wsdls = default_wsdls
+        self.companies = settings.T24_COMPANIES
+        self.pool_defaults = settings.T24_POOL
+        self.metrics = CallMetrics()
+        self.pools = {}
+        self.clients = {}
+        # builds the zeep transport of each new client, swapped out by transports.replaying()
+        self.transport = default_transport
+        self._lock = threading.Lock()
+
+    def company_config(self, company):
+        return self.companies.get(company, {})
+
+    def credentials(self, company):
+        """returns the WebRequestCommon block for a call made for company"""
+        config = self.company_config(company)
+        return {
+            'company': company,
+            'password': config.get('password', self.default_credentials['password']),
+            'userName': config.get('user', self.default_credentials['userName']),
+        }
+
+    def wsdl(self, service, company):
+        return self.company_config(company).get(service, self.default_wsdls[service])
+
+    def client(self, service, company):
+        wsdl = self.wsdl(service, company)
+        client = self.clients.get(wsdl)
+        if client is None:
+            # zeep (and lxml) take a while to import, only pay for it when a client is first needed
+            from zeep import Client
+            # load the WSDL outside the lock so that a slow endpoint does not hold up the other companies
+            client = Client(wsdl, transport=self.transport(service, wsdl))
+            with self._lock:
+                client = self.clients.setdefault(wsdl, client)
+        return client
+
+    def pool(self, service, company):
+        with self._lock:
+            if (service, company) not in self.pools:
+                config = self.company_config(company)
+                self.pools[service, company] = CompanyPool(
+                    service,
+                    company,
+                    config.get('max_concurrency', self.pool_defaults['MAX_CONCURRENCY']),
+                    config.get('max_queue', self.pool_defaults['MAX_QUEUE']),
+                    config.get('queue_timeout', self.pool_defaults['QUEUE_TIMEOUT']),
+                )
+            return self.pools[service, company]
+
+    def call(self, client, service, company, operation, request_parameters):
+        """
+        - wait for a slot in the pool of the service in the company (raises CompanyBusy if there is none)
+        - call the operation, recording its latency and outcome under (service, company)
+        - return the response
+        """
+        try:
+            with self.pool(service, company).slot():
+                with self.metrics.track(service, company):
+                    return getattr(client.service, operation)(**request_parameters)
+        except CompanyBusy:
+            self.metrics.reject(service, company)
+            raise
+
+    def pool_state(self):
+        """returns the calls running and the callers queued in every pool (<service>@<company>), against their limits"""
+        with self._lock:
+            pools = list(self.pools.values())
+        return {f'{pool.service}@{pool.company}': {'in_flight': pool.in_flight,
+                                                    'max_concurrency': pool.max_concurrency,
+                                                    'waiting': pool.waiting, 'max_queue': pool.max_queue}
+                for pool in pools}
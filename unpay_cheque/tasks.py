@@ -0,0 +1,133 @@
+# follow-up T24 work on existing rows, run on a background pool instead of inside a request.
+# the queue is in memory: tasks still queued when the worker restarts are dropped, run the action again
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connection
+from .batching import persist
+from .claims import claim_unpaid_cheques, hold_claims, new_claimer, release_claim
+from .helpers import Helpers, current_date
+from .models import UnpaidCheque, Charge
+
+
+helper = Helpers()
+
+# shared by the admin actions. the pool size bounds the load put on T24, the slots bound the tasks
+# queued or running so that a large selection cannot pile up in the worker's memory
+executor = ThreadPoolExecutor(max_workers=settings.BACKGROUND_WORKERS, thread_name_prefix='background-task')
+slots = threading.BoundedSemaphore(settings.BACKGROUND_QUEUE_SIZE)
+
+
+class QueueFull(Exception):
+    """raised by submit() when BACKGROUND_QUEUE_SIZE tasks are already queued or running"""
+
+
+def submit(task, *args):
+    """runs task(*args) on the background pool, raises QueueFull if the queue is full"""
+    if not slots.acquire(blocking=False):
+        raise QueueFull(f'{settings.BACKGROUND_QUEUE_SIZE} background tasks are already queued')
+    try:
+        future = executor.submit(run_task, task, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda future: slots.release())
+    return future
+
+
+def queue_depth():
+    """returns the number of tasks waiting for a free worker"""
+    # the executor has no public way to tell
+    return executor._work_queue.qsize()
+
+
+def run_task(task, *args):
+    logger = helper.setup_logger('background_tasks', f'logs/{current_date}/background_tasks.log')
+    try:
+        return task(*args)
+    except Exception as e:
+        logger.error(f'{task.__name__}{args}: {e}')
+        raise
+    finally:
+        # the task ran on a pool thread, which has its own database connection
+        connection.close()
+
+
+def requery_unpaid_cheque(pk):
+    """
+    runs an unpaid cheque that was not unpaid through the query_cc and unpay_cheque web services again
+    and stores the new outcome on the row
+    """
+    unpaid_cheque = UnpaidCheque.objects.get(pk=pk)
+    if unpaid_cheque.is_unpaid:
+        return unpaid_cheque
+
+    result = helper.process_unpay_request(helper.parse_raw_string(unpaid_cheque.raw_string))
+    if 'error' in result:
+        unpaid_cheque.unpay_error_message = result['error'][:100]
+        unpaid_cheque.save(update_fields=['unpay_error_message'])
+        return unpaid_cheque
+
+    fields = ['is_unpaid', 'unpaid_value_date', 'cc_record', 'unpay_success_indicator', 'unpay_error_message',
+              'cheque_account', 'co_code']
+    for field in fields:
+        if field in result:
+            setattr(unpaid_cheque, field, result[field])
+    unpaid_cheque.save(update_fields=[field for field in fields if field in result])
+    return unpaid_cheque
+
+
+def build_charge(unpaid_cheque):
+    """
+    calls the unpaid_charge web service for the account of an unpaid cheque and returns an unsaved
+    Charge with the outcome, or None if the web service call failed
+    """
+    response = helper.create_charge_soap_request(unpaid_cheque.cheque_account, unpaid_cheque.co_code)
+    if 'error' in response:
+        return None
+
+    return Charge(
+        charge_id=response['charge_id'],
+        charge_account=response['charge_account'],
+        charge_amount=response['charge_amount'],
+        charge_value_date=response['charge_value_date'],
+        charge_success_indicator=response['charge_success_indicator'],
+        ofs_id=response['ofs_id'],
+        ft_ref=unpaid_cheque.ft_ref,
+        is_collected=response['charge_success_indicator'] == 'Success',
+        cc_record=unpaid_cheque,
+        owner_id=unpaid_cheque.owner_id,
+    )
+
+
+def attempt_charge(pk):
+    """
+    charges an unpaid cheque unless it is not unpaid, a charge has already been collected for it or
+    another path (the collection sweep, the charges API) holds a claim on it
+    """
+    claimed_by = new_claimer('admin')
+    claimed = claim_unpaid_cheques([pk], claimed_by, settings.CHARGE_COLLECTION['CLAIM_TTL'])
+    if not claimed:
+        return None
+
+    try:
+        charge = build_charge(claimed[0])
+    except Exception:
+        # T24 did not answer, the cheque can be tried again right away
+        release_claim(claimed[0], claimed_by)
+        raise
+    if charge is None:
+        # the web service call failed, nothing was charged
+        release_claim(claimed[0], claimed_by)
+    else:
+        try:
+            persist(charge)
+        except Exception:
+            # the charge was made in T24, keep the cheque from being charged again
+            hold_claims([charge], helper.setup_logger('background_tasks', f'logs/{current_date}/background_tasks.log'))
+            raise
+        if not charge.is_collected:
+            # T24 answered that nothing was collected, the cheque can be tried again right away
+            release_claim(claimed[0], claimed_by)
+    return charge
@@ -1,3 +1,1092 @@
-from django.test import TestCase
+import cProfile
+import dataclasses
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
 
-# Create your tests here.
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from io import StringIO
+from datetime import date, timedelta
+from unittest import mock
+from cheque_unpay.env import Env, to_bool
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache.backends.redis import RedisCache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import call_command
+from django.db import DatabaseError, OperationalError, connection
+from django.db.migrations.loader import MigrationLoader
+from django.db.models.signals import post_save
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from lxml import etree
+from rest_framework.test import APIClient
+from .models import UnpaidCheque, Charge, ServiceToken, WebhookSubscription, WebhookEvent
+from . import (authentication, batching, benchmarks, cassettes, claims, collection, health, helpers, ingestion,
+               profiling, t24, tasks, throttling, transports, views, warmup, webhooks)
+
+
+class MigrationsTests(TestCase):
+
+    def test_models_match_migrations(self):
+        # fails when a model change was made without its migration
+        call_command('makemigrations', 'unpay_cheque', '--check', '--dry-run', stdout=StringIO())
+
+
+class MigrationHistoryTests(TransactionTestCase):
+
+    def test_every_migration_applies_and_reverses_in_order(self):
+        graph = MigrationLoader(connection).graph
+        names = [name for app, name in graph.forwards_plan(graph.leaf_nodes('unpay_cheque')[0])
+                 if app == 'unpay_cheque']
+        self.assertEqual(len(names), len(set(names)))
+        try:
+            call_command('migrate', 'unpay_cheque', 'zero', verbosity=0)
+            for name in names:
+                call_command('migrate', 'unpay_cheque', name, verbosity=0)
+            for name in reversed(names[:-1]):
+                call_command('migrate', 'unpay_cheque', name, verbosity=0)
+        finally:
+            call_command('migrate', 'unpay_cheque', verbosity=0)
+
+
+class BackgroundTasksTests(SimpleTestCase):
+
+    def test_submit_rejects_work_when_the_queue_is_full(self):
+        release = threading.Event()
+        saved = tasks.slots
+        tasks.slots = threading.BoundedSemaphore(2)
+        try:
+            futures = [tasks.submit(release.wait) for _ in range(2)]
+            with self.assertRaises(tasks.QueueFull):
+                tasks.submit(release.wait)
+            release.set()
+            for future in futures:
+                future.result(timeout=5)
+            # the slots of finished tasks are given back
+            tasks.submit(lambda: None).result(timeout=5)
+        finally:
+            release.set()
+            tasks.slots = saved
+
+
+class EnvTests(SimpleTestCase):
+
+    def load(self, environ, dotenv=''):
+        """loads Env with only environ set and dotenv as the test.env of the working directory"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'test.env'), 'w') as f:
+            f.write(dotenv)
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            with mock.patch.dict(os.environ, environ, clear=True):
+                return Env.load()
+        finally:
+            os.chdir(cwd)
+
+    def test_defaults_are_parsed(self):
+        env = self.load({})
+        self.assertIsNone(env.secret_key)
+        self.assertIs(env.api_only_mode, False)
+        self.assertEqual(env.t24_pool_max_queue, 16)
+        self.assertEqual(env.t24_companies, {})
+        self.assertEqual(env.t24_record_mask_elements, ['CREDITACCNO', 'DEBITACCOUNT', 'TXNID', 'criteriaValue'])
+
+    def test_values_are_parsed(self):
+        env = self.load({'API_ONLY_MODE': 'yes', 'T24_POOL_QUEUE_TIMEOUT': '2.5',
+                         'T24_COMPANIES': '{"KE0010002": {"max_concurrency": 2}}', 'T24_RECORD_MASK_ELEMENTS': 'A, B,'})
+        self.assertIs(env.api_only_mode, True)
+        self.assertEqual(env.t24_pool_queue_timeout, 2.5)
+        self.assertEqual(env.t24_companies, {'KE0010002': {'max_concurrency': 2}})
+        self.assertEqual(env.t24_record_mask_elements, ['A', 'B'])
+
+    def test_the_environment_wins_over_the_dotenv_file(self):
+        env = self.load({'TWS_CO': 'KE0010002'}, 'TWS_CO=KE0010001\nTWS_USER=inputter\n')
+        self.assertEqual(env.tws_co_code, 'KE0010002')
+        self.assertEqual(env.tws_user, 'inputter')
+
+    def test_booleans(self):
+        for value in ('True', 'true', 'TRUE', '1', 'yes', ' on '):
+            self.assertIs(to_bool(value), True, value)
+        for value in ('False', 'false', '0', 'no', 'off', ''):
+            self.assertIs(to_bool(value), False, value)
+        with self.assertRaisesRegex(ValueError, 'WRITE_BEHIND_ENABLED'):
+            self.load({'WRITE_BEHIND_ENABLED': 'ture'})
+
+
+class WarmupTests(SimpleTestCase):
+
+    def test_failures_are_logged_and_do_not_stop_the_process(self):
+        logger = mock.Mock()
+        with mock.patch.object(warmup.helper, 'setup_logger', return_value=logger), \
+                mock.patch.object(warmup.router, 'wsdl', return_value='http://t24.invalid/service?wsdl'), \
+                mock.patch.object(warmup.router, 'client', side_effect=ConnectionError('unreachable')), \
+                mock.patch.object(warmup, 'connection') as connection:
+            connection.ensure_connection.side_effect = OperationalError('no database')
+            warmup.run()
+
+        errors = [c.args[0] for c in logger.error.call_args_list]
+        self.assertTrue(any('loading the query_cc WSDL' in error for error in errors))
+        self.assertIn('warm-up: connecting to the database: no database', errors)
+        # the connection is not left open for the forked workers
+        connection.close.assert_called_once_with()
+        self.assertIn('warm-up done', logger.info.call_args.args[0])
+
+
+class ClaimTestsBase:
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', password='owner')
+
+    def unpaid_cheque(self, n, **fields):
+        unpaid_cheque = self.new_unpaid_cheque(n, **fields)
+        unpaid_cheque.save()
+        return unpaid_cheque
+
+    def new_unpaid_cheque(self, n, **fields):
+        values = dict(raw_string=f'09-{n:06d}-01-1000.00-20220201-FT22032TEST{n}', voucher_code='09',
+                      cheque_number=f'{n:06d}', reason_code='01', cheque_amount='1000.00',
+                      cheque_value_date=date(2022, 2, 1), ft_ref=f'FT22032TEST{n}', is_unpaid=True,
+                      cheque_account=f'0100{n:06d}', owner=self.owner)
+        values.update(fields)
+        return UnpaidCheque(**values)
+
+    def charge(self, unpaid_cheque, is_collected):
+        return Charge.objects.create(charge_id=f'CHG{unpaid_cheque.pk}', charge_account=unpaid_cheque.cheque_account,
+                                     charge_amount='500.00', charge_value_date=date(2022, 2, 1),
+                                     is_collected=is_collected, cc_record=unpaid_cheque, owner=self.owner)
+
+    def collection_run(self, **options):
+        values = dict(max_per_run=1000, rate=0, concurrency=2, batch_size=5, claim_ttl=3600)
+        values.update(options)
+        return collection.ChargeCollectionRun(**values)
+
+
+class OutstandingUnpaidChequesTests(ClaimTestsBase, TestCase):
+
+    def test_only_unpaid_cheques_with_an_account_and_no_collected_charge(self):
+        outstanding = self.unpaid_cheque(1)
+        with_failed_charge = self.unpaid_cheque(2)
+        self.charge(with_failed_charge, is_collected=False)
+        collected = self.unpaid_cheque(3)
+        self.charge(collected, is_collected=True)
+        self.unpaid_cheque(4, is_unpaid=False)
+        self.unpaid_cheque(5, cheque_account=None)
+        self.unpaid_cheque(6, cheque_account='')
+
+        self.assertEqual(set(claims.outstanding_unpaid_cheques()), {outstanding, with_failed_charge})
+
+
+class ClaimTests(ClaimTestsBase, TestCase):
+
+    def test_a_claim_is_not_taken_over_until_it_expires(self):
+        unpaid_cheque = self.unpaid_cheque(1)
+        self.assertEqual(claims.claim_unpaid_cheques([unpaid_cheque.pk], 'first', 3600), [unpaid_cheque])
+        self.assertEqual(claims.claim_unpaid_cheques([unpaid_cheque.pk], 'second', 3600), [])
+
+        UnpaidCheque.objects.update(charge_claimed_at=timezone.now() - timedelta(hours=2))
+        self.assertEqual(claims.claim_unpaid_cheques([unpaid_cheque.pk], 'second', 3600), [unpaid_cheque])
+
+    def test_the_claim_rechecks_that_no_charge_was_collected(self):
+        unpaid_cheque = self.unpaid_cheque(1)
+        self.charge(unpaid_cheque, is_collected=True)
+        self.assertEqual(claims.claim_unpaid_cheques([unpaid_cheque.pk], 'first', 0), [])
+
+    def test_held_claims_never_expire(self):
+        unpaid_cheque = self.unpaid_cheque(1)
+        UnpaidCheque.objects.update(charge_claimed_by=claims.HELD + 'x',
+                                    charge_claimed_at=timezone.now() - timedelta(days=30))
+        self.assertEqual(claims.claim_unpaid_cheques([unpaid_cheque.pk], 'first', 60), [])
+        self.assertEqual(self.collection_run(claim_ttl=60).claim(10), [])
+
+    def test_runs_claiming_at_the_same_time_get_disjoint_cheques(self):
+        cheques = [self.unpaid_cheque(n) for n in range(10)]
+        first, second = self.collection_run(), self.collection_run()
+        taken_by_second = []
+        claim = claims.claim_unpaid_cheques
+
+        # the second run claims between the first run's candidate query and its UPDATE
+        def interleaved(pks, claimed_by, claim_ttl):
+            if claimed_by == first.run_id:
+                taken_by_second.extend(second.claim(10))
+            return claim(pks, claimed_by, claim_ttl)
+
+        with mock.patch.object(collection, 'claim_unpaid_cheques', interleaved):
+            taken_by_first = first.claim(10)
+
+        self.assertEqual(len(taken_by_second), 10)
+        self.assertEqual(taken_by_first, [])
+        self.assertEqual(set(taken_by_second), set(cheques))
+
+    def test_a_run_does_not_retry_its_own_failed_cheques(self):
+        self.unpaid_cheque(1)
+        run = self.collection_run(claim_ttl=0)
+        self.assertEqual(len(run.claim(10)), 1)
+        self.assertEqual(run.claim(10), [])
+
+
+class ConcurrentClaimTests(ClaimTestsBase, TransactionTestCase):
+
+    def test_concurrent_runs_never_claim_the_same_cheque(self):
+        for n in range(40):
+            self.unpaid_cheque(n)
+        runs = [self.collection_run() for _ in range(4)]
+        claimed = {run.run_id: [] for run in runs}
+        barrier = threading.Barrier(len(runs))
+
+        def claim_all(run):
+            try:
+                barrier.wait()
+                while True:
+                    try:
+                        batch = run.claim(5)
+                    except OperationalError:
+                        # the in-memory SQLite test database locks whole tables, try again
+                        time.sleep(0.01)
+                        continue
+                    if not batch:
+                        break
+                    claimed[run.run_id].extend(unpaid_cheque.pk for unpaid_cheque in batch)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=claim_all, args=(run,)) for run in runs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        pks = [pk for run_pks in claimed.values() for pk in run_pks]
+        self.assertEqual(len(pks), len(set(pks)))
+        self.assertEqual(len(pks), 40)
+
+
+class ChargePathTests(ClaimTestsBase, TestCase):
+
+    def charge_response(self, account, success='Success'):
+        return {'charge_id': 'CHG1', 'charge_account': account, 'charge_amount': '500.00',
+                'charge_value_date': '2022-02-01', 'charge_success_indicator': success, 'ofs_id': 'OFS1'}
+
+    def test_admin_charge_skips_a_cheque_claimed_by_the_sweep(self):
+        unpaid_cheque = self.unpaid_cheque(1)
+        self.collection_run().claim(10)
+        with mock.patch.object(tasks.helper, 'create_charge_soap_request') as charge:
+            self.assertIsNone(tasks.attempt_charge(unpaid_cheque.pk))
+        charge.assert_not_called()
+
+    def test_charges_api_refuses_a_cheque_claimed_by_the_sweep(self):
+        unpaid_cheque = self.unpaid_cheque(1)
+        self.collection_run().claim(10)
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        with mock.patch.object(views.helper, 'create_charge_soap_request') as charge:
+            response = client.post('/charges/', {'ft_ref': unpaid_cheque.ft_ref,
+                                                 'charge_account': unpaid_cheque.cheque_account})
+        self.assertEqual(response.status_code, 409)
+        charge.assert_not_called()
+
+    def test_charges_api_releases_the_claim_when_t24_fails(self):
+        unpaid_cheque = self.unpaid_cheque(1)
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        data = {'ft_ref': unpaid_cheque.ft_ref, 'charge_account': unpaid_cheque.cheque_account}
+        with mock.patch.object(views.helper, 'create_charge_soap_request',
+                               return_value={'error': 'T24 is busy for company KE0010001, try again later'}):
+            self.assertEqual(client.post('/charges/', data).status_code, 400)
+        with mock.patch.object(views.helper, 'create_charge_soap_request', side_effect=ConnectionError('reset')):
+            self.assertEqual(client.post('/charges/', data).status_code, 400)
+        with mock.patch.object(views.helper, 'create_charge_soap_request',
+                               return_value=self.charge_response(unpaid_cheque.cheque_account)):
+            response = client.post('/charges/', data)
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Charge.objects.get().is_collected)
+
+    def test_admin_charge_releases_the_claim_when_t24_fails(self):
+        unpaid_cheque = self.unpaid_cheque(1)
+        with mock.patch.object(tasks.helper, 'create_charge_soap_request', return_value={'error': 'busy'}):
+            self.assertIsNone(tasks.attempt_charge(unpaid_cheque.pk))
+        with mock.patch.object(tasks.helper, 'create_charge_soap_request', side_effect=ConnectionError('reset')):
+            with self.assertRaises(ConnectionError):
+                tasks.attempt_charge(unpaid_cheque.pk)
+        with mock.patch.object(tasks.helper, 'create_charge_soap_request',
+                               return_value=self.charge_response(unpaid_cheque.cheque_account)):
+            self.assertTrue(tasks.attempt_charge(unpaid_cheque.pk).is_collected)
+
+    def test_sweep_stores_charges_one_by_one_when_the_batch_insert_fails(self):
+        cheques = [self.unpaid_cheque(n) for n in range(3)]
+        responses = {unpaid_cheque.cheque_account: self.charge_response(unpaid_cheque.cheque_account)
+                     for unpaid_cheque in cheques}
+        responses[cheques[1].cheque_account]['charge_amount'] = 'not a number'
+
+        with mock.patch.object(tasks.helper, 'create_charge_soap_request', side_effect=responses.get), \
+                mock.patch.object(collection, 'bulk_persist', side_effect=DatabaseError('batch failed')):
+            summary = self.collection_run().run()
+
+        self.assertEqual(summary['collected'], 3)
+        self.assertEqual(summary['unrecorded'], 1)
+        self.assertEqual(Charge.objects.count(), 2)
+        # the cheque charged in T24 without a stored charge is held, no later run charges it again
+        held = UnpaidCheque.objects.get(pk=cheques[1].pk)
+        self.assertTrue(held.charge_claimed_by.startswith(claims.HELD))
+        self.assertEqual(self.collection_run(claim_ttl=0).claim(10), [])
+
+
+class CounterStoreTests:
+    """the same cases for the local and the redis counters, store() returns an empty store"""
+
+    def test_buckets_are_taken_from_together_or_not_at_all(self):
+        store = self.store()
+        buckets = [('test:owner', 1, 2), ('test:global', 1, 3)]
+        self.assertEqual(store.take_tokens(buckets), 0)
+        self.assertEqual(store.take_tokens(buckets), 0)
+        wait = store.take_tokens(buckets)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 1)
+        # the rejected request did not spend the global bucket's last token
+        self.assertEqual(store.take_tokens([('test:global', 1, 3)]), 0)
+
+    def test_buckets_refill_over_time(self):
+        store = self.store()
+        buckets = [('test:owner', 100, 1)]
+        self.assertEqual(store.take_tokens(buckets), 0)
+        self.assertGreater(store.take_tokens(buckets), 0)
+        time.sleep(0.05)
+        self.assertEqual(store.take_tokens(buckets), 0)
+
+    def test_slots_are_limited_and_released(self):
+        store = self.store()
+        self.assertTrue(store.acquire_slot('test:slot', 2))
+        self.assertTrue(store.acquire_slot('test:slot', 2))
+        self.assertFalse(store.acquire_slot('test:slot', 2))
+        store.release_slot('test:slot')
+        self.assertTrue(store.acquire_slot('test:slot', 2))
+
+
+class LocalCounterStoreTests(CounterStoreTests, SimpleTestCase):
+
+    def store(self):
+        return throttling.LocalCounterStore()
+
+
+@unittest.skipUnless(os.getenv('TEST_REDIS_URL'), 'set TEST_REDIS_URL to run the redis counter tests')
+class CacheCounterStoreTests(CounterStoreTests, SimpleTestCase):
+
+    def store(self):
+        cache = RedisCache(os.getenv('TEST_REDIS_URL'), {'KEY_PREFIX': f'test-{os.getpid()}-{time.time()}'})
+        return throttling.CacheCounterStore(cache)
+
+
+@override_settings(ADMISSION_CONTROL={'OWNER_RATE': 0.001, 'OWNER_BURST': 1, 'GLOBAL_RATE': 0.001,
+                                      'GLOBAL_BURST': 2, 'OWNER_MAX_IN_FLIGHT': 1})
+class AdmissionControlThrottleTests(SimpleTestCase):
+
+    def setUp(self):
+        self.store = throttling.LocalCounterStore()
+        patcher = mock.patch.object(throttling.store, 'local', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(throttling.store, 'shared', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, address):
+        request = RequestFactory().post('/charges/', REMOTE_ADDR=address)
+        request.user = None
+        return request
+
+    def allow(self, request):
+        return throttling.AdmissionControlThrottle().allow_request(request, None)
+
+    def test_a_request_over_the_in_flight_limit_spends_no_token(self):
+        first = self.request('10.0.0.1')
+        self.assertTrue(self.allow(first))
+        self.assertFalse(self.allow(self.request('10.0.0.1')))
+        # the rejected request left the global bucket's second token for another client
+        self.assertTrue(self.allow(self.request('10.0.0.2')))
+
+    def test_a_request_rejected_by_a_bucket_keeps_no_slot(self):
+        request = self.request('10.0.0.1')
+        self.assertTrue(self.allow(request))
+        throttling.store.release_slot(request.admission_slot)
+        self.assertFalse(self.allow(self.request('10.0.0.1')))
+        self.assertNotIn('admission:in_flight:addr-10.0.0.1', self.store._slots)
+
+
+class ApiOnlyMiddlewareTests(SimpleTestCase):
+
+    def test_api_only_stack_swaps_each_browser_middleware_in_place(self):
+        self.assertEqual(len(settings.API_ONLY_MIDDLEWARE), len(settings.FULL_MIDDLEWARE))
+        for full, api_only in zip(settings.FULL_MIDDLEWARE, settings.API_ONLY_MIDDLEWARE):
+            self.assertEqual(api_only, settings.BROWSER_ONLY_MIDDLEWARE.get(full, full))
+            self.assertTrue(issubclass(import_string(api_only), import_string(full)))
+
+
+class ServiceTokenAuthenticationTests(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user('service', password='service')
+        self.token, self.key = ServiceToken.generate(self.owner, 'collector')
+        authentication.token_cache.clear()
+        self.addCleanup(authentication.token_cache.clear)
+        self.authentication = authentication.ServiceTokenAuthentication()
+
+    def get(self, key):
+        client = APIClient()
+        return client.get('/webhooks/', HTTP_AUTHORIZATION=f'Token {key}')
+
+    def test_a_valid_token_authenticates(self):
+        self.assertEqual(self.get(self.key).status_code, 200)
+        user, _ = self.authentication.authenticate_credentials(self.key)
+        self.assertEqual((user.pk, user.username), (self.owner.pk, 'service'))
+
+    def test_unknown_and_inactive_tokens_and_owners_are_refused(self):
+        self.assertEqual(self.get('not-a-token').status_code, 401)
+        ServiceToken.objects.filter(pk=self.token.pk).update(is_active=False)
+        self.assertEqual(self.get(self.key).status_code, 401)
+        ServiceToken.objects.filter(pk=self.token.pk).update(is_active=True)
+        User.objects.filter(pk=self.owner.pk).update(is_active=False)
+        self.assertEqual(self.get(self.key).status_code, 401)
+
+    def test_repeated_calls_within_the_ttl_run_no_query(self):
+        first, _ = self.authentication.authenticate_credentials(self.key)
+        with self.assertNumQueries(0):
+            second, _ = self.authentication.authenticate_credentials(self.key)
+        # every request gets its own user
+        self.assertIsNot(first, second)
+        self.assertEqual(first, second)
+
+    @override_settings(MIDDLEWARE=settings.API_ONLY_MIDDLEWARE)
+    def test_api_only_mode_refuses_sessions_on_the_api_but_not_in_the_admin(self):
+        User.objects.filter(pk=self.owner.pk).update(is_staff=True, is_superuser=True)
+        client = APIClient()
+        client.force_login(self.owner)
+        self.assertEqual(client.get('/webhooks/').status_code, 401)
+        self.assertEqual(client.get('/admin/').status_code, 200)
+        self.assertEqual(client.get('/webhooks/', HTTP_AUTHORIZATION=f'Token {self.key}').status_code, 200)
+
+
+class SamplingProfilerMiddlewareTests(SimpleTestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def middleware(self, **config):
+        profiling_settings = {**settings.PROFILING, 'SAMPLE_RATE': 0, 'HEADER_TOKEN': 'token',
+                              'OUTPUT_DIR': self.output_dir, **config}
+        with override_settings(PROFILING=profiling_settings):
+            return profiling.SamplingProfilerMiddleware(lambda request: sorted(range(100)))
+
+    def request(self, path='/unpaids/1/', method='get', view_name='unpaidcheque-detail', token=None):
+        headers = {'HTTP_X_PROFILE': token} if token else {}
+        request = getattr(RequestFactory(), method)(path, **headers)
+        request.resolver_match = mock.Mock(view_name=view_name)
+        return request
+
+    def endpoints(self):
+        return sorted(os.listdir(self.output_dir))
+
+    def test_it_is_not_used_without_a_sample_rate_or_a_token(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            self.middleware(HEADER_TOKEN=None)
+
+    def test_only_the_right_token_forces_a_profile(self):
+        middleware = self.middleware()
+        middleware(self.request(token='wrong'))
+        self.assertEqual(self.endpoints(), [])
+        middleware(self.request(token='token'))
+        self.assertEqual(self.endpoints(), ['unpaidcheque-detail.GET'])
+
+    def test_paths_outside_the_prefixes_are_never_profiled(self):
+        middleware = self.middleware(SAMPLE_RATE=1)
+        middleware(self.request(path='/admin/', token='token'))
+        self.assertEqual(self.endpoints(), [])
+
+    def test_profiles_are_aggregated_per_view_and_method(self):
+        middleware = self.middleware(SAMPLE_RATE=1)
+        middleware(self.request(path='/unpaids/1/'))
+        middleware(self.request(path='/unpaids/2/'))
+        middleware(self.request(path='/unpaids/', method='post', view_name='unpaidcheque-list'))
+        self.assertEqual(self.endpoints(), ['unpaidcheque-detail.GET', 'unpaidcheque-list.POST'])
+        self.assertEqual(os.listdir(os.path.join(self.output_dir, 'unpaidcheque-detail.GET')), [f'{os.getpid()}.prof'])
+        self.assertEqual(middleware.stats['unpaidcheque-detail.GET'].total_calls,
+                         2 * middleware.stats['unpaidcheque-list.POST'].total_calls)
+
+    def test_the_files_of_every_worker_are_merged(self):
+        middleware = self.middleware(SAMPLE_RATE=1)
+        middleware(self.request())
+        own = middleware.stats['unpaidcheque-detail.GET'].total_calls
+        # the profile of another worker process
+        profiler = cProfile.Profile()
+        profiler.runcall(sorted, range(100))
+        profiler.dump_stats(os.path.join(self.output_dir, 'unpaidcheque-detail.GET', '1.prof'))
+        other = profiling.pstats.Stats(profiler).total_calls
+
+        profiles = profiling.load_profiles(self.output_dir)
+        self.assertEqual(list(profiles), ['unpaidcheque-detail.GET'])
+        self.assertEqual(profiles['unpaidcheque-detail.GET'].total_calls, own + other)
+        self.assertEqual(profiling.load_profiles(self.output_dir, 'unpaidcheque-list.POST'), {})
+
+        out = StringIO()
+        call_command('profile_report', dir=self.output_dir, stdout=out)
+        self.assertIn(f'unpaidcheque-detail.GET ({own + other} calls', out.getvalue())
+
+
+class DropFolderIngesterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.lines = [f'09-{n:06d}-01-1000.00-20220201-FT22032TEST{n}' for n in range(4)]
+        self.path = os.path.join(self.directory, 'returns.txt')
+        with open(self.path, 'w') as f:
+            f.write(''.join(line + '\n' for line in self.lines))
+        self.offsets = [sum(len(line) + 1 for line in self.lines[:n]) for n in range(len(self.lines))]
+        self.ingester = ingestion.DropFolderIngester(self.directory, User(username='owner'), concurrency=2)
+
+    def ingest(self):
+        sent = []
+
+        def unpay(request_dict):
+            sent.append(request_dict['raw_string'])
+            return {**request_dict, 'is_unpaid': True}
+
+        with mock.patch.object(ingestion.helper, 'process_unpay_request', side_effect=unpay), \
+                mock.patch.object(ingestion, 'persist'):
+            summary = self.ingester.ingest_file(self.path)
+        return summary, sent
+
+    def test_resume_skips_finished_lines_and_does_not_resend_interrupted_ones(self):
+        # a worker died with the checkpoint at line 1: line 1 was in T24, line 2 had its outcome
+        checkpoint = ingestion.Checkpoint(self.ingester.state_dir, self.path)
+        checkpoint.advance(self.offsets[1])
+        checkpoint.start(self.offsets[1])
+        checkpoint.start(self.offsets[2])
+        checkpoint.record({'offset': self.offsets[2], 'raw_string': self.lines[2], 'status': ingestion.UNPAID})
+
+        summary, sent = self.ingest()
+
+        self.assertEqual(sent, [self.lines[3]])
+        self.assertEqual(summary['lines'], 3)
+        self.assertEqual(summary['counts'], {ingestion.UNPAID: 2, ingestion.INTERRUPTED: 1})
+        self.assertEqual([line['offset'] for line in summary['failed_lines']], [self.offsets[1]])
+        self.assertTrue(os.path.exists(os.path.join(self.ingester.failed_dir, 'returns.txt')))
+
+    def test_every_line_is_sent_once(self):
+        summary, sent = self.ingest()
+
+        self.assertEqual(sent, self.lines)
+        self.assertEqual(summary['counts'], {ingestion.UNPAID: 4})
+        self.assertTrue(os.path.exists(os.path.join(self.ingester.done_dir, 'returns.txt')))
+
+    def test_only_offsets_past_the_checkpoint_are_kept(self):
+        checkpoint = ingestion.Checkpoint(self.ingester.state_dir, self.path)
+        for offset in self.offsets:
+            checkpoint.record({'offset': offset, 'status': ingestion.UNPAID})
+        checkpoint.advance(self.offsets[2])
+        self.assertEqual(checkpoint.finished, set(self.offsets[2:]))
+
+
+class CompanyRoutingTests(ClaimTestsBase, TestCase):
+
+    def test_charges_are_made_in_the_company_of_the_cc_record(self):
+        unpaid_cheque = self.unpaid_cheque(1, co_code='KE0010099')
+        with mock.patch.object(tasks.helper, 'create_charge_soap_request', return_value={'error': 'x'}) as charge:
+            tasks.build_charge(unpaid_cheque)
+        charge.assert_called_once_with(unpaid_cheque.cheque_account, 'KE0010099')
+
+    def test_charges_of_cheques_without_a_company_go_to_the_default_one(self):
+        with mock.patch.object(helpers.router, 'client'), mock.patch.object(helpers.router, 'credentials'), \
+                mock.patch.object(helpers.router, 'call', side_effect=helpers.CompanyBusy('busy')) as call:
+            helpers.Helpers().create_charge_soap_request('0100000001')
+            helpers.Helpers().create_charge_soap_request('0100000001', 'KE0010099')
+        self.assertEqual([c.args[2] for c in call.call_args_list], [helpers.tws_co_code, 'KE0010099'])
+
+    def cc_record(self, company):
+        return {'CBLCHQCOLType': [{'gCBLCHQCOLDetailType': {'mCBLCHQCOLDetailType': [
+            {'ID': 'CC1', 'COCODE': company}]}}]}
+
+    def test_busy_companies_are_reported_by_every_call(self):
+        busy = helpers.CompanyBusy('busy')
+        with mock.patch.object(helpers.router, 'client'), mock.patch.object(helpers.router, 'credentials'), \
+                mock.patch.object(helpers.router, 'call', side_effect=busy):
+            query = helpers.Helpers().create_query_soap_request({'ft_ref': 'FT1'})
+            unpay = helpers.Helpers().create_unpay_soap_request(self.cc_record('KE0010099'))
+            charge = helpers.Helpers().create_charge_soap_request('0100000001', 'KE0010098')
+        self.assertEqual(query, {'error': f'T24 is busy for company {helpers.tws_co_code}, try again later'})
+        self.assertEqual(unpay, {'error': 'T24 is busy for company KE0010099, try again later'})
+        self.assertEqual(charge, {'error': 'T24 is busy for company KE0010098, try again later'})
+
+
+class CompanyPoolTests(SimpleTestCase):
+
+    def hold(self, pool):
+        """takes a slot of pool in another thread and keeps it until the returned event is set"""
+        taken, done = threading.Event(), threading.Event()
+
+        def run():
+            with pool.slot():
+                taken.set()
+                done.wait()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        taken.wait()
+        self.addCleanup(thread.join)
+        self.addCleanup(done.set)
+        return done
+
+    def test_a_free_slot_is_taken_without_queueing(self):
+        pool = t24.CompanyPool('unpaid_charge', 'KE0010001', 2, 0, 1)
+        with pool.slot(), pool.slot():
+            self.assertEqual((pool.in_flight, pool.waiting), (2, 0))
+        self.assertEqual(pool.in_flight, 0)
+
+    def test_without_a_queue_a_full_pool_fails_at_once(self):
+        pool = t24.CompanyPool('unpaid_charge', 'KE0010001', 1, 0, 5)
+        self.hold(pool)
+        started = time.monotonic()
+        with self.assertRaisesRegex(t24.CompanyBusy, 'queued'):
+            with pool.slot():
+                pass
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_queued_callers_time_out(self):
+        pool = t24.CompanyPool('unpaid_charge', 'KE0010001', 1, 1, 0.05)
+        self.hold(pool)
+        with self.assertRaisesRegex(t24.CompanyBusy, 'timed out'):
+            with pool.slot():
+                pass
+        self.assertEqual(pool.waiting, 0)
+
+    def test_queued_callers_get_the_slot_once_it_is_freed(self):
+        pool = t24.CompanyPool('unpaid_charge', 'KE0010001', 1, 1, 5)
+        done = self.hold(pool)
+        threading.Timer(0.05, done.set).start()
+        with pool.slot():
+            self.assertEqual(pool.in_flight, 1)
+
+
+@override_settings(
+    T24_COMPANIES={'KE0010099': {'user': 'branch', 'unpay_cheque': 'http://branch/unpay?wsdl', 'max_concurrency': 1}},
+    T24_POOL={'MAX_CONCURRENCY': 4, 'MAX_QUEUE': 0, 'QUEUE_TIMEOUT': 1},
+)
+class T24RouterTests(SimpleTestCase):
+
+    def setUp(self):
+        wsdls = {'query_cc': 'http://default/query?wsdl', 'unpay_cheque': 'http://default/unpay?wsdl'}
+        self.router = t24.T24Router({'userName': 'default', 'password': 'secret'}, wsdls)
+
+    def test_companies_override_the_defaults(self):
+        self.assertEqual(self.router.credentials('KE0010099'),
+                         {'company': 'KE0010099', 'password': 'secret', 'userName': 'branch'})
+        self.assertEqual(self.router.credentials('KE0010001')['userName'], 'default')
+        self.assertEqual(self.router.wsdl('unpay_cheque', 'KE0010099'), 'http://branch/unpay?wsdl')
+        self.assertEqual(self.router.wsdl('query_cc', 'KE0010099'), 'http://default/query?wsdl')
+        self.assertEqual(self.router.pool('unpay_cheque', 'KE0010099').max_concurrency, 1)
+        self.assertEqual(self.router.pool('unpay_cheque', 'KE0010001').max_concurrency, 4)
+
+    def test_every_service_of_a_company_has_its_own_pool(self):
+        self.assertIs(self.router.pool('query_cc', 'KE0010001'), self.router.pool('query_cc', 'KE0010001'))
+        self.assertIsNot(self.router.pool('query_cc', 'KE0010001'), self.router.pool('unpay_cheque', 'KE0010001'))
+        self.assertEqual(set(self.router.pool_state()), {'query_cc@KE0010001', 'unpay_cheque@KE0010001'})
+
+    def test_calls_are_made_and_rejections_counted(self):
+        client = mock.Mock()
+        client.service.UnpayChequeWebService.return_value = 'ok'
+        self.assertEqual(self.router.call(client, 'unpay_cheque', 'KE0010099', 'UnpayChequeWebService', {'a': 1}), 'ok')
+        client.service.UnpayChequeWebService.assert_called_once_with(a=1)
+
+        with self.router.pool('unpay_cheque', 'KE0010099').slot():
+            with self.assertRaises(t24.CompanyBusy):
+                self.router.call(client, 'unpay_cheque', 'KE0010099', 'UnpayChequeWebService', {})
+            # the other services of the company are not held up
+            self.router.call(client, 'query_cc', 'KE0010099', 'UnpayChequeWebService', {})
+        stats = self.router.metrics.snapshot()['unpay_cheque']['KE0010099']
+        self.assertEqual((stats['calls'], stats['rejected']), (1, 1))
+
+
+def resolving_to(*addresses):
+    """a getaddrinfo that resolves every host to the given addresses"""
+    return lambda host, port, **kwargs: [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (address, port))
+                                         for address in addresses]
+
+
+@override_settings(WEBHOOKS={**settings.WEBHOOKS, 'ALLOW_LOCAL': False})
+class CallbackURLTests(SimpleTestCase):
+
+    def test_public_https_urls_are_allowed(self):
+        with mock.patch.object(webhooks.socket, 'getaddrinfo', resolving_to('93.184.216.34', '2606:2800:220:1::1')):
+            webhooks.check_callback_url('https://hooks.example.com/cheques')
+
+    def test_plain_http_is_refused(self):
+        with mock.patch.object(webhooks.socket, 'getaddrinfo', resolving_to('93.184.216.34')):
+            with self.assertRaises(webhooks.UnsafeCallbackURL):
+                webhooks.check_callback_url('http://hooks.example.com/cheques')
+
+    def test_internal_addresses_are_refused(self):
+        for address in ('169.254.169.254', '127.0.0.1', '10.1.2.3', '192.168.0.10', '172.16.0.1', '100.64.0.1',
+                        '0.0.0.0', '240.0.0.1', '::1', 'fe80::1%eth0', 'fd00::1', '::ffff:10.0.0.1'):
+            with self.subTest(address=address), \
+                    mock.patch.object(webhooks.socket, 'getaddrinfo', resolving_to('93.184.216.34', address)):
+                with self.assertRaises(webhooks.UnsafeCallbackURL):
+                    webhooks.check_callback_url('https://hooks.example.com/cheques')
+
+
+@override_settings(WEBHOOKS={**settings.WEBHOOKS, 'ALLOW_LOCAL': False})
+class WebhookSubscriptionTests(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', password='owner')
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        patcher = mock.patch.object(webhooks.socket, 'getaddrinfo', resolving_to('93.184.216.34'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_the_secret_is_only_returned_on_create(self):
+        response = self.client.post('/webhooks/', {'callback_url': 'https://hooks.example.com/cheques'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['secret'], WebhookSubscription.objects.get().secret)
+
+        self.assertNotIn('secret', self.client.get('/webhooks/').data['results'][0])
+        self.assertNotIn('secret', self.client.get(f"/webhooks/{response.data['id']}/").data)
+
+    def test_internal_callback_urls_are_refused(self):
+        with mock.patch.object(webhooks.socket, 'getaddrinfo', resolving_to('169.254.169.254')):
+            response = self.client.post('/webhooks/', {'callback_url': 'https://metadata.example.com/'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('callback_url', response.data)
+
+    def test_delivery_does_not_follow_redirects_or_post_to_internal_addresses(self):
+        subscription = WebhookSubscription.objects.create(callback_url='https://hooks.example.com/cheques',
+                                                          owner=self.owner)
+        webhooks.emit(self.owner.pk, 'unpay', {'ft_ref': 'FT1'})
+        deliverer = webhooks.WebhookDeliverer()
+        session = deliverer.session(subscription.callback_url)
+        with mock.patch.object(session, 'post', return_value=mock.Mock(status_code=302)) as post:
+            self.assertFalse(deliverer.post(subscription, list(WebhookEvent.objects.all())))
+        self.assertIs(post.call_args.kwargs['allow_redirects'], False)
+        self.assertEqual(WebhookEvent.objects.get().last_error, 'HTTP 302')
+
+        # the host now resolves to an internal address
+        with mock.patch.object(webhooks.socket, 'getaddrinfo', resolving_to('10.0.0.5')), \
+                mock.patch.object(session, 'post') as post:
+            self.assertFalse(deliverer.post(subscription, list(WebhookEvent.objects.all())))
+        post.assert_not_called()
+        self.assertEqual(WebhookEvent.objects.get().status, WebhookEvent.FAILED)
+
+
+class OutcomeEventTests(ClaimTestsBase, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        WebhookSubscription.objects.create(callback_url='https://hooks.example.com/cheques', owner=self.owner)
+
+    def events(self):
+        return [(event.event_type, event.payload) for event in WebhookEvent.objects.order_by('pk')]
+
+    def test_every_new_row_emits_an_event_failures_included(self):
+        unpaid_cheque = self.unpaid_cheque(1, is_unpaid=False, unpay_success_indicator='T24Error')
+        self.charge(self.unpaid_cheque(2), is_collected=False)
+        self.assertEqual([(event_type, payload.get('is_unpaid', payload.get('is_collected')))
+                          for event_type, payload in self.events()],
+                         [('unpaid_cheque.is_unpaid_changed', False), ('unpaid_cheque.is_unpaid_changed', True),
+                          ('charge.is_collected_changed', False)])
+        self.assertEqual(self.events()[0][1]['unpay_success_indicator'], 'T24Error')
+
+        # saving a row again only emits when its outcome changed
+        WebhookEvent.objects.all().delete()
+        unpaid_cheque.save()
+        self.assertEqual(self.events(), [])
+        unpaid_cheque.is_unpaid = True
+        unpaid_cheque.save()
+        self.assertEqual([payload['is_unpaid'] for _, payload in self.events()], [True])
+
+
+class WriteBehindBatcherTests(ClaimTestsBase, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.batcher = batching.WriteBehindBatcher(max_batch=10, max_wait=0.05)
+        self.addCleanup(self.batcher.stop, 5)
+
+    def test_concurrent_rows_are_committed_in_one_batch_with_post_save(self):
+        saved = []
+
+        def receiver(sender, instance, created, **kwargs):
+            saved.append((instance.pk, created))
+
+        post_save.connect(receiver, sender=UnpaidCheque)
+        self.addCleanup(post_save.disconnect, receiver, sender=UnpaidCheque)
+
+        futures = [self.batcher.submit(self.new_unpaid_cheque(n)) for n in range(5)]
+        for future in futures:
+            future.result(timeout=5)
+
+        self.assertEqual(self.batcher.commits, 1)
+        self.assertEqual(UnpaidCheque.objects.count(), 5)
+        self.assertEqual(sorted(saved), sorted((pk, True) for pk in UnpaidCheque.objects.values_list('pk', flat=True)))
+
+    def test_a_bad_row_only_fails_its_own_future(self):
+        good = self.new_unpaid_cheque(1)
+        bad = self.new_unpaid_cheque(2, cheque_amount='not a number')
+        futures = [self.batcher.submit(good), self.batcher.submit(bad), self.batcher.submit(self.new_unpaid_cheque(3))]
+
+        futures[0].result(timeout=5)
+        futures[2].result(timeout=5)
+        with self.assertRaises(Exception):
+            futures[1].result(timeout=5)
+        self.assertEqual(UnpaidCheque.objects.count(), 2)
+        self.assertEqual(self.batcher.commits, 0)
+
+    def test_stop_writes_what_is_queued_and_ends_the_thread(self):
+        future = self.batcher.submit(self.new_unpaid_cheque(1))
+        self.batcher.stop(5)
+        self.assertTrue(future.done())
+        self.assertFalse(self.batcher.thread.is_alive())
+        self.assertEqual(UnpaidCheque.objects.count(), 1)
+
+    def test_persist_waits_for_the_batch_at_most_the_timeout(self):
+        stuck = batching.WriteBehindBatcher(max_batch=10, max_wait=0.05)
+        with mock.patch.object(batching, 'batcher', stuck), mock.patch.object(stuck, 'submit', return_value=Future()), \
+                override_settings(WRITE_BEHIND={**settings.WRITE_BEHIND, 'ENABLED': True, 'TIMEOUT': 0.01}):
+            with self.assertRaises(FutureTimeoutError):
+                batching.persist(self.new_unpaid_cheque(1))
+
+
+# envelopes as zeep sends them and T24 answers them, the values are made up
+QUERY_CC_REQUEST = (
+    "<?xml version='1.0' encoding='utf-8'?>\n"
+    '<soap-env:Envelope xmlns:soap-env="http://schemas.xmlsoap.org/soap/envelope/"><soap-env:Body>'
+    '<ns0:GetCCWebService xmlns:ns0="http://temenos.com/CHEQUECOLLECTION"><WebRequestCommon>'
+    '<company>KE0010001</company><password>S3cret-2022</password><userName>TWSUSER1</userName></WebRequestCommon>'
+    '<CBLCHQCOLType><enquiryInputCollection><columnName>TXN.ID</columnName><criteriaValue>FT22032ABC31</criteriaValue>'
+    '<operand>EQ</operand></enquiryInputCollection></CBLCHQCOLType></ns0:GetCCWebService></soap-env:Body>'
+    '</soap-env:Envelope>'
+)
+QUERY_CC_RESPONSE = (
+    '<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/"><S:Body>'
+    '<ns10:GetCCWebServiceResponse xmlns:ns10="http://temenos.com/CHEQUECOLLECTION" '
+    'xmlns:ns4="http://temenos.com/CBLCHQCOL"><Status><successIndicator>Success</successIndicator></Status>'
+    '<CBLCHQCOLType><ns4:gCBLCHQCOLDetailType><ns4:mCBLCHQCOLDetailType><ns4:ID>CC2203200001</ns4:ID>'
+    '<ns4:TXNID>FT22032ABC31</ns4:TXNID><ns4:CREDITACCNO>01100234567800</ns4:CREDITACCNO>'
+    '<ns4:COCODE>KE0010001</ns4:COCODE></ns4:mCBLCHQCOLDetailType></ns4:gCBLCHQCOLDetailType></CBLCHQCOLType>'
+    '</ns10:GetCCWebServiceResponse></S:Body></S:Envelope>'
+)
+CHARGE_REQUEST = (
+    "<?xml version='1.0' encoding='utf-8'?>\n"
+    '<soap-env:Envelope xmlns:soap-env="http://schemas.xmlsoap.org/soap/envelope/"><soap-env:Body>'
+    '<ns0:InputUnpaidCharge xmlns:ns0="http://temenos.com/ACCHARGEREQUEST"><WebRequestCommon>'
+    '<company>KE0010001</company><password>S3cret-2022</password><userName>TWSUSER1</userName></WebRequestCommon>'
+    '<OfsFunction><gtsControl>0</gtsControl></OfsFunction><ACCHARGEREQUESTINUNPAIDType>'
+    '<DEBITACCOUNT>01100234567800</DEBITACCOUNT><CHARGEDETAIL>BENONLY</CHARGEDETAIL></ACCHARGEREQUESTINUNPAIDType>'
+    '</ns0:InputUnpaidCharge></soap-env:Body></soap-env:Envelope>'
+)
+
+
+def default_mask_elements():
+    field = next(field for field in dataclasses.fields(Env) if field.name == 't24_record_mask_elements')
+    return field.metadata['parse'](field.metadata['default'])
+
+
+@override_settings(SECRET_KEY='test', T24_TRAFFIC={**settings.T24_TRAFFIC, 'SECRET_ELEMENTS': ['userName', 'password'],
+                                                   'MASK_ELEMENTS': default_mask_elements()})
+class RedactXMLTests(SimpleTestCase):
+
+    def elements(self, xml):
+        """{local name: text} of the elements of an envelope"""
+        root = etree.fromstring(xml.encode())
+        return {etree.QName(element).localname: element.text for element in root.iter() if element.text}
+
+    def test_credentials_are_blanked_and_accounts_and_references_masked_by_default(self):
+        request = self.elements(cassettes.redact_xml(QUERY_CC_REQUEST))
+        response = self.elements(cassettes.redact_xml(QUERY_CC_RESPONSE))
+        charge = self.elements(cassettes.redact_xml(CHARGE_REQUEST))
+
+        self.assertEqual((request['userName'], request['password']), ('***', '***'))
+        self.assertEqual((charge['userName'], charge['password']), ('***', '***'))
+
+        # masked values keep their format and mask the same in every envelope
+        self.assertNotEqual(request['criteriaValue'], 'FT22032ABC31')
+        self.assertRegex(request['criteriaValue'], r'^FT\d{5}ABC\d{2}$')
+        self.assertEqual(response['TXNID'], request['criteriaValue'])
+        self.assertNotEqual(response['CREDITACCNO'], '01100234567800')
+        self.assertEqual(charge['DEBITACCOUNT'], response['CREDITACCNO'])
+
+        # the rest of the envelope, which replay needs, is untouched
+        self.assertEqual(response['COCODE'], 'KE0010001')
+        self.assertEqual(response['ID'], 'CC2203200001')
+        self.assertEqual(request['columnName'], 'TXN.ID')
+        self.assertEqual(charge['CHARGEDETAIL'], 'BENONLY')
+
+
+@override_settings(SECRET_KEY='test')
+class CassetteRoundTripTests(SimpleTestCase):
+
+    def setUp(self):
+        self.record_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.record_dir)
+        traffic = {**settings.T24_TRAFFIC, 'RECORD_DIR': self.record_dir, 'SECRET_ELEMENTS': ['userName', 'password'],
+                   'MASK_ELEMENTS': default_mask_elements()}
+        patcher = override_settings(T24_TRAFFIC=traffic)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        self.addCleanup(cassettes.recorder.close)
+        cassettes.recorder.close()
+
+    def t24_response(self, text):
+        response = transports.Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'text/xml; charset=utf-8'
+        response.encoding = 'utf-8'
+        response._content = text.encode('utf-8')
+        return response
+
+    def record(self):
+        transport = transports.RecordingTransport('query_cc')
+        with mock.patch.object(transports.Transport, 'load', return_value=b'<definitions/>'):
+            transport.load('http://t24/query?wsdl')
+        with mock.patch.object(transport, 'post', return_value=self.t24_response(QUERY_CC_RESPONSE)):
+            transport.post_xml('http://t24/query', etree.fromstring(QUERY_CC_REQUEST.encode()),
+                               {'SOAPAction': 'GetCCWebService'})
+        cassettes.recorder.record_request('charge', {'charge_account': '01100234567800'})
+        cassettes.recorder.close()
+
+    def test_recorded_traffic_is_replayed(self):
+        self.record()
+        cassette = cassettes.Cassette([self.record_dir])
+        self.assertEqual([entry['kind'] for entry in cassette.requests], ['charge'])
+        self.assertNotEqual(cassette.requests[0]['data']['charge_account'], '01100234567800')
+
+        router = t24.T24Router(helpers.router.default_credentials, {'query_cc': 'http://default/query?wsdl'})
+        with transports.replaying(router, cassette, latency_scale=0):
+            transport = router.transport('query_cc', router.wsdl('query_cc', helpers.tws_co_code))
+            self.assertIsInstance(transport, transports.ReplayTransport)
+            self.assertEqual(transport.load('http://t24/query?wsdl'), b'<definitions/>')
+            response = transport.post_xml('http://t24/query', etree.fromstring(QUERY_CC_REQUEST.encode()),
+                                          {'SOAPAction': 'GetCCWebService'})
+        self.assertEqual(router.transport, t24.default_transport)
+
+        # T24 is answered with the recorded response, redacted the same way as the request
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, cassettes.redact_xml(QUERY_CC_RESPONSE))
+        self.assertNotIn('01100234567800', response.text)
+        self.assertIn('<ns4:ID>CC2203200001</ns4:ID>', response.text)
+
+    def test_a_failing_redaction_does_not_fail_the_call(self):
+        with mock.patch.object(cassettes, 'redact_xml', side_effect=ValueError('bad pattern')), \
+                mock.patch.object(helpers.Helpers, 'setup_logger') as setup_logger:
+            self.record()
+        setup_logger.return_value.error.assert_called_once_with('recording T24 traffic: bad pattern')
+        cassette = cassettes.Cassette([self.record_dir])
+        self.assertEqual(cassette.calls, {})
+        self.assertEqual(len(cassette.requests), 1)
+
+    def test_the_comparison_flags_regressions(self):
+        options = {'latency_scale': 0, 'speed': 0, 'concurrency': 4, 'limit': None, 'tolerance': 10}
+        baseline = {'options': benchmarks.ReplayBenchmark().replay_options(options),
+                    'results': {'charge': {'throughput_per_s': 100.0, 'p99_ms': 20.0, 'errors': 0}}}
+        command = mock.Mock()
+        benchmarks.ReplayBenchmark().compare(
+            command, baseline, {'charge': {'throughput_per_s': 95.0, 'p99_ms': 21.0, 'errors': 0}}, options)
+        command.stdout.write.assert_called_once()
+
+        with self.assertRaisesRegex(benchmarks.CommandError, r'charge throughput 100.0/s -> 50.0/s; charge p99'):
+            benchmarks.ReplayBenchmark().compare(
+                command, baseline, {'charge': {'throughput_per_s': 50.0, 'p99_ms': 40.0, 'errors': 0}}, options)
+
+
+class HealthCheckerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.checker = health.HealthChecker(interval=3600, timeout=1, stale_after=60)
+        for patcher in (mock.patch.object(self.checker, 'ensure_thread'),
+                        mock.patch.object(views, 'checker', self.checker),
+                        mock.patch.object(health, 'connection')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = APIClient()
+
+    def refresh(self, database=True, t24=True):
+        with mock.patch.object(self.checker, 'check_database', return_value={'ok': database}), \
+                mock.patch.object(self.checker, 'check_t24', return_value={'ok': t24}):
+            self.checker.refresh()
+
+    def probe(self):
+        response = self.client.get('/health/ready')
+        # the probe only reads the outcome of the background checks
+        health.connection.cursor.assert_not_called()
+        return response
+
+    def test_starting_is_not_ready(self):
+        response = self.probe()
+        self.assertEqual((response.status_code, response.data), (503, {'status': 'starting'}))
+
+    def test_ready_when_every_check_passed(self):
+        self.refresh()
+        response = self.probe()
+        self.assertEqual((response.status_code, response.data['status']), (200, 'ready'))
+
+    def test_a_failed_check_makes_the_node_unready(self):
+        for database, t24 in ((False, True), (True, False)):
+            with self.subTest(database=database, t24=t24):
+                self.refresh(database, t24)
+                response = self.probe()
+                self.assertEqual((response.status_code, response.data['status']), (503, 'not ready'))
+
+    def test_a_stale_outcome_makes_the_node_unready(self):
+        self.refresh()
+        self.checker.checked_at -= 61
+        self.assertEqual(self.probe().status_code, 503)
+
+    def test_database_check(self):
+        self.assertEqual(self.checker.check_database(), {'ok': True})
+        health.connection.cursor.side_effect = OperationalError('too many connections')
+        self.assertEqual(self.checker.check_database(), {'ok': False, 'error': 'too many connections'})
+        # the connection is closed again either way
+        self.assertEqual(health.connection.close.call_count, 2)
+
+    def test_t24_check_reports_the_unreachable_services_but_not_their_urls(self):
+        def wsdl(service, company):
+            return 'http://down/unpay?wsdl' if service == 'unpay_cheque' else 'http://up/shared?wsdl'
+
+        def get(url, timeout):
+            if 'down' in url:
+                raise ConnectionError('refused')
+            return mock.Mock()
+
+        with mock.patch.object(health.router, 'wsdl', wsdl), mock.patch.object(self.checker.session, 'get', get), \
+                override_settings(T24_COMPANIES={}):
+            check = self.checker.check_t24()
+        self.assertEqual(check, {'ok': False, 'wsdls': 2, 'unreachable': [f'unpay_cheque@{health.tws_co_code}']})
+
+
+class HealthStateTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_closed_by_default(self):
+        with override_settings(HEALTH={**settings.HEALTH, 'STATE_TOKEN': '', 'STATE_PUBLIC': False}):
+            self.assertIn(self.client.get('/health/state').status_code, (401, 403))
+            self.client.force_authenticate(User.objects.create_user('client', password='client'))
+            self.assertEqual(self.client.get('/health/state').status_code, 403)
+
+    def test_open_to_the_token_and_staff(self):
+        with override_settings(HEALTH={**settings.HEALTH, 'STATE_TOKEN': 'lb-token', 'STATE_PUBLIC': False}):
+            self.assertEqual(self.client.get('/health/state', HTTP_X_HEALTH_TOKEN='lb-token').status_code, 200)
+            self.assertIn(self.client.get('/health/state', HTTP_X_HEALTH_TOKEN='wrong').status_code, (401, 403))
+            self.client.force_authenticate(User.objects.create_user('admin', password='admin', is_staff=True))
+            self.assertEqual(self.client.get('/health/state').status_code, 200)
+
+    def test_open_to_anyone_when_made_public(self):
+        with override_settings(HEALTH={**settings.HEALTH, 'STATE_TOKEN': '', 'STATE_PUBLIC': True}):
+            self.assertEqual(self.client.get('/health/state').status_code, 200)
@@ -0,0 +1,237 @@
+# admission control for the endpoints that end up calling T24
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+from rest_framework.throttling import BaseThrottle
+from .helpers import Helpers, current_date
+
+
+helper = Helpers()
+
+# alias of the cache that holds the counters shared between workers
+THROTTLE_CACHE_ALIAS = 'throttle'
+
+# a concurrency slot that is never released (e.g. a killed worker) expires after this many seconds
+SLOT_TIMEOUT = 300
+
+
+class LocalCounterStore:
+    """
+    In-memory counters for a single process. Used when no shared cache is configured
+    or when the shared cache cannot be reached.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._slots = {}
+
+    def take_tokens(self, buckets):
+        """
+        buckets is a list of (key, rate, burst):
+        - refill every bucket for the time elapsed since the last call
+        - if every bucket has a token, take one from each and return 0
+        - otherwise take none and return the number of seconds until every bucket has a token
+        """
+        now = time.monotonic()
+        with self._lock:
+            refilled = []
+            for key, rate, burst in buckets:
+                tokens, updated = self._buckets.get(key, (burst, now))
+                refilled.append((key, min(burst, tokens + (now - updated) * rate), rate))
+            wait = max((1 - tokens) / rate if tokens < 1 else 0 for key, tokens, rate in refilled)
+            for key, tokens, rate in refilled:
+                self._buckets[key] = (tokens if wait else tokens - 1, now)
+            return wait
+
+    def acquire_slot(self, key, limit):
+        with self._lock:
+            in_flight = self._slots.get(key, 0)
+            if in_flight >= limit:
+                return False
+            self._slots[key] = in_flight + 1
+            return True
+
+    def release_slot(self, key):
+        with self._lock:
+            in_flight = self._slots.get(key, 0)
+            if in_flight <= 1:
+                self._slots.pop(key, None)
+            else:
+                self._slots[key] = in_flight - 1
+
+
+# LocalCounterStore.take_tokens as one redis script, so that workers sharing a bucket never both take
+# its last token. buckets are hashes of tokens and the time of the last refill, by the redis clock.
+# the wait is returned as a string, redis truncates lua numbers to integers
+TAKE_TOKENS_SCRIPT = """
+-- TIME in a script that writes needs effects replication, the default from redis 5 on
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local refilled = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    refilled[i] = tokens
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    local tokens = refilled[i]
+    if wait == 0 then
+        tokens = tokens - 1
+    end
+    redis.call('HMSET', key, 'tokens', string.format('%.6f', tokens), 'updated', string.format('%.6f', now))
+    -- keep the bucket around for as long as it takes to refill completely
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return tostring(wait)
+"""
+
+
+class CacheCounterStore:
+    """
+    Counters kept in a shared django RedisCache so that every worker sees the same limits:
+    - buckets are refilled and taken from in one lua script (TAKE_TOKENS_SCRIPT), atomically
+    - concurrency slots rely on the atomic incr/decr of the backend
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._take_tokens = None
+
+    def take_tokens(self, buckets):
+        keys = [self.cache.make_key(key) for key, rate, burst in buckets]
+        client = self.cache._cache.get_client(keys[0], write=True)
+        if self._take_tokens is None:
+            self._take_tokens = client.register_script(TAKE_TOKENS_SCRIPT)
+        args = [value for key, rate, burst in buckets for value in (rate, burst)]
+        return float(self._take_tokens(keys=keys, args=args, client=client))
+
+    def acquire_slot(self, key, limit):
+        self.cache.add(key, 0, SLOT_TIMEOUT)
+        if self.cache.incr(key) > limit:
+            self.cache.decr(key)
+            return False
+        return True
+
+    def release_slot(self, key):
+        try:
+            self.cache.decr(key)
+        except ValueError:
+            # the slot expired while the request was in flight
+            pass
+
+
+class CounterStore:
+    """
+    Uses the shared cache when one is configured and falls back to the local in-memory
+    counters whenever the shared cache raises.
+    """
+
+    def __init__(self):
+        self.local = LocalCounterStore()
+        self.logger = helper.setup_logger('admission_control', f'logs/{current_date}/admission_control.log')
+        try:
+            self.shared = CacheCounterStore(caches[THROTTLE_CACHE_ALIAS])
+        except InvalidCacheBackendError:
+            self.shared = None
+
+    def _call(self, method, *args):
+        if self.shared is not None:
+            try:
+                return getattr(self.shared, method)(*args)
+            except Exception as e:
+                self.logger.warning('shared throttle store unavailable, using local counters: ' + str(e))
+        return getattr(self.local, method)(*args)
+
+    def take_tokens(self, buckets):
+        return self._call('take_tokens', buckets)
+
+    def acquire_slot(self, key, limit):
+        return self._call('acquire_slot', key, limit)
+
+    def release_slot(self, key):
+        return self._call('release_slot', key)
+
+
+store = CounterStore()
+
+
+class AdmissionControlThrottle(BaseThrottle):
+    """
+    Admits a request only if:
+    - the owner has fewer than OWNER_MAX_IN_FLIGHT requests in flight,
+    - the owner still has a token in their bucket and the global bucket still has a token.
+    The in-flight slot is taken first and given back if the buckets reject the request. Both buckets
+    are taken from together or not at all, so a rejected request spends no token and keeps no slot.
+    The acquired slot is released by AdmissionControlMixin.
+    """
+
+    def __init__(self):
+        self.config = settings.ADMISSION_CONTROL
+        self.wait_seconds = None
+
+    def get_ident(self, request):
+        # throttle authenticated clients per owner and anonymous clients per address
+        if request.user and request.user.is_authenticated:
+            return 'owner-' + str(request.user.pk)
+        return 'addr-' + super().get_ident(request)
+
+    def allow_request(self, request, view):
+        ident = self.get_ident(request)
+
+        slot = 'admission:in_flight:' + ident
+        if not store.acquire_slot(slot, self.config['OWNER_MAX_IN_FLIGHT']):
+            # there is no way to know when an in-flight T24 call will finish, ask for a short back-off
+            self.wait_seconds = 1
+            return False
+
+        wait = store.take_tokens([
+            ('admission:bucket:' + ident, self.config['OWNER_RATE'], self.config['OWNER_BURST']),
+            ('admission:bucket:global', self.config['GLOBAL_RATE'], self.config['GLOBAL_BURST']),
+        ])
+        if wait:
+            store.release_slot(slot)
+            self.wait_seconds = wait
+            return False
+
+        request.admission_slot = slot
+        return True
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class AdmissionControlMixin:
+    """
+    Applies AdmissionControlThrottle to the listed viewset actions. DRF checks throttles before
+    the handler runs, so a rejected request never parses its body or reaches T24 and is answered
+    with a 429 and a Retry-After header.
+    """
+    admission_controlled_actions = ('create',)
+
+    def get_throttles(self):
+        if self.action in self.admission_controlled_actions:
+            return [AdmissionControlThrottle()]
+        return super().get_throttles()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        # release the in-flight slot taken by the throttle (if any) once the handler is done
+        slot = getattr(request, 'admission_slot', None)
+        if slot is not None:
+            store.release_slot(slot)
+            request.admission_slot = None
+        return super().finalize_response(request, response, *args, **kwargs)
@@ -0,0 +1,80 @@
+# zeep transports that record T24 traffic to a cassette or serve it back from one
+import time
+
+from contextlib import contextmanager
+from requests import Response
+from zeep.transports import Transport
+from zeep.wsdl.utils import etree_to_string
+from .cassettes import recorder
+
+
+class RecordingTransport(Transport):
+    """a zeep transport that records the documents it loads and the calls it makes (see cassettes.py)"""
+
+    def __init__(self, service, **kwargs):
+        super().__init__(**kwargs)
+        self.service = service
+
+    def load(self, url):
+        content = super().load(url)
+        recorder.record_document(self.service, url, content)
+        return content
+
+    def post_xml(self, address, envelope, headers):
+        message = etree_to_string(envelope)
+        started = time.perf_counter()
+        response = self.post(address, message, headers)
+        recorder.record_call(self.service, address, headers.get('SOAPAction'), message.decode('utf-8'),
+                             response.status_code, response.headers.get('Content-Type'), response.text,
+                             time.perf_counter() - started)
+        return response
+
+
+class ReplayTransport(Transport):
+    """
+    A zeep transport that answers from a cassette instead of T24:
+    - documents are served by URL
+    - every call gets the next recorded response of the same SOAPAction, round robin, after sleeping
+      for the recorded latency times latency_scale (0 answers at once)
+    """
+
+    def __init__(self, cassette, latency_scale=1.0):
+        super().__init__()
+        self.cassette = cassette
+        self.latency_scale = latency_scale
+
+    def load(self, url):
+        try:
+            return self.cassette.documents[url]
+        except KeyError:
+            raise ValueError(f'{url} was not recorded in the cassette')
+
+    def post_xml(self, address, envelope, headers):
+        call = self.cassette.next_call(headers.get('SOAPAction'))
+        if self.latency_scale:
+            time.sleep(call['elapsed'] * self.latency_scale)
+
+        response = Response()
+        response.status_code = call['status']
+        response.headers['Content-Type'] = call['content_type'] or 'text/xml; charset=utf-8'
+        response.encoding = 'utf-8'
+        response._content = call['response'].encode('utf-8')
+        response.url = address
+        return response
+
+
+@contextmanager
+def replaying(router, cassette, latency_scale=1.0):
+    """
+    points router at the cassette for the duration: every company uses the recorded default WSDL of each
+    service and the clients are rebuilt on ReplayTransports. The router's own clients are put back afterwards.
+    """
+    saved = router.clients, router.companies, router.default_wsdls, router.transport
+    router.clients = {}
+    router.companies = {}
+    router.default_wsdls = {**router.default_wsdls, **cassette.wsdls}
+    router.transport = lambda service, wsdl: ReplayTransport(cassette, latency_scale)
+    try:
+        yield router
+    finally:
+        router.clients, router.companies, router.default_wsdls, router.transport = saved
@@ -7,8 +7,14 @@ router = DefaultRouter()
 router.register(r'unpaids', views.UnpaidViewSet)
 router.register(r'users', views.UserViewSet)
 router.register(r'charges', views.ChargeViewSet)
+router.register(r'webhooks', views.WebhookSubscriptionViewSet)
 
 # The API URLs are now determined automatically by the router.
 urlpatterns = [
     path('', include(router.urls)),
+    path('t24/metrics/', views.t24_metrics, name='t24-metrics'),
+    # no trailing slash, load balancer probes do not follow the APPEND_SLASH redirect
+    path('health/live', views.health_live, name='health-live'),
+    path('health/ready', views.health_ready, name='health-ready'),
+    path('health/state', views.health_state, name='health-state'),
 ]
\ No newline at end of file
@@ -1,18 +1,25 @@
+import os
+
 from datetime import datetime
-from .models import UnpaidCheque, Charge
-from .serializers import UnpaidChequeSerializer, UserSerializer, ChargeSerializer
-from .permissions import IsOwnerOrReadOnly
-from .helpers import Helpers
+from .models import UnpaidCheque, Charge, WebhookSubscription
+from .serializers import (UnpaidChequeSerializer, UserSerializer, ChargeSerializer, WebhookSubscriptionSerializer,
+                          WebhookSubscriptionCreateSerializer)
+from .permissions import CanReadHealthState, IsOwnerOrReadOnly
+from .throttling import AdmissionControlMixin
+from .batching import batcher, persist
+from .claims import claim_unpaid_cheques, hold_claims, new_claimer, release_claim
+from .health import checker
+from .helpers import Helpers, router, current_date
+from . import tasks
 from rest_framework import permissions, viewsets, status
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
+from django.conf import settings
 from django.contrib.auth.models import User
 from asgiref.sync import sync_to_async
 
 
-current_date = datetime.now().strftime('%Y-%m-%d')
-
 # object of the Helper class
 helper = Helpers()
 
@@ -27,7 +34,57 @@ def api_root(request, format=None):
     })
 
 
-class UnpaidViewSet(viewsets.ModelViewSet):
+# per-company metrics of the T24 calls made by this worker
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def t24_metrics(request, format=None):
+    return Response({
+        'services': router.metrics.snapshot(),
+        'pools': router.pool_state(),
+    })
+
+
+# liveness probe: the worker is up and answering, nothing else is checked
+@api_view(['GET'])
+@authentication_classes([])
+@permission_classes([permissions.AllowAny])
+def health_live(request, format=None):
+    return Response({'status': 'alive'})
+
+
+# readiness probe: the outcome of the last background checks of the database and the T24 WSDLs
+@api_view(['GET'])
+@authentication_classes([])
+@permission_classes([permissions.AllowAny])
+def health_ready(request, format=None):
+    ready, details = checker.status()
+    return Response(details, status=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+# live load of this worker, for the load balancer to shed traffic from saturated nodes
+@api_view(['GET'])
+@permission_classes([CanReadHealthState])
+def health_state(request, format=None):
+    """
+    - the T24 calls in flight and the recent latency percentiles per service and company
+    - the calls running and queued in each pool (per service and company); saturated is true when a pool has
+      callers waiting
+    - the depth of the background task and write-behind queues
+    """
+    pools = router.pool_state()
+    return Response({
+        'pid': os.getpid(),
+        'saturated': any(pool['waiting'] for pool in pools.values()),
+        't24': router.metrics.snapshot(),
+        'pools': pools,
+        'queues': {
+            'background_tasks': tasks.queue_depth(),
+            'write_behind': batcher.queue.qsize(),
+        },
+    })
+
+
+class UnpaidViewSet(AdmissionControlMixin, viewsets.ModelViewSet):
     """
     This viewset automatically provides `list`, `create`, `retrieve`,
     `update` and `destroy` actions.
@@ -56,30 +113,13 @@ class UnpaidViewSet(viewsets.ModelViewSet):
         # read the request dict
         request_dict = helper.string_to_dict(request)
 
-        # validate the request
-        validated_request_dict = helper.validate_input(request_dict)
+        # validate the request, call the query_cc and unpay_cheque web services and evaluate the response
+        validated_request_dict = helper.process_unpay_request(request_dict)
 
-        # if the request is invalid, return an error message
+        # if the request is invalid or a web service call failed, return an error message
         if 'error' in validated_request_dict:
             return Response(validated_request_dict, status=status.HTTP_400_BAD_REQUEST)
 
-        # call the query_cc web service
-        response = helper.create_query_soap_request(validated_request_dict)
-
-        # if the response is an error message, return an error message
-        if 'error' in response:
-            return Response(response, status=status.HTTP_400_BAD_REQUEST)
-
-        # call the unpay_cheque web service
-        response = helper.create_unpay_soap_request(response)
-
-        # if the response is an error message, return an error message
-        if 'error' in response:
-            return Response(response, status=status.HTTP_400_BAD_REQUEST)
-
-        # evaluate the response from the unpay_cheque web service
-        validated_request_dict = helper.evaluate_soap_response(validated_request_dict, response)
-
         # log the validated_request_dict
         logger.info(validated_request_dict)
 
@@ -90,7 +130,7 @@ class UnpaidViewSet(viewsets.ModelViewSet):
             
             # create and save the UnpaidCheque object
             unpaid_cheque = UnpaidCheque(**validated_request_dict)
-            unpaid_cheque.save()
+            persist(unpaid_cheque)
 
             # create a response dictionary
             response_dict = {
@@ -131,7 +171,7 @@ class UnpaidViewSet(viewsets.ModelViewSet):
         serializer.save(owner=self.request.user)
 
 
-class ChargeViewSet(viewsets.ModelViewSet):
+class ChargeViewSet(AdmissionControlMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows charges to be viewed or edited.
     """
@@ -144,7 +184,8 @@ class ChargeViewSet(viewsets.ModelViewSet):
     def create(self, request, *args, **kwargs):
         """
         - checks to see if the charge had been collected,
-        - if not, creates a charge object and returns the API response
+        - claims the unpaid cheque so that the collection sweep and the admin do not charge it at the same time,
+        - if it could be claimed, creates a charge object and returns the API response
         """
         # create a logger object
         logger = helper.setup_logger('charge', f'logs/{current_date}/API_response.log')
@@ -153,13 +194,33 @@ class ChargeViewSet(viewsets.ModelViewSet):
         if helper.validate_charge_not_collected(request):
             return Response(helper.validate_charge_not_collected(request), status=status.HTTP_400_BAD_REQUEST)
 
+        # find the unpaid cheque before charging, a charge made in T24 must have a row to be stored against
+        try:
+            unpaid_cheque = UnpaidCheque.objects.get(ft_ref=request.data['ft_ref'],
+                                                     cheque_account=request.data['charge_account'])
+        except (KeyError, UnpaidCheque.DoesNotExist, UnpaidCheque.MultipleObjectsReturned):
+            return Response({'error': 'no single unpaid cheque matches ft_ref and charge_account'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # claim the cheque, the claim also re-checks that it is unpaid and has no collected charge
+        claimed_by = new_claimer('api')
+        if not claim_unpaid_cheques([unpaid_cheque.pk], claimed_by, settings.CHARGE_COLLECTION['CLAIM_TTL']):
+            return Response({'error': 'the cheque is not unpaid, its charge has been collected or is being collected'},
+                            status=status.HTTP_409_CONFLICT)
+
         # call the web service in a try block
         try:
             # call the web service
-            response = helper.create_charge_soap_request(request)
-
-            # if the response is an error message, return an error message
+            try:
+                response = helper.create_charge_soap_request(request.data['charge_account'], unpaid_cheque.co_code)
+            except Exception:
+                # T24 did not answer, the cheque can be tried again right away
+                release_claim(unpaid_cheque, claimed_by)
+                raise
+
+            # if the response is an error message, nothing was charged: drop the claim and return the error
             if 'error' in response:
+                release_claim(unpaid_cheque, claimed_by)
                 return Response(response, status=status.HTTP_400_BAD_REQUEST)
 
             # # create a response dictionary
@@ -178,14 +239,22 @@ class ChargeViewSet(viewsets.ModelViewSet):
 
             # update response_dict with the owner field and cc_record field
             response['owner'] = self.request.user
-            response['cc_record'] = UnpaidCheque.objects.get(ft_ref=request.data['ft_ref'], cheque_account=request.data['charge_account'])
+            response['cc_record'] = unpaid_cheque
 
             # create and save the Charge object
             charge = Charge(**response)
-            charge.save()
-
-            # return the response
-            return Response(response, status=status.HTTP_201_CREATED)
+            try:
+                persist(charge)
+            except Exception:
+                # the charge was made in T24, keep the cheque from being charged again
+                hold_claims([charge], logger)
+                raise
+            if not charge.is_collected:
+                # T24 answered that nothing was collected, the cheque can be tried again right away
+                release_claim(unpaid_cheque, claimed_by)
+
+            # return the charge, the response dictionary now holds the owner and cheque objects
+            return Response(self.get_serializer(charge).data, status=status.HTTP_201_CREATED)
         except Exception as e:
             # log the error from the API response creation and return an error message 
             logger.error(e)
@@ -195,6 +264,29 @@ class ChargeViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
+class WebhookSubscriptionViewSet(viewsets.ModelViewSet):
+    """
+    Callback URLs that get a signed POST when one of the caller's unpaid cheques or charges is recorded,
+    whatever its outcome, or its outcome changes. The secret used to sign the events is returned when the subscription is created,
+    and never again.
+    """
+    queryset = WebhookSubscription.objects.all()
+    serializer_class = WebhookSubscriptionSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_serializer_class(self):
+        if self.action == 'create':
+            return WebhookSubscriptionCreateSerializer
+        return WebhookSubscriptionSerializer
+
+    def get_queryset(self):
+        # clients only see their own subscriptions
+        return WebhookSubscription.objects.filter(owner=self.request.user)
+
+    def perform_create(self, serializer):
+        serializer.save(owner=self.request.user)
+
+
 class UserViewSet(viewsets.ReadOnlyModelViewSet):
     """
     This viewset automatically provides `list` and `retrieve` actions.
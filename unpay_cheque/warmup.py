@@ -0,0 +1,61 @@
+# work done once when the app loads instead of on the first request of every worker
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.urls import get_resolver
+from .helpers import Helpers, current_date, router, tws_co_code, wsdls
+from . import serializers
+
+
+helper = Helpers()
+
+
+def preload_soap_clients(logger):
+    """
+    loads the WSDL of every T24 web service for the default company and the companies in T24_COMPANIES.
+    the requests session of each client is closed afterwards so that forked workers do not share its
+    sockets, the parsed WSDL is what is worth keeping
+    """
+    for company in {tws_co_code, *settings.T24_COMPANIES}:
+        for service in wsdls:
+            if not router.wsdl(service, company):
+                continue
+            try:
+                client = router.client(service, company)
+                client.transport.session.close()
+            except Exception as e:
+                logger.error(f'warm-up: loading the {service} WSDL for company {company}: {e}')
+
+
+def build_serializers():
+    """builds the fields, and with them the validators, of every serializer once"""
+    for serializer_class in (serializers.UnpaidChequeSerializer, serializers.UserSerializer,
+                             serializers.ChargeSerializer, serializers.WebhookSubscriptionSerializer,
+                             serializers.WebhookSubscriptionCreateSerializer):
+        serializer_class().fields
+
+
+def run():
+    """
+    Warms the process up before it serves requests:
+    - loads the T24 WSDLs into the router's client cache
+    - builds the serializers and resolves the URLconf, which imports the views
+    - checks that the database is reachable; the connection is closed again, a connection opened in the
+      gunicorn master must not be shared by the workers forked from it
+    Failures are logged and do not stop the process from starting.
+    """
+    logger = helper.setup_logger('warmup', f'logs/{current_date}/warmup.log')
+    started = time.perf_counter()
+
+    preload_soap_clients(logger)
+    build_serializers()
+    get_resolver().url_patterns
+    try:
+        connection.ensure_connection()
+    except Exception as e:
+        logger.error(f'warm-up: connecting to the database: {e}')
+    finally:
+        connection.close()
+
+    logger.info(f'warm-up done in {time.perf_counter() - started:.3f}s')
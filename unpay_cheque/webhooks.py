@@ -0,0 +1,203 @@
+# outbound webhooks telling clients about unpay and charge outcomes
+import hashlib
+import hmac
+import ipaddress
+import json
+import random
+import socket
+import time
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+import requests
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.utils import timezone
+from .helpers import Helpers, current_date
+from .models import WebhookSubscription, WebhookEvent
+
+
+helper = Helpers()
+
+SIGNATURE_HEADER = 'X-Webhook-Signature'
+TIMESTAMP_HEADER = 'X-Webhook-Timestamp'
+
+
+class UnsafeCallbackURL(ValueError):
+    pass
+
+
+def check_callback_url(url):
+    """
+    raises UnsafeCallbackURL unless url is https and its host resolves to public addresses only, so that a
+    subscription cannot make the delivery worker post to the internal network, the loopback interface or a
+    cloud metadata endpoint (169.254.169.254). WEBHOOKS['ALLOW_LOCAL'] lifts both rules for development
+    """
+    if settings.WEBHOOKS['ALLOW_LOCAL']:
+        return
+    parts = urlsplit(url)
+    if parts.scheme != 'https' or not parts.hostname:
+        raise UnsafeCallbackURL('the callback URL must be an https URL')
+    try:
+        infos = socket.getaddrinfo(parts.hostname, parts.port or 443, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        raise UnsafeCallbackURL(f'the host {parts.hostname} of the callback URL does not resolve')
+    for info in infos:
+        # the scope of a link-local IPv6 address (fe80::1%eth0) is not part of the address
+        ip = ipaddress.ip_address(info[4][0].split('%')[0])
+        # ::ffff:10.0.0.1 is 10.0.0.1
+        ip = getattr(ip, 'ipv4_mapped', None) or ip
+        if not ip.is_global or ip.is_multicast:
+            raise UnsafeCallbackURL(f'the host {parts.hostname} of the callback URL is not a public address')
+
+
+def sign(secret, timestamp, body):
+    """hex HMAC-SHA256 of '<timestamp>.<body>' with the subscription's secret"""
+    return hmac.new(secret.encode(), f'{timestamp}.'.encode() + body, hashlib.sha256).hexdigest()
+
+
+def emit(owner_id, event_type, data):
+    """
+    - add an event to the outbox of every active subscription of the owner
+    - keep each outbox bounded: beyond MAX_PENDING pending events the oldest ones are dropped
+    """
+    max_pending = settings.WEBHOOKS['MAX_PENDING']
+    for subscription in WebhookSubscription.objects.filter(owner_id=owner_id, is_active=True):
+        WebhookEvent.objects.create(subscription=subscription, event_type=event_type, payload=data)
+        pending = WebhookEvent.objects.filter(subscription=subscription, status=WebhookEvent.PENDING)
+        overflow = pending.count() - max_pending
+        if overflow > 0:
+            oldest = pending.order_by('created_at').values_list('pk', flat=True)[:overflow]
+            WebhookEvent.objects.filter(pk__in=list(oldest)).update(status=WebhookEvent.DROPPED)
+
+
+class WebhookDeliverer:
+    """
+    Delivers the outbox:
+    - due pending events are grouped per subscription and posted as batches of up to BATCH_SIZE events
+    - every destination (scheme://host:port) has its own requests session, so connections are kept alive
+      and pooled between batches
+    - a failed batch is retried with exponential backoff and jitter until MAX_ATTEMPTS, then marked failed
+    - the callback URL is checked again before every post (the host may resolve elsewhere since the
+      subscription was made) and redirects are not followed, a 3xx counts as a failed delivery
+    Events carry their id and creation time; a retried batch can arrive after newer events, so
+    subscribers should order by id. Run a single delivery worker per database, events are not claimed.
+    """
+
+    def __init__(self, concurrency=4):
+        self.config = settings.WEBHOOKS
+        self.concurrency = concurrency
+        self.sessions = {}
+        self.logger = helper.setup_logger('webhooks', f'logs/{current_date}/webhooks.log')
+
+    def session(self, url):
+        parts = urlsplit(url)
+        origin = f'{parts.scheme}://{parts.netloc}'
+        if origin not in self.sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+            session.mount(origin, adapter)
+            self.sessions[origin] = session
+        return self.sessions[origin]
+
+    def due_batches(self):
+        """returns [(subscription, [events])] of the pending events that are due, oldest first"""
+        events = (WebhookEvent.objects
+                  .filter(status=WebhookEvent.PENDING, next_attempt_at__lte=timezone.now())
+                  .select_related('subscription')
+                  .order_by('next_attempt_at', 'pk')[:self.config['BATCH_SIZE'] * self.concurrency * 4])
+        by_subscription = defaultdict(list)
+        for event in events:
+            by_subscription[event.subscription].append(event)
+
+        batches = []
+        for subscription, subscription_events in by_subscription.items():
+            for i in range(0, len(subscription_events), self.config['BATCH_SIZE']):
+                batches.append((subscription, subscription_events[i:i + self.config['BATCH_SIZE']]))
+        return batches
+
+    def deliver_due(self):
+        """delivers one round of due batches, concurrently across subscriptions. returns the number of batches"""
+        batches = self.due_batches()
+        # sessions are created up front, the pool threads only read the dictionary
+        for subscription, _ in batches:
+            self.session(subscription.callback_url)
+
+        grouped = defaultdict(list)
+        for subscription, events in batches:
+            grouped[subscription.pk].append((subscription, events))
+
+        # batches of one subscription go out in order on one thread, subscriptions run side by side
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            list(pool.map(self.deliver_subscription, grouped.values()))
+        return len(batches)
+
+    def deliver_subscription(self, batches):
+        try:
+            for subscription, events in batches:
+                if not self.post(subscription, events):
+                    # the destination is probably down, leave its other batches for the next round
+                    break
+        finally:
+            connection.close()
+
+    def post(self, subscription, events):
+        """posts a batch and records the outcome on its events. returns True if the batch was delivered"""
+        body = json.dumps({'events': [
+            {'id': event.pk, 'type': event.event_type, 'created_at': event.created_at, 'data': event.payload}
+            for event in events
+        ]}, cls=DjangoJSONEncoder).encode()
+        timestamp = str(int(time.time()))
+        headers = {
+            'Content-Type': 'application/json',
+            TIMESTAMP_HEADER: timestamp,
+            SIGNATURE_HEADER: 'sha256=' + sign(subscription.secret, timestamp, body),
+        }
+
+        try:
+            check_callback_url(subscription.callback_url)
+        except UnsafeCallbackURL as e:
+            # not worth retrying, the subscription has to be fixed
+            WebhookEvent.objects.filter(pk__in=[event.pk for event in events]).update(
+                status=WebhookEvent.FAILED, last_error=str(e)[:200])
+            self.logger.error(f'not delivering {len(events)} events to {subscription.callback_url}: {e}')
+            return False
+
+        try:
+            response = self.session(subscription.callback_url).post(
+                subscription.callback_url, data=body, headers=headers, timeout=self.config['TIMEOUT'],
+                allow_redirects=False)
+            error = None if 200 <= response.status_code < 300 else f'HTTP {response.status_code}'
+        except requests.RequestException as e:
+            error = str(e)[:200]
+
+        pks = [event.pk for event in events]
+        if error is None:
+            WebhookEvent.objects.filter(pk__in=pks).update(status=WebhookEvent.DELIVERED, delivered_at=timezone.now())
+            self.logger.info(f'delivered {len(events)} events to {subscription.callback_url}')
+            return True
+
+        attempts = max(event.attempts for event in events) + 1
+        if attempts >= self.config['MAX_ATTEMPTS']:
+            WebhookEvent.objects.filter(pk__in=pks).update(status=WebhookEvent.FAILED, attempts=attempts, last_error=error)
+            self.logger.error(f'giving up on {len(events)} events for {subscription.callback_url}: {error}')
+        else:
+            backoff = min(self.config['BACKOFF_MAX'], self.config['BACKOFF_BASE'] * 2 ** (attempts - 1))
+            next_attempt_at = timezone.now() + timedelta(seconds=backoff * random.uniform(0.5, 1))
+            WebhookEvent.objects.filter(pk__in=pks).update(attempts=attempts, next_attempt_at=next_attempt_at, last_error=error)
+            self.logger.warning(f'retrying {len(events)} events for {subscription.callback_url} at {next_attempt_at}: {error}')
+        return False
+
+    def run(self, poll_interval=1, once=False):
+        """delivers due events until interrupted, or one round if once is True"""
+        while True:
+            batches = self.deliver_due()
+            if once:
+                return
+            if not batches:
+                time.sleep(poll_interval)